@@ -5,6 +5,8 @@ from django.contrib import messages
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
 from.models import ShippingAddress
+from django.utils.http import url_has_allowed_host_and_scheme
+from store import carts
 
 
 def register_view(request):
@@ -32,6 +34,8 @@ def login_view(request):
         user = authenticate(request, email=email, password=password)
         if user is not None:
             login(request, user)
+            # move the cart filled in before logging in over to the account
+            carts.merge_cookie_cart(request, user)
 
             # Handle "Remember Me"
             if not remember_me:
@@ -40,7 +44,14 @@ def login_view(request):
                 request.session.set_expiry(0)
 
             messages.success(request, "Logged in successful")
-            return redirect(reverse("store:home_page"))
+            next_url = request.GET.get("next")
+            if not url_has_allowed_host_and_scheme(
+                next_url, allowed_hosts={request.get_host()}, require_https=request.is_secure()
+            ):
+                next_url = reverse("store:home_page")
+            response = redirect(next_url)
+            response.delete_cookie(carts.COOKIE_NAME)
+            return response
 
         messages.error(request, "Email or password is incorrect")
 
@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'project.settings')
+# the payment views wait on Khalti without holding a thread under ASGI
+os.environ.setdefault('ASYNC_PAYMENT_VIEWS', 'True')
 
 application = get_asgi_application()
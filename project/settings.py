@@ -76,6 +76,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'store.context_processors.cart_summary',
             ],
         },
     },
@@ -91,6 +92,24 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # take the write lock when a transaction starts: concurrent checkouts then
+            # queue on the busy timeout instead of failing with "database is locked"
+            # when a read transaction tries to upgrade to a write
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
+    }
+}
+
+
+# Cache
+# shared between worker processes so that invalidations reach all of them
+
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': config('CACHE_LOCATION', default=str(BASE_DIR / 'cache')),
     }
 }
 
@@ -138,6 +157,58 @@ MEDIA_ROOT = BASE_DIR / "media"
 MEDIA_URL = "/media/"
 
 
+# Store
+# seconds before the in-memory catalog index (facets, filtering) is rebuilt from the db
+CATALOG_INDEX_TTL = config("CATALOG_INDEX_TTL", default=300, cast=int)
+# bytes the catalog index may use per process, larger catalogs are served from the db
+CATALOG_INDEX_MAX_MEMORY = config("CATALOG_INDEX_MAX_MEMORY", default=64 * 1024 * 1024, cast=int)
+# show "about N products" on listings served from the db, it costs a COUNT(*) per
+# filter combination every TOTAL_CACHE_TIMEOUT; index-served listings always show it
+CATALOG_COUNT_TOTAL = config("CATALOG_COUNT_TOTAL", default=False, cast=bool)
+# seconds the rendered featured products block on the home page is cached for,
+# it is invalidated early whenever a product changes
+FEATURED_PRODUCTS_CACHE_TIMEOUT = config("FEATURED_PRODUCTS_CACHE_TIMEOUT", default=60 * 60 * 24, cast=int)
+# seconds product detail data is cached for, it is invalidated early whenever a product changes
+PRODUCT_DETAIL_CACHE_TIMEOUT = config("PRODUCT_DETAIL_CACHE_TIMEOUT", default=300, cast=int)
+# seconds an expired product detail entry is still served while one worker refreshes it
+PRODUCT_DETAIL_STALE_TIMEOUT = config("PRODUCT_DETAIL_STALE_TIMEOUT", default=600, cast=int)
+# coalesce concurrent cache misses so only one worker hits the database
+VIEW_CACHE_SINGLE_FLIGHT = config("VIEW_CACHE_SINGLE_FLIGHT", default=True, cast=bool)
+# seconds a request waits for another worker's recompute before doing it itself
+VIEW_CACHE_COALESCE_WAIT = config("VIEW_CACHE_COALESCE_WAIT", default=1.0, cast=float)
+# seconds stock stays reserved for an unpaid order before the sweeper puts it back on sale
+STOCK_RESERVATION_TTL = config("STOCK_RESERVATION_TTL", default=15 * 60, cast=int)
+# days a delivered or cancelled order stays in the order tables before archive_orders moves it
+ORDER_ARCHIVE_AFTER_DAYS = config("ORDER_ARCHIVE_AFTER_DAYS", default=90, cast=int)
+# background threads per process that generate product image thumbnails / webp copies
+IMAGE_DERIVATIVE_WORKERS = config("IMAGE_DERIVATIVE_WORKERS", default=2, cast=int)
+
+# Khalti payment gateway
+# public address of the site, Khalti redirects the customer back to it
+SITE_URL = config("SITE_URL", default="http://localhost:8000")
+# the sandbox by default; https://khalti.com/api/v2/ in production, or a local stand-in
+# (python manage.py khalti_stand_in) for load tests
+KHALTI_BASE_URL = config("KHALTI_BASE_URL", default="https://dev.khalti.com/api/v2/")
+KHALTI_SECRET_KEY = config("KHALTI_SECRET_KEY", default="")
+# seconds to open a connection / to wait for a response from Khalti
+KHALTI_CONNECT_TIMEOUT = config("KHALTI_CONNECT_TIMEOUT", default=3.05, cast=float)
+KHALTI_READ_TIMEOUT = config("KHALTI_READ_TIMEOUT", default=10, cast=float)
+# retries of idempotent gateway calls (lookups) after a transport error or a 5xx
+KHALTI_MAX_RETRIES = config("KHALTI_MAX_RETRIES", default=2, cast=int)
+# keep-alive connections to Khalti each process keeps open
+KHALTI_POOL_SIZE = config("KHALTI_POOL_SIZE", default=10, cast=int)
+# consecutive failures that open the circuit breaker, and seconds it fails fast before trying again
+KHALTI_CIRCUIT_FAILURES = config("KHALTI_CIRCUIT_FAILURES", default=5, cast=int)
+KHALTI_CIRCUIT_RESET_TIMEOUT = config("KHALTI_CIRCUIT_RESET_TIMEOUT", default=30, cast=float)
+# serve the payment views as async views; set by project/asgi.py, leave off under WSGI
+# where every async view would get a fresh event loop and connection pool
+ASYNC_PAYMENT_VIEWS = config("ASYNC_PAYMENT_VIEWS", default=False, cast=bool)
+# seconds an open payment is left to its callback before reconcile_payments looks it up
+PAYMENT_RECONCILE_MIN_AGE = config("PAYMENT_RECONCILE_MIN_AGE", default=300, cast=int)
+# lookups reconcile_payments keeps in flight; at most KHALTI_POOL_SIZE reuse a connection
+PAYMENT_RECONCILE_CONCURRENCY = config("PAYMENT_RECONCILE_CONCURRENCY", default=8, cast=int)
+
+
 
 ################################### JAZZMIN Setting ####################################
 JAZZMIN_SETTINGS = {
@@ -1,5 +1,12 @@
+from datetime import timedelta
+
 from django.contrib import admin
-from .models import Product, Category, Cart, CartProduct , Payment, Order
+from django.template.response import TemplateResponse
+from django.db.models import Q, Sum
+from django.utils import timezone
+
+from store import rollups
+from .models import Product, Category, Cart, CartProduct , Payment, Order, ArchivedOrder, ArchivedOrderItem, ArchivedPayment, DailyOrderStats, DailyProductSales
 from store.forms import OrderChangeForm
 
 admin.site.register(Product)
@@ -26,4 +33,80 @@ class OrderModelAdmin(admin.ModelAdmin):
     #disable add
     def has_add_permission(self, request):
         return False
-    
+
+
+class ReadOnlyAdminMixin:
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+class ArchivedOrderItemInline(ReadOnlyAdminMixin, admin.TabularInline):
+    model = ArchivedOrderItem
+    fields = ["product_name", "price", "quantity"]
+
+
+class ArchivedPaymentInline(ReadOnlyAdminMixin, admin.StackedInline):
+    model = ArchivedPayment
+
+
+#archived orders keep the list columns and filters of the live ones, read-only
+@admin.register(ArchivedOrder)
+class ArchivedOrderModelAdmin(ReadOnlyAdminMixin, admin.ModelAdmin):
+    list_display = ["order_id","status","user","total","created_at","archived_at"]
+
+    list_filter = ["status","delivery_person"]
+    search_fields = ["order_id","user__email","user__first_name","user__last_name"]
+    list_select_related = ["user"]
+
+    inlines = [ArchivedOrderItemInline, ArchivedPaymentInline]
+
+
+#sales dashboard: reads the rollup tables only, never orders
+@admin.register(DailyOrderStats)
+class SalesDashboardAdmin(ReadOnlyAdminMixin, admin.ModelAdmin):
+    change_list_template = "admin/store/sales_dashboard.html"
+    PERIODS = [7, 30, 90, 365]
+    TOP_PRODUCTS = 10
+
+    def changelist_view(self, request, extra_context=None):
+        try:
+            days = int(request.GET.get("days", 30))
+        except ValueError:
+            days = 30
+        days = days if days in self.PERIODS else 30
+        since = timezone.localdate() - timedelta(days=days - 1)
+
+        stats = DailyOrderStats.objects.filter(day__gte=since)
+        sold = Q(status__in=rollups.SOLD_STATUSES)
+        statuses = dict(DailyOrderStats._meta.get_field("status").choices)
+        context = {
+            **self.admin_site.each_context(request),
+            "title": "Sales dashboard",
+            "opts": self.model._meta,
+            "days": days,
+            "periods": self.PERIODS,
+            "since": since,
+            "daily": stats.values("day").annotate(
+                placed=Sum("orders"),
+                sold=Sum("orders", filter=sold),
+                sold_revenue=Sum("revenue", filter=sold),
+            ).order_by("-day"),
+            "statuses": [
+                {**row, "status": statuses.get(row["status"], row["status"])}
+                for row in stats.values("status").annotate(count=Sum("orders"), value=Sum("revenue")).order_by("status")
+            ],
+            "totals": stats.aggregate(sold=Sum("orders", filter=sold), sold_revenue=Sum("revenue", filter=sold)),
+            "products": DailyProductSales.objects.filter(day__gte=since)
+            .values("product_id", "product__name")
+            .annotate(sold_units=Sum("units"), sold_revenue=Sum("revenue"))
+            .filter(sold_units__gt=0)
+            .order_by("-sold_revenue")[: self.TOP_PRODUCTS],
+            **(extra_context or {}),
+        }
+        return TemplateResponse(request, self.change_list_template, context)
@@ -0,0 +1,81 @@
+"""Archive tier for finished orders.
+
+Delivered and cancelled orders that have not changed for
+``ORDER_ARCHIVE_AFTER_DAYS`` are moved, with their items and payment, from
+``Order`` / ``OrderItem`` / ``Payment`` into the ``Archived*`` tables by
+:func:`archive_orders` (the ``archive_orders`` command, run from cron). Rows
+keep their primary keys, so an order has the same id and ``order_id`` before
+and after the move and the hot tables only hold the orders still in play.
+
+:func:`order_history` reads both tiers as one list for the order page.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Prefetch
+from django.utils import timezone
+
+from .models import (
+    Order, OrderItem, Payment, StockReservation, ArchivedOrder, ArchivedOrderItem, ArchivedPayment,
+)
+from .pagination import MergedKeysetPaginator
+
+ARCHIVED_STATUSES = [Order.Status.DELIVERED, Order.Status.CANCELLED]
+
+
+def _copy(row, model):
+    """An unsaved ``model`` instance with the field values ``row`` shares with it."""
+    source_fields = {field.attname for field in row._meta.concrete_fields}
+    return model(**{
+        field.attname: getattr(row, field.attname)
+        for field in model._meta.concrete_fields
+        if field.attname in source_fields
+    })
+
+
+def archive_orders(before=None, batch_size=500):
+    """Move finished orders last updated before ``before`` into the archive tables.
+
+    Works in batches of ``batch_size`` orders, one short transaction each.
+    Orders still holding stock reservations are left alone. Returns the
+    number of orders archived.
+    """
+    before = before or timezone.now() - timedelta(days=settings.ORDER_ARCHIVE_AFTER_DAYS)
+    archived = 0
+    while True:
+        with transaction.atomic():
+            orders = list(
+                Order.objects.select_for_update(skip_locked=True)
+                .filter(status__in=ARCHIVED_STATUSES, updated_at__lt=before)
+                .exclude(Exists(StockReservation.objects.filter(order=OuterRef("pk"))))
+                .order_by("pk")[:batch_size]
+            )
+            if not orders:
+                return archived
+            order_ids = [order.pk for order in orders]
+
+            ArchivedOrder.objects.bulk_create(_copy(order, ArchivedOrder) for order in orders)
+            ArchivedOrderItem.objects.bulk_create(
+                _copy(item, ArchivedOrderItem) for item in OrderItem.objects.filter(order_id__in=order_ids)
+            )
+            ArchivedPayment.objects.bulk_create(
+                _copy(payment, ArchivedPayment) for payment in Payment.objects.filter(order_id__in=order_ids)
+            )
+            # cascades to the items and payments copied above
+            Order.objects.filter(pk__in=order_ids).delete()
+        archived += len(orders)
+
+
+def order_history(user, per_page):
+    """Paginator over the user's orders in both tiers, newest first, items prefetched."""
+    items = Prefetch("items", queryset=OrderItem.objects.select_related("product").order_by("pk"))
+    archived_items = Prefetch("items", queryset=ArchivedOrderItem.objects.select_related("product").order_by("pk"))
+    return MergedKeysetPaginator(
+        [
+            Order.objects.filter(user=user).prefetch_related(items),
+            ArchivedOrder.objects.filter(user=user).prefetch_related(archived_items),
+        ],
+        "-created_at",
+        per_page,
+    )
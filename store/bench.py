@@ -0,0 +1,285 @@
+"""Helpers shared by the ``bench_*`` management commands."""
+import importlib
+import json
+import random
+import socket
+import statistics
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlencode, urlsplit
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+import uvicorn
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.asgi import get_asgi_application
+from django.core.wsgi import get_wsgi_application
+from django.db import connection
+from django.test import override_settings
+from django.urls import clear_url_caches
+
+# seconds a stand-in payment page stays valid, like Khalti's
+EXPIRES_IN = 1800
+
+
+@contextmanager
+def scratch_database(name=None):
+    """Run the block against a throwaway copy of the schema (like the test runner).
+
+    ``name`` keeps an SQLite copy in that file instead of in memory, so that
+    worker processes can open it too.
+    """
+    old_name = connection.settings_dict["NAME"]
+    old_test = connection.settings_dict.get("TEST", {})
+    if name:
+        connection.settings_dict["TEST"] = {**old_test, "NAME": name}
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        connection.settings_dict["TEST"] = old_test
+
+
+def timed(func, repeat=5):
+    """Call ``func`` ``repeat`` times and return (median, best) in milliseconds."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples), min(samples)
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class _GatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.server.behave(self):
+            return
+        if self.path.endswith("/epayment/initiate/"):
+            pidx = self.server.add_payment(body["amount"], callback={
+                "return_url": body.get("return_url"),
+                "purchase_order_id": body.get("purchase_order_id"),
+                "purchase_order_name": body.get("purchase_order_name"),
+            })
+            self.answer(200, {
+                "pidx": pidx,
+                "payment_url": f"http://{self.server.host}:{self.server.server_port}/pay/{pidx}",
+                "expires_at": (datetime.now(timezone.utc) + timedelta(seconds=EXPIRES_IN)).isoformat(),
+                "expires_in": EXPIRES_IN,
+            })
+        elif self.path.endswith("/epayment/lookup/") and body.get("pidx") in self.server.payments:
+            self.answer(200, self.server.payments[body["pidx"]])
+        else:
+            self.answer(404, {"detail": "Not found."})
+
+    def do_GET(self):
+        """The payment page: the customer pays (or ``?status=User canceled``) and is sent back to the shop."""
+        url = urlsplit(self.path)
+        pidx = url.path.removeprefix("/pay/")
+        if not self.server.behave(self):
+            return
+        if not url.path.startswith("/pay/") or pidx not in self.server.payments:
+            self.answer(404, {"detail": "Not found."})
+            return
+        status = parse_qs(url.query).get("status", ["Completed"])[0]
+        self.server.set_status(pidx, status)
+        payment, callback = self.server.payments[pidx], self.server.callbacks[pidx]
+        query = urlencode({
+            "pidx": pidx,
+            "status": status,
+            "transaction_id": payment["transaction_id"] or "",
+            "tidx": payment["transaction_id"] or "",
+            "amount": payment["total_amount"],
+            "total_amount": payment["total_amount"],
+            "mobile": "98XXXXX001",
+            "purchase_order_id": callback["purchase_order_id"],
+            "purchase_order_name": callback["purchase_order_name"],
+        })
+        self.send_response(302)
+        self.send_header("Location", f"{callback['return_url']}?{query}")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def answer(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInGateway(ThreadingHTTPServer):
+    """A local Khalti stand-in: initiate, lookup and the payment page redirecting to the callback.
+
+    Every answer comes after ``delay`` seconds. A share ``error_rate`` of the
+    calls is answered 503, and a share ``timeout_rate`` only after ``hang``
+    seconds, past any sane client timeout. Payments start ``Initiated``;
+    opening their payment page, or :meth:`set_status`, settles them.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, delay=0.0, error_rate=0.0, timeout_rate=0.0, hang=60.0, host="127.0.0.1", port=0):
+        super().__init__((host, port), _GatewayHandler)
+        self.host = host
+        self.delay = delay
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.hang = hang
+        self.payments = {}
+        self.callbacks = {}
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.server_port}/api/v2/"
+
+    def handle_error(self, request, client_address):
+        # clients giving up on a hanging call is what the hang is for
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def behave(self, handler):
+        """Wait out the latency and inject failures; False when ``handler`` was already answered."""
+        roll = random.random()
+        if roll < self.timeout_rate:
+            time.sleep(self.hang)
+            handler.answer(504, {"detail": "Gateway timeout."})
+            return False
+        time.sleep(self.delay)
+        if roll < self.timeout_rate + self.error_rate:
+            handler.answer(503, {"detail": "Service unavailable."})
+            return False
+        return True
+
+    def add_payment(self, amount, status="Initiated", pidx=None, callback=None):
+        """Register a payment of ``amount`` paisa; returns its pidx."""
+        pidx = pidx or uuid.uuid4().hex
+        self.payments[pidx] = {"pidx": pidx, "total_amount": amount, "fee": 0, "refunded": False}
+        self.callbacks[pidx] = callback or {}
+        self.set_status(pidx, status)
+        return pidx
+
+    def set_status(self, pidx, status):
+        payment = self.payments[pidx]
+        payment["status"] = status
+        payment["transaction_id"] = f"TXN-{pidx}" if status == "Completed" else None
+
+
+@contextmanager
+def stand_in_gateway(delay=0.0, **options):
+    """Run a :class:`StandInGateway` on a free local port for the block; yields it."""
+    server = StandInGateway(delay, **options)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+# serving the site itself in-process, for the end-to-end benchmarks
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class WorkerPoolWSGIServer(ThreadingMixIn, WSGIServer):
+    """Serves requests on a fixed number of threads, like that many sync gunicorn workers."""
+
+    def __init__(self, address, workers):
+        super().__init__(address, _QuietHandler)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def reload_urls():
+    """Re-import the url modules so they route to the payment views ASYNC_PAYMENT_VIEWS picks."""
+    importlib.reload(importlib.import_module("store.urls"))
+    importlib.reload(importlib.import_module(settings.ROOT_URLCONF))
+    clear_url_caches()
+
+
+@contextmanager
+def serve_site(mode, workers=4, **overrides):
+    """Serve the site on a free port in this process, under ``"wsgi"`` or ``"asgi"``; yields its base URL.
+
+    ``overrides`` are extra settings for the block. ``SITE_URL`` points at the
+    server, so Khalti's callback comes back to it.
+    """
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    with override_settings(
+        ASYNC_PAYMENT_VIEWS=mode == "asgi", ALLOWED_HOSTS=["127.0.0.1"], SITE_URL=base_url, **overrides,
+    ):
+        reload_urls()
+        if mode == "asgi":
+            server = uvicorn.Server(uvicorn.Config(
+                get_asgi_application(), host="127.0.0.1", port=port, lifespan="off", log_level="warning",
+            ))
+            thread = threading.Thread(target=server.run, daemon=True)
+            thread.start()
+            while not server.started:
+                time.sleep(0.01)
+        else:
+            server = WorkerPoolWSGIServer(("127.0.0.1", port), workers)
+            server.set_app(get_wsgi_application())
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+        try:
+            yield base_url
+        finally:
+            if mode == "asgi":
+                server.should_exit = True
+            else:
+                server.shutdown()
+                server.server_close()
+            thread.join(timeout=10)
+    reload_urls()
+
+
+def login_cookies(user):
+    """Session cookies of a logged-in ``user``, without going through the login form."""
+    session = SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = "django.contrib.auth.backends.ModelBackend"
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.create()
+    return {settings.SESSION_COOKIE_NAME: session.session_key}
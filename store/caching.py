@@ -0,0 +1,103 @@
+"""Versioned cache keys for the store's view caches.
+
+Each cached namespace (e.g. ``"products"``) has a version number stored in the
+cache. Keys built with :func:`versioned_key` embed it, so bumping the version
+from a signal handler invalidates every entry of the namespace at once without
+having to know or delete the individual keys.
+
+:func:`get_or_set` reads through the cache with request coalescing: when an
+entry is missing only one worker recomputes it while the others wait briefly
+for its result, and an entry past its timeout keeps being served for
+``stale_timeout`` more seconds while a single worker refreshes it. The lock
+lives in the shared cache; the file-based cache's ``add()`` is not atomic
+across processes, so there two workers may now and then both recompute,
+which costs time but never correctness.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+# longest a recompute may hold the lock, in case the worker dies half way
+LOCK_TIMEOUT = 10
+
+POLL_INTERVAL = 0.02
+
+_acquire_lock = threading.Lock()
+
+
+def _version_key(namespace):
+    return f"store:version:{namespace}"
+
+
+def get_version(namespace):
+    version = cache.get(_version_key(namespace))
+    if version is None:
+        version = time.time_ns()
+        # add() so two processes racing here agree on a single version
+        cache.add(_version_key(namespace), version, None)
+        version = cache.get(_version_key(namespace), version)
+    return version
+
+
+def bump_version(namespace):
+    cache.set(_version_key(namespace), time.time_ns(), None)
+
+
+def versioned_key(namespace, *parts):
+    return ":".join(["store", namespace, str(get_version(namespace)), *map(str, parts)])
+
+
+def _lock_key(key):
+    return f"{key}:lock"
+
+
+def _acquire(key):
+    # FileBasedCache.add checks and then writes, so serialise it within the process
+    with _acquire_lock:
+        return cache.add(_lock_key(key), 1, LOCK_TIMEOUT)
+
+
+def _refresh(key, compute, timeout, stale_timeout):
+    try:
+        value = compute()
+        cache.set(key, (value, time.time() + timeout), timeout + stale_timeout)
+    finally:
+        cache.delete(_lock_key(key))
+    return value
+
+
+def get_or_set(key, compute, timeout, stale_timeout=0):
+    """Return the cached value of ``key``, calling ``compute()`` at most once at a time.
+
+    Keys built with :func:`versioned_key` change when their namespace is bumped,
+    so outdated content is never served as stale, only content past ``timeout``.
+    """
+    if not settings.VIEW_CACHE_SINGLE_FLIGHT:
+        entry = cache.get(key)
+        if entry is not None:
+            return entry[0]
+        value = compute()
+        cache.set(key, (value, time.time() + timeout), timeout + stale_timeout)
+        return value
+
+    entry = cache.get(key)
+    if entry is not None:
+        value, fresh_until = entry
+        # stale: the first worker to notice refreshes, everybody else serves it
+        if time.time() < fresh_until or not _acquire(key):
+            return value
+        return _refresh(key, compute, timeout, stale_timeout)
+
+    if _acquire(key):
+        return _refresh(key, compute, timeout, stale_timeout)
+
+    deadline = time.monotonic() + settings.VIEW_CACHE_COALESCE_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(POLL_INTERVAL)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry[0]
+    # the worker holding the lock is slow or gone, do not keep the visitor waiting
+    return compute()
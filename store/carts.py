@@ -0,0 +1,289 @@
+"""Cart writes.
+
+A cart holds one ``CartProduct`` line per product (a unique constraint), and
+every write is an upsert against it instead of a read followed by a save, so
+two tabs adding to the same cart can neither lose an update nor create a
+duplicate line.
+
+:func:`add_product` increments a line with a single ``INSERT ... ON CONFLICT
+DO UPDATE``. :func:`apply_changes` takes ``{product_id: quantity}``, where
+quantity is the new quantity of the line and 0 removes it, and applies them in
+one transaction: a product existence check, one multi-row upsert and one
+delete, however many lines change.
+
+Every change also recomputes the cart's denormalized ``item_count`` and
+``total`` in the same transaction (:func:`refresh_summary`), and
+:func:`get_summary` serves them from the cache for the navbar badge.
+
+Anonymous visitors get a cart kept in a signed cookie (``{product_id:
+quantity}``), so browsing and filling a cart writes nothing to the database.
+At login :func:`merge_cookie_cart` folds it into the user's ``Cart`` with
+one multi-row upsert.
+"""
+from decimal import Decimal
+
+from django.core import signing
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import DecimalField, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Product, Cart, CartProduct
+
+MAX_CHANGES = 100
+
+# bounds how long a summary cached by a request racing a cart change can be stale
+SUMMARY_CACHE_TIMEOUT = 300
+
+COOKIE_NAME = "cart"
+COOKIE_SALT = "store.carts.cookie"
+COOKIE_MAX_AGE = 60 * 60 * 24 * 30
+# keeps the signed cookie well under the 4 KB browsers accept
+MAX_COOKIE_LINES = 50
+
+
+class InvalidChange(Exception):
+    pass
+
+
+def parse_changes(data):
+    """Validate a decoded JSON body ``{"lines": [{"product_id": 1, "quantity": 2}, ...]}``.
+
+    Returns ``{product_id: quantity}``; for repeated products the last change wins.
+    """
+    lines = data.get("lines") if isinstance(data, dict) else None
+    if not isinstance(lines, list) or not lines:
+        raise InvalidChange("Expected a non-empty \"lines\" list.")
+    if len(lines) > MAX_CHANGES:
+        raise InvalidChange(f"At most {MAX_CHANGES} lines can be changed at once.")
+
+    changes = {}
+    for line in lines:
+        try:
+            product_id, quantity = line["product_id"], line["quantity"]
+        except (TypeError, KeyError):
+            raise InvalidChange("Every line needs a product_id and a quantity.")
+        if type(product_id) is not int or type(quantity) is not int or quantity < 0:
+            raise InvalidChange("product_id and quantity must be non-negative integers.")
+        changes[product_id] = quantity
+    return changes
+
+
+def summary_expressions(line_model=CartProduct):
+    """``update()`` kwargs recomputing ``item_count`` and ``total`` from the cart lines."""
+    money = DecimalField(max_digits=12, decimal_places=2)
+    lines = line_model.objects.filter(cart=OuterRef("pk")).order_by().values("cart")
+    return {
+        "item_count": Coalesce(Subquery(lines.annotate(count=Sum("quantity")).values("count")), 0),
+        "total": Coalesce(
+            Subquery(
+                lines.annotate(
+                    total=Sum(F("quantity") * F("product__price"), output_field=money)
+                ).values("total")
+            ),
+            Value(Decimal(0)),
+            output_field=money,
+        ),
+    }
+
+
+def _summary_key(user_id):
+    return f"store:cart-summary:{user_id}"
+
+
+def refresh_summaries(carts):
+    """Recompute the summaries of the ``carts`` queryset; call inside the transaction of the change."""
+    user_ids = list(carts.values_list("user_id", flat=True))
+    carts.update(**summary_expressions())
+    transaction.on_commit(lambda: cache.delete_many([_summary_key(user_id) for user_id in user_ids]))
+
+
+def refresh_summary(cart):
+    Cart.objects.filter(pk=cart.pk).update(**summary_expressions())
+    transaction.on_commit(lambda: cache.delete(_summary_key(cart.user_id)))
+
+
+def get_summary(user):
+    """``{"item_count", "total"}`` of the user's cart, usually without a query."""
+    key = _summary_key(user.pk)
+    summary = cache.get(key)
+    if summary is None:
+        summary = Cart.objects.filter(user=user).values("item_count", "total").first() or {
+            "item_count": 0,
+            "total": Decimal(0),
+        }
+        cache.set(key, summary, SUMMARY_CACHE_TIMEOUT)
+    return summary
+
+
+def add_products(cart, quantities):
+    """Add ``{product_id: quantity}`` to ``cart`` with one upsert; returns the new line quantities."""
+    if not quantities:
+        return {}
+    table = connection.ops.quote_name(CartProduct._meta.db_table)
+    added_at = connection.ops.adapt_datetimefield_value(timezone.now())
+    rows = ", ".join(["(%s, %s, %s, %s)"] * len(quantities))
+    params = []
+    for product_id, quantity in quantities.items():
+        params += [cart.pk, product_id, quantity, added_at]
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {table} (cart_id, product_id, quantity, added_at) VALUES {rows} "
+            f"ON CONFLICT (cart_id, product_id) DO UPDATE SET quantity = {table}.quantity + excluded.quantity "
+            f"RETURNING product_id, quantity",
+            params,
+        )
+        totals = dict(cursor.fetchall())
+        refresh_summary(cart)
+    return totals
+
+
+def add_product(cart, product_id, quantity=1):
+    """Add ``quantity`` of a product to ``cart``; returns ``(line quantity, created)``."""
+    total = add_products(cart, {product_id: quantity})[product_id]
+    # lines never hold 0, so the quantity only equals the amount added for a new line
+    return total, total == quantity
+
+
+def apply_changes(cart, changes):
+    """Set the quantity of every product in ``changes`` (``{product_id: quantity}``)."""
+    with transaction.atomic():
+        known = set(Product.objects.filter(pk__in=changes).values_list("pk", flat=True))
+        missing = sorted(set(changes) - known)
+        if missing:
+            raise InvalidChange(f"Unknown products: {', '.join(map(str, missing))}.")
+
+        lines = [
+            CartProduct(cart=cart, product_id=product_id, quantity=quantity)
+            for product_id, quantity in changes.items()
+            if quantity
+        ]
+        removed = [product_id for product_id, quantity in changes.items() if not quantity]
+        if lines:
+            CartProduct.objects.bulk_create(
+                lines,
+                update_conflicts=True,
+                unique_fields=["cart", "product"],
+                update_fields=["quantity"],
+            )
+        if removed:
+            CartProduct.objects.filter(cart=cart, product_id__in=removed).delete()
+        refresh_summary(cart)
+
+
+def cart_summary(cart):
+    """JSON-ready lines and totals of ``cart``, read in one query."""
+    lines = []
+    count = 0
+    total = Decimal(0)
+    for line in CartProduct.objects.filter(cart=cart).select_related("product").order_by("added_at", "pk"):
+        subtotal = line.product.price * line.quantity
+        lines.append({
+            "id": line.pk,
+            "product_id": line.product_id,
+            "name": line.product.name,
+            "price": str(line.product.price),
+            "quantity": line.quantity,
+            "subtotal": str(subtotal),
+        })
+        count += line.quantity
+        total += subtotal
+    return {"lines": lines, "count": count, "total": str(total)}
+
+
+# anonymous carts
+
+
+class CookieLine:
+    """A cookie cart line, with the attributes templates use on ``CartProduct``."""
+
+    def __init__(self, product, quantity):
+        self.id = self.product_id = product.pk
+        self.product = product
+        self.quantity = quantity
+
+    @property
+    def get_total_price(self):
+        return self.quantity * self.product.price
+
+
+def read_cookie(request):
+    """The anonymous cart as ``{product_id: quantity}``, empty when missing or tampered with."""
+    try:
+        data = signing.loads(request.COOKIES[COOKIE_NAME], salt=COOKIE_SALT, max_age=COOKIE_MAX_AGE)
+        return {int(product_id): int(quantity) for product_id, quantity in data.items() if int(quantity) > 0}
+    except (KeyError, signing.BadSignature, AttributeError, TypeError, ValueError):
+        return {}
+
+
+def write_cookie(response, lines):
+    if not lines:
+        response.delete_cookie(COOKIE_NAME)
+        return
+    response.set_cookie(
+        COOKIE_NAME,
+        signing.dumps(lines, salt=COOKIE_SALT, compress=True),
+        max_age=COOKIE_MAX_AGE,
+        httponly=True,
+        samesite="Lax",
+    )
+
+
+def change_cookie_lines(lines, changes):
+    """Return ``lines`` with ``{product_id: quantity}`` changes applied (0 removes)."""
+    added = [pk for pk, quantity in changes.items() if quantity]
+    known = set(Product.objects.filter(pk__in=added).values_list("pk", flat=True))
+    missing = sorted(pk for pk in added if pk not in known)
+    if missing:
+        raise InvalidChange(f"Unknown products: {', '.join(map(str, missing))}.")
+
+    lines = dict(lines)
+    for product_id, quantity in changes.items():
+        if quantity:
+            lines[product_id] = quantity
+        else:
+            lines.pop(product_id, None)
+    if len(lines) > MAX_COOKIE_LINES:
+        raise InvalidChange(f"A cart holds at most {MAX_COOKIE_LINES} products before logging in.")
+    return lines
+
+
+def cookie_cart_lines(lines):
+    """``CookieLine`` objects for a cookie cart, read in one query; gone products are skipped."""
+    products = Product.objects.in_bulk(lines)
+    return [CookieLine(products[pk], quantity) for pk, quantity in lines.items() if pk in products]
+
+
+def cookie_summary(lines):
+    """Same shape as :func:`cart_summary`, for a cookie cart."""
+    summary = {"lines": [], "count": 0, "total": Decimal(0)}
+    for line in cookie_cart_lines(lines):
+        subtotal = line.get_total_price
+        summary["lines"].append({
+            "id": line.id,
+            "product_id": line.product_id,
+            "name": line.product.name,
+            "price": str(line.product.price),
+            "quantity": line.quantity,
+            "subtotal": str(subtotal),
+        })
+        summary["count"] += line.quantity
+        summary["total"] += subtotal
+    summary["total"] = str(summary["total"])
+    return summary
+
+
+def merge_cookie_cart(request, user):
+    """Add the anonymous cart of ``request`` to ``user``'s cart; returns the number of lines merged.
+
+    The caller should drop the cookie from the response.
+    """
+    lines = read_cookie(request)
+    if not lines:
+        return 0
+    known = set(Product.objects.filter(pk__in=lines).values_list("pk", flat=True))
+    lines = {pk: quantity for pk, quantity in lines.items() if pk in known}
+    cart, _ = Cart.objects.get_or_create(user=user)
+    add_products(cart, lines)
+    return len(lines)
@@ -0,0 +1,467 @@
+"""Process-local bitmap index over the product catalog.
+
+Every product gets a position (positions follow pk order). Category membership
+and price buckets are kept as bitsets (plain Python ints) over those positions,
+price and created_at are array-backed columns with a sorted position order each,
+so the product listing can filter, count, facet, sort and page fully in memory
+and only load the rows it renders.
+
+The index is built lazily, updated in place by the signal handlers in
+``store.signals`` once the saving transaction commits, and rebuilt when another
+process bumps the shared version key in the cache or when it gets older than
+``CATALOG_INDEX_TTL`` seconds. Rebuilds run in a background thread while the
+previous index keeps serving, so a change in one process never stalls the
+requests of the others. Catalogs too large for ``CATALOG_INDEX_MAX_MEMORY`` are
+not indexed at all and the views fall back to the database.
+"""
+import logging
+import re
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, transaction
+
+logger = logging.getLogger(__name__)
+
+VERSION_KEY = "store:catalog-index:version"
+
+# lower bounds of the price histogram buckets, the last bucket is open ended
+PRICE_BUCKETS = [0, 100, 250, 500, 1000, 2500, 5000]
+
+PRICE_MASK_CACHE_SIZE = 64
+
+# use the sparse paging strategy when fewer than 1 in SPARSE_FACTOR products match
+SPARSE_FACTOR = 16
+
+# rough per-product footprint, used to refuse a build before loading anything
+ESTIMATED_BYTES_PER_PRODUCT = 320
+
+_NONZERO_BYTE = re.compile(rb"[^\x00]")
+
+
+class SortedColumn:
+    """Positions ordered by ``(values[pos], pos)``."""
+
+    def __init__(self, values):
+        self.values = values
+        self.order = array("q", sorted(range(len(values)), key=self.key))
+
+    def key(self, pos):
+        return (self.values[pos], pos)
+
+    def find(self, pos):
+        return bisect_left(self.order, self.key(pos), key=self.key)
+
+    def insert(self, pos):
+        self.order.insert(self.find(pos), pos)
+
+    def remove(self, pos):
+        # must be called before values[pos] changes
+        at = self.find(pos)
+        if at < len(self.order) and self.order[at] == pos:
+            del self.order[at]
+
+    def bounds(self, low=None, high=None):
+        """Slice of ``order`` holding values in the closed range [low, high]."""
+        start = 0 if low is None else bisect_left(self.order, (low, -1), key=self.key)
+        end = (
+            len(self.order)
+            if high is None
+            else bisect_right(self.order, (high, sys.maxsize), key=self.key)
+        )
+        return start, end
+
+
+class CatalogIndex:
+    def __init__(self, version=None):
+        self.lock = threading.RLock()
+        self.version = version
+        self.built_at = time.monotonic()
+
+        self.ids = array("q")
+        self.prices = array("d")
+        self.created = array("d")
+        self.positions = {}
+        self.alive = 0
+
+        self.categories = {}
+        self.product_categories = {}
+        self.price_buckets = [0] * len(PRICE_BUCKETS)
+
+        self.price_column = SortedColumn(self.prices)
+        self.created_column = SortedColumn(self.created)
+        self._price_masks = OrderedDict()
+
+    @classmethod
+    def build(cls, version=None):
+        from .models import Product
+
+        index = cls(version)
+        memberships = {}
+        for product_id, category_id in Product.categories.through.objects.values_list(
+            "product_id", "category_id"
+        ):
+            memberships.setdefault(product_id, []).append(category_id)
+
+        rows = Product.objects.order_by("pk").values_list("pk", "price", "created_at")
+        for pk, price, created_at in rows.iterator(chunk_size=5000):
+            index._add_row(pk, price, created_at, memberships.get(pk, ()))
+        index._set_all()
+
+        index.price_column = SortedColumn(index.prices)
+        index.created_column = SortedColumn(index.created)
+        return index
+
+    def __len__(self):
+        return self.alive.bit_count()
+
+    def memory_usage(self):
+        """Approximate size in bytes of everything the index holds."""
+        containers = (
+            self.ids, self.prices, self.created,
+            self.price_column.order, self.created_column.order,
+            self.positions, self.product_categories,
+        )
+        size = sum(sys.getsizeof(container) for container in containers)
+        size += sum(sys.getsizeof(bits) for bits in self.categories.values())
+        size += sum(sys.getsizeof(bits) for bits in self.price_buckets)
+        size += sum(sys.getsizeof(ids) for ids in self.product_categories.values())
+        # int objects held as keys and values by the positions dict
+        size += len(self.positions) * 2 * sys.getsizeof(2**40)
+        return size
+
+    def _add_row(self, pk, price, created_at, category_ids):
+        pos = len(self.ids)
+        self.ids.append(pk)
+        self.prices.append(float(price))
+        self.created.append(created_at.timestamp())
+        self.positions[pk] = pos
+        self.product_categories[pos] = tuple(category_ids)
+        return pos
+
+    def _append(self, pk, price, created_at, category_ids):
+        pos = self._add_row(pk, price, created_at, category_ids)
+        self._set(pos, category_ids)
+        return pos
+
+    def _set_all(self):
+        """Set the bits of every row at once; OR-ing ints one bit at a time copies them each time."""
+        alive = self._flags()
+        categories = {}
+        price_buckets = [self._flags() for _ in PRICE_BUCKETS]
+        for pos in range(len(self.ids)):
+            byte, bit = pos >> 3, 1 << (pos & 7)
+            alive[byte] |= bit
+            for category_id in self.product_categories[pos]:
+                if category_id not in categories:
+                    categories[category_id] = self._flags()
+                categories[category_id][byte] |= bit
+            price_buckets[bucket_for(self.prices[pos])][byte] |= bit
+        self.alive = int.from_bytes(alive, "little")
+        self.categories = {category_id: int.from_bytes(flags, "little") for category_id, flags in categories.items()}
+        self.price_buckets = [int.from_bytes(flags, "little") for flags in price_buckets]
+
+    def _set(self, pos, category_ids):
+        bit = 1 << pos
+        self.alive |= bit
+        for category_id in category_ids:
+            self.categories[category_id] = self.categories.get(category_id, 0) | bit
+        self.product_categories[pos] = tuple(category_ids)
+        self.price_buckets[bucket_for(self.prices[pos])] |= bit
+
+    def _clear(self, pos):
+        bit = 1 << pos
+        self.alive &= ~bit
+        for category_id in self.product_categories.pop(pos, ()):
+            self.categories[category_id] &= ~bit
+        self.price_buckets[bucket_for(self.prices[pos])] &= ~bit
+
+    # incremental maintenance
+
+    def update_product(self, pk, price, created_at, category_ids):
+        with self.lock:
+            pos = self.positions.get(pk)
+            if pos is None:
+                pos = self._append(pk, price, created_at, category_ids)
+            else:
+                self.price_column.remove(pos)
+                self.created_column.remove(pos)
+                self._clear(pos)
+                self.prices[pos] = float(price)
+                self.created[pos] = created_at.timestamp()
+                self._set(pos, category_ids)
+            self.price_column.insert(pos)
+            self.created_column.insert(pos)
+            self._price_masks.clear()
+
+    def remove_product(self, pk):
+        with self.lock:
+            pos = self.positions.pop(pk, None)
+            if pos is None:
+                return
+            self.price_column.remove(pos)
+            self.created_column.remove(pos)
+            self._clear(pos)
+            self._price_masks.clear()
+
+    # masks
+
+    def _flags(self):
+        return bytearray((len(self.ids) + 7) // 8)
+
+    def mask_for_ids(self, product_ids):
+        flags = self._flags()
+        for pk in product_ids:
+            pos = self.positions.get(pk)
+            if pos is not None:
+                flags[pos >> 3] |= 1 << (pos & 7)
+        return int.from_bytes(flags, "little")
+
+    def category_mask(self, category_ids):
+        mask = 0
+        for category_id in category_ids:
+            mask |= self.categories.get(category_id, 0)
+        return mask
+
+    def price_mask(self, min_price=None, max_price=None):
+        if min_price is None and max_price is None:
+            return self.alive
+        key = (min_price, max_price)
+        with self.lock:
+            mask = self._price_masks.get(key)
+            if mask is not None:
+                self._price_masks.move_to_end(key)
+                return mask
+
+            start, end = self.price_column.bounds(
+                None if min_price is None else float(min_price),
+                None if max_price is None else float(max_price),
+            )
+            flags = self._flags()
+            for pos in self.price_column.order[start:end]:
+                flags[pos >> 3] |= 1 << (pos & 7)
+            mask = int.from_bytes(flags, "little")
+
+            self._price_masks[key] = mask
+            if len(self._price_masks) > PRICE_MASK_CACHE_SIZE:
+                self._price_masks.popitem(last=False)
+            return mask
+
+    def filter_mask(self, product_ids=None, min_price=None, max_price=None, category_ids=None):
+        """Bitset of the products matching every given filter."""
+        with self.lock:
+            mask = self.alive & self.price_mask(min_price, max_price)
+            if product_ids is not None:
+                mask &= self.mask_for_ids(product_ids)
+            if category_ids:
+                mask &= self.category_mask(category_ids)
+            return mask
+
+    # facets
+
+    def facets(self, product_ids=None, min_price=None, max_price=None, category_ids=None):
+        """Count products per category and per price bucket for a filter state.
+
+        Each facet ignores its own filter (so the user can see what widening
+        it would give) but applies all the others.
+        """
+        with self.lock:
+            base = self.alive
+            if product_ids is not None:
+                base &= self.mask_for_ids(product_ids)
+            price = self.price_mask(min_price, max_price)
+            categories = self.category_mask(category_ids) if category_ids else self.alive
+
+            for_categories = base & price
+            for_prices = base & categories
+
+            category_counts = {
+                category_id: (bits & for_categories).bit_count()
+                for category_id, bits in self.categories.items()
+            }
+            price_counts = []
+            for i, bits in enumerate(self.price_buckets):
+                upper = PRICE_BUCKETS[i + 1] if i + 1 < len(PRICE_BUCKETS) else None
+                price_counts.append((PRICE_BUCKETS[i], upper, (bits & for_prices).bit_count()))
+
+            return {
+                "total": (for_categories & categories).bit_count(),
+                "categories": category_counts,
+                "prices": price_counts,
+            }
+
+    # sorting and paging
+
+    def page(self, mask, field, descending, limit, after_pk=None, backwards=False):
+        """Return up to ``limit`` product ids from ``mask`` in ``(field, pk)`` order.
+
+        ``field`` is ``"pk"``, ``"price"`` or ``"created_at"``. ``after_pk`` is the
+        boundary row of a keyset cursor and ``backwards`` walks from it towards
+        the start of the listing (the ids still come back nearest first). Raises
+        ``KeyError`` when the boundary product is no longer in the index.
+        """
+        columns = {"pk": None, "price": self.price_column, "created_at": self.created_column}
+        column = columns[field]
+
+        with self.lock:
+            order = range(len(self.ids)) if column is None else column.order
+            key = (lambda pos: pos) if column is None else column.key
+            start = None
+            if after_pk is not None:
+                boundary = self.positions[after_pk]
+                start = boundary if column is None else column.find(boundary)
+
+            # walk the ascending storage order forwards or backwards
+            ascending = descending == backwards
+            flags = mask.to_bytes(len(self._flags()), "little")
+
+            if mask.bit_count() * SPARSE_FACTOR < len(order):
+                # sparse result: pull the matching positions out of the bitset
+                matches = [
+                    (match.start() << 3) + bit
+                    for match in _NONZERO_BYTE.finditer(flags)
+                    for bit in range(8)
+                    if match.group()[0] >> bit & 1
+                ]
+                matches.sort(key=key)
+                if start is not None:
+                    if ascending:
+                        matches = matches[bisect_right(matches, key(boundary), key=key):]
+                    else:
+                        matches = matches[:bisect_left(matches, key(boundary), key=key)]
+                selected = matches[:limit] if ascending else matches[::-1][:limit]
+            else:
+                if ascending:
+                    steps = range(0 if start is None else start + 1, len(order))
+                else:
+                    steps = range(len(order) - 1 if start is None else start - 1, -1, -1)
+                selected = []
+                for step in steps:
+                    pos = order[step]
+                    if flags[pos >> 3] >> (pos & 7) & 1:
+                        selected.append(pos)
+                        if len(selected) == limit:
+                            break
+
+            return [self.ids[pos] for pos in selected]
+
+
+def bucket_for(price):
+    return bisect_right(PRICE_BUCKETS, price) - 1 if price >= 0 else 0
+
+
+_index = None
+_disabled_until = 0.0
+_build_lock = threading.Lock()
+
+
+def get_index():
+    """Return the index of this process, building it on first use.
+
+    An index outdated by another process or older than ``CATALOG_INDEX_TTL``
+    keeps being returned while a background thread rebuilds it. Returns None
+    while the catalog is too large to fit in ``CATALOG_INDEX_MAX_MEMORY`` bytes.
+    """
+    version = cache.get(VERSION_KEY)
+    index = _index
+    now = time.monotonic()
+    if (
+        index is not None
+        and index.version == version
+        and now - index.built_at < settings.CATALOG_INDEX_TTL
+    ):
+        return index
+    if index is not None:
+        _rebuild_in_background(index, version)
+        return index
+    if now < _disabled_until:
+        return None
+
+    with _build_lock:
+        if _index is not index:
+            return _index
+        return _build(version)
+
+
+def _build(version):
+    """Build and install the index at ``version``; the caller holds ``_build_lock``."""
+    global _index, _disabled_until
+    from .models import Product
+
+    limit = settings.CATALOG_INDEX_MAX_MEMORY
+    if Product.objects.count() * ESTIMATED_BYTES_PER_PRODUCT <= limit:
+        index = CatalogIndex.build(version)
+        if index.memory_usage() <= limit:
+            _index = index
+            return index
+    _index = None
+    _disabled_until = time.monotonic() + settings.CATALOG_INDEX_TTL
+    return None
+
+
+def _rebuild_in_background(index, version):
+    if not _build_lock.acquire(blocking=False):
+        # a rebuild is already running
+        return
+
+    def rebuild():
+        try:
+            if _index is index:
+                _build(version)
+        except Exception:
+            logger.exception("Could not rebuild the catalog index")
+        finally:
+            connections.close_all()
+            _build_lock.release()
+
+    threading.Thread(target=rebuild, name="catalog-index-rebuild", daemon=True).start()
+
+
+def _bump_version(index=None):
+    version = time.time_ns()
+    cache.set(VERSION_KEY, version, None)
+    if index is not None:
+        index.version = version
+
+
+def _apply_changes(product_ids):
+    from .models import Product
+
+    index = _index
+    if index is not None:
+        products = Product.objects.filter(pk__in=product_ids).prefetch_related("categories").in_bulk()
+        for pk in product_ids:
+            product = products.get(pk)
+            if product is None:
+                index.remove_product(pk)
+            else:
+                category_ids = [category.pk for category in product.categories.all()]
+                index.update_product(pk, product.price, product.created_at, category_ids)
+    # processes holding an index learn about the change from the version
+    _bump_version(index)
+
+
+def products_changed(products):
+    """Apply saved products to the index, if this process has one, once the transaction commits.
+
+    The products are read back after the commit, so a rolled back save never
+    reaches the index and other processes never rebuild from uncommitted rows.
+    """
+    product_ids = [product.pk for product in products]
+    transaction.on_commit(lambda: _apply_changes(product_ids))
+
+
+def product_deleted(pk):
+    transaction.on_commit(lambda: _apply_changes([pk]))
+
+
+def reset():
+    global _index, _disabled_until
+    _index = None
+    _disabled_until = 0.0
@@ -0,0 +1,65 @@
+"""Conditional GET (ETag / Last-Modified) for the catalog pages.
+
+Validators are derived from the ``"products"`` cache version, which every
+product or category change bumps, so answering a revalidation costs no
+catalog query and no template rendering. The request's filter parameters and
+the visitor (user id, role and cart summary, or the anonymous cart cookie,
+since base.html renders user-specific navigation and the cart badge) are part
+of the ETag.
+"""
+import hashlib
+from datetime import datetime, timezone
+from functools import wraps
+
+from django.contrib.messages import get_messages
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.http import condition
+
+from . import caching, carts
+
+
+def _cacheable(request):
+    # a 304 would swallow pending flash messages ("Product added to cart", ...)
+    return not len(get_messages(request))
+
+
+def catalog_etag(request, *args, **kwargs):
+    if not _cacheable(request):
+        return None
+    user = request.user
+    if user.is_authenticated:
+        # the navbar shows the cart badge
+        summary = carts.get_summary(user)
+        visitor = f"user:{user.pk}:{user.role}:{summary['item_count']}:{summary['total']}"
+    else:
+        visitor = f"anonymous:{request.COOKIES.get(carts.COOKIE_NAME, '')}"
+    params = "&".join(sorted(f"{key}={value}" for key, value in request.GET.lists()))
+    raw = f"{caching.get_version('products')}|{request.path}|{params}|{visitor}"
+    return hashlib.md5(raw.encode()).hexdigest()
+
+
+def catalog_last_modified(request, *args, **kwargs):
+    if not _cacheable(request):
+        return None
+    # versions are time.time_ns() of the last catalog change
+    return datetime.fromtimestamp(caching.get_version("products") / 1e9, tz=timezone.utc)
+
+
+def conditional_catalog_page(view):
+    """Answer repeat requests for a catalog page with 304 Not Modified."""
+    conditional_view = condition(
+        etag_func=catalog_etag, last_modified_func=catalog_last_modified
+    )(view)
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        response = conditional_view(request, *args, **kwargs)
+        # keep anonymous and per-user copies apart in shared caches
+        patch_vary_headers(response, ["Cookie"])
+        if request.user.is_authenticated:
+            patch_cache_control(response, no_cache=True, private=True)
+        else:
+            patch_cache_control(response, no_cache=True)
+        return response
+
+    return wrapper
@@ -0,0 +1,18 @@
+from django.utils.functional import SimpleLazyObject
+
+from . import carts
+
+
+def cart_summary(request):
+    """The cart item count and total for the navbar badge.
+
+    Read from the cache between cart changes for users, and from the cart
+    cookie for anonymous visitors.
+    """
+    user = getattr(request, "user", None)
+    if user is None:
+        return {}
+    if not user.is_authenticated:
+        # the cookie holds quantities only, the total would cost a query
+        return {"cart_summary": {"item_count": sum(carts.read_cookie(request).values()), "total": None}}
+    return {"cart_summary": SimpleLazyObject(lambda: carts.get_summary(user))}
@@ -41,6 +41,12 @@ class ProductFilterForm(forms.Form):
         widget=forms.Select(attrs={'class':'form-control'})
         ) 
 
+    def set_category_counts(self, counts):
+        """Show the number of matching products next to each category."""
+        self.fields["categories"].label_from_instance = (
+            lambda category: f"{category.name} ({counts.get(category.pk, 0)})"
+        )
+
 class OrderChangeForm(forms.ModelForm):
 
     delivery_person = forms.ModelChoiceField(
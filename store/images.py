@@ -0,0 +1,128 @@
+"""Resized and WebP copies of product images.
+
+For an upload ``products/honey.jpg`` the derivatives are stored next to it as
+``products/honey.220w.webp``, ``products/honey.220w.jpg``, ``products/honey.440w.webp``
+and so on. They are generated in a small background thread pool after the
+product is saved (Pillow releases the GIL while resizing and encoding) and can
+be backfilled with the ``generate_image_derivatives`` command.
+
+Once they are written the image name is recorded in ``Product.derivatives_of``,
+so rendering a picture reads a column instead of probing the storage.
+"""
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+from . import caching
+from .models import Product
+
+logger = logging.getLogger(__name__)
+
+# product cards are 220px wide, 440px covers 2x screens
+WIDTHS = (220, 440)
+
+WEBP_QUALITY = 80
+JPEG_QUALITY = 85
+
+_executor = None
+
+
+def derivative_name(name, width, extension):
+    root, _ = os.path.splitext(name)
+    return f"{root}.{width}w.{extension}"
+
+
+def fallback_extension(name):
+    """Derivatives keep PNG for PNG uploads (transparency) and use JPEG otherwise."""
+    return "png" if name.lower().endswith(".png") else "jpg"
+
+
+def derivative_names(name):
+    return [
+        derivative_name(name, width, extension)
+        for width in WIDTHS
+        for extension in ("webp", fallback_extension(name))
+    ]
+
+
+def has_derivatives(name):
+    return all(default_storage.exists(derivative) for derivative in derivative_names(name))
+
+
+def derivatives_recorded(image):
+    """Whether the derivatives of the product image ``image`` (a field file) are known to exist."""
+    return bool(image.name) and getattr(image.instance, "derivatives_of", None) == image.name
+
+
+def record_derivatives(name):
+    """Mark the products showing ``name`` as having its derivatives."""
+    if Product.objects.filter(image=name).exclude(derivatives_of=name).update(derivatives_of=name):
+        # cached pages still render the original image
+        caching.bump_version("products")
+
+
+def _encode(image, extension):
+    buffer = BytesIO()
+    if extension == "webp":
+        image.save(buffer, "WEBP", quality=WEBP_QUALITY, method=4)
+    elif extension == "png":
+        image.save(buffer, "PNG", optimize=True)
+    else:
+        image.convert("RGB").save(buffer, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return buffer.getvalue()
+
+
+def generate_derivatives(name, force=False):
+    """Write every derivative of the stored image ``name``; returns the names written.
+
+    The caller records them with :func:`record_derivatives` once this returns.
+    """
+    if not force and has_derivatives(name):
+        return []
+
+    with default_storage.open(name, "rb") as source:
+        original = ImageOps.exif_transpose(Image.open(source))
+        original.load()
+
+    written = []
+    for width in WIDTHS:
+        image = original.copy()
+        # never upscale, a small original is served as is
+        image.thumbnail((width, width * 4), Image.Resampling.LANCZOS)
+        for extension in ("webp", fallback_extension(name)):
+            target = derivative_name(name, width, extension)
+            if default_storage.exists(target):
+                default_storage.delete(target)
+            written.append(default_storage.save(target, ContentFile(_encode(image, extension))))
+    return written
+
+
+def _generate_logged(name):
+    try:
+        written = generate_derivatives(name)
+        record_derivatives(name)
+        return written
+    except Exception:
+        logger.exception("Could not generate derivatives for %s", name)
+        return []
+
+
+def executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.IMAGE_DERIVATIVE_WORKERS,
+            thread_name_prefix="image-derivatives",
+        )
+    return _executor
+
+
+def schedule(name):
+    """Generate the derivatives of ``name`` in the background."""
+    return executor().submit(_generate_logged, name)
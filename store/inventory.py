@@ -0,0 +1,112 @@
+"""Stock tracking and reservations.
+
+Stock is taken with a conditional ``UPDATE product SET stock = stock - n WHERE
+id = ? AND stock >= n``, so two checkouts racing for the last unit cannot both
+succeed: the database applies the updates one after the other and the second
+one matches no row. The units are then held by a :class:`StockReservation` on
+the order until it is paid (:func:`confirm`) or the reservation expires and the
+sweeper puts them back (:func:`release_expired`).
+
+Products with ``stock`` left empty are not tracked and never reserved.
+"""
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import rollups
+from .models import Product, Order, StockReservation
+
+
+class OutOfStock(Exception):
+    def __init__(self, product):
+        super().__init__(f"{product.name} is out of stock")
+        self.product = product
+
+
+def reserve(order, lines):
+    """Take the stock for ``(product, quantity)`` pairs and hold it for ``order``.
+
+    Must run inside the checkout transaction: raises :class:`OutOfStock` on
+    the first product short of units and the rollback returns the others.
+    """
+    wanted = Counter()
+    products = {}
+    for product, quantity in lines:
+        if product.stock is not None:
+            wanted[product.pk] += quantity
+            products[product.pk] = product
+
+    # a fixed order so concurrent checkouts take their row locks consistently
+    for pk in sorted(wanted):
+        taken = Product.objects.filter(pk=pk, stock__gte=wanted[pk]).update(
+            stock=F("stock") - wanted[pk]
+        )
+        if not taken:
+            raise OutOfStock(products[pk])
+
+    expires_at = timezone.now() + timedelta(seconds=settings.STOCK_RESERVATION_TTL)
+    return StockReservation.objects.bulk_create(
+        StockReservation(order=order, product_id=pk, quantity=quantity, expires_at=expires_at)
+        for pk, quantity in wanted.items()
+    )
+
+
+def confirm(order):
+    """The order is paid, its reserved units are sold for good."""
+    StockReservation.objects.filter(order=order).delete()
+
+
+def confirm_many(order_ids):
+    """:func:`confirm` for a batch of orders, in one query."""
+    StockReservation.objects.filter(order_id__in=order_ids).delete()
+
+
+def _release(reservations):
+    returned = Counter()
+    for reservation in reservations:
+        returned[reservation.product_id] += reservation.quantity
+    for pk in sorted(returned):
+        Product.objects.filter(pk=pk).update(stock=F("stock") + returned[pk])
+    StockReservation.objects.filter(pk__in=[reservation.pk for reservation in reservations]).delete()
+
+
+def release(order):
+    """Put the units held for ``order`` back on sale (the order is cancelled)."""
+    with transaction.atomic():
+        _release(list(StockReservation.objects.filter(order=order)))
+
+
+def release_expired(now=None, batch_size=500):
+    """Release the reservations of unpaid orders past their expiry and cancel those orders.
+
+    Works in batches of ``batch_size`` orders, one short transaction each.
+    Returns the number of orders cancelled.
+    """
+    now = now or timezone.now()
+    cancelled = 0
+    while True:
+        with transaction.atomic():
+            order_ids = list(
+                StockReservation.objects.filter(expires_at__lte=now, order__status=Order.Status.PENDING)
+                .values_list("order_id", flat=True)
+                .distinct()[:batch_size]
+            )
+            if not order_ids:
+                return cancelled
+            # only orders still pending: a payment may have settled one since the read above
+            orders = list(
+                Order.objects.select_for_update()
+                .filter(pk__in=order_ids, status=Order.Status.PENDING)
+                .only("pk", "created_at", "total")
+            )
+            order_ids = [order.pk for order in orders]
+            Order.objects.filter(pk__in=order_ids, status=Order.Status.PENDING).update(
+                status=Order.Status.CANCELLED, updated_at=timezone.now()
+            )
+            rollups.record([(order, Order.Status.PENDING, Order.Status.CANCELLED) for order in orders])
+            _release(list(StockReservation.objects.filter(order_id__in=order_ids)))
+        cancelled += len(order_ids)
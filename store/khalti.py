@@ -0,0 +1,343 @@
+"""Khalti payment gateway client.
+
+Every call goes through one ``requests.Session`` per process, so connections
+to Khalti are kept alive and reused instead of paying a TCP and TLS handshake
+per payment. On top of it:
+
+* idempotent calls (:func:`lookup`) are retried a bounded number of times
+  after a transport error or a 5xx, with full-jitter exponential backoff;
+  :func:`initiate` creates a new payment on every call, so it is only retried
+  when the connection could not even be opened;
+* a circuit breaker fails calls immediately with :class:`CircuitOpen` after
+  ``KHALTI_CIRCUIT_FAILURES`` consecutive failures, for
+  ``KHALTI_CIRCUIT_RESET_TIMEOUT`` seconds, so a gateway outage does not hold
+  a worker per request for the whole timeout; then one trial call decides
+  whether it closes again;
+* :data:`metrics` counts calls, errors, retries and latency per endpoint.
+
+:func:`ainitiate` and :func:`alookup` do the same on a pooled
+``httpx.AsyncClient`` for the async views served under ASGI.
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+import weakref
+from collections import defaultdict
+
+import httpx
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+INITIATE_PATH = "epayment/initiate/"
+LOOKUP_PATH = "epayment/lookup/"
+
+BACKOFF_BASE = 0.2
+BACKOFF_CAP = 2.0
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class KhaltiError(Exception):
+    pass
+
+
+class GatewayUnavailable(KhaltiError):
+    """Khalti could not be reached, timed out or answered with a server error."""
+
+
+class CircuitOpen(GatewayUnavailable):
+    pass
+
+
+class InvalidResponse(KhaltiError):
+    """Khalti answered, but rejected the call or sent something unusable."""
+
+    def __init__(self, message, status=None, data=None):
+        super().__init__(message)
+        self.status = status
+        self.data = data
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold, reset_timeout, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            if self.clock() - self.opened_at >= self.reset_timeout:
+                return "half-open"
+            return "open"
+
+    def before_call(self):
+        """Raise :class:`CircuitOpen` unless a call may go out now."""
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if self.clock() - self.opened_at < self.reset_timeout or self.trial_running:
+                raise CircuitOpen("Khalti is failing, not calling it for now.")
+            # half-open: let this one call through to probe the gateway
+            self.trial_running = True
+
+    def succeeded(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def cancelled(self):
+        """A call ended without an answer either way; let another one probe the gateway."""
+        with self.lock:
+            self.trial_running = False
+
+    def failed(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+            self.trial_running = False
+
+
+class Metrics:
+    """Per-process counters of the gateway calls, by endpoint."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = defaultdict(int)
+            self.errors = defaultdict(int)
+            self.retries = defaultdict(int)
+            self.short_circuits = defaultdict(int)
+            self.latency_total = defaultdict(float)
+            self.latency_max = defaultdict(float)
+            self.latency_buckets = defaultdict(lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+
+    def observe(self, endpoint, seconds, error=None):
+        with self.lock:
+            self.calls[endpoint] += 1
+            self.latency_total[endpoint] += seconds
+            self.latency_max[endpoint] = max(self.latency_max[endpoint], seconds)
+            bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), len(LATENCY_BUCKETS))
+            self.latency_buckets[endpoint][bucket] += 1
+            if error:
+                self.errors[(endpoint, error)] += 1
+
+    def count(self, counter, endpoint):
+        with self.lock:
+            getattr(self, counter)[endpoint] += 1
+
+    def snapshot(self):
+        with self.lock:
+            endpoints = {}
+            for endpoint, calls in self.calls.items():
+                endpoints[endpoint] = {
+                    "calls": calls,
+                    "retries": self.retries[endpoint],
+                    "errors": {error: n for (name, error), n in self.errors.items() if name == endpoint},
+                    "latency_avg": self.latency_total[endpoint] / calls,
+                    "latency_max": self.latency_max[endpoint],
+                    "latency_buckets": dict(
+                        zip([str(bound) for bound in LATENCY_BUCKETS] + ["inf"], self.latency_buckets[endpoint])
+                    ),
+                }
+            return {
+                "endpoints": endpoints,
+                "short_circuits": dict(self.short_circuits),
+                "circuit": breaker.state,
+                "pid": os.getpid(),
+            }
+
+
+metrics = Metrics()
+breaker = CircuitBreaker(settings.KHALTI_CIRCUIT_FAILURES, settings.KHALTI_CIRCUIT_RESET_TIMEOUT)
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.KHALTI_POOL_SIZE, max_retries=0)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+        return _session
+
+
+def _forget_session():
+    # a forked worker must open its own connections, not share the parent's sockets
+    global _session, _session_lock
+    _session, _session_lock = None, threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_session)
+
+
+def backoff(attempt):
+    """Full jitter: a random wait up to an exponentially growing cap."""
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+# transport failures of both clients, and the ones raised before anything was sent
+TRANSPORT_ERRORS = (requests.RequestException, httpx.TransportError)
+NOT_SENT_ERRORS = (requests.ConnectTimeout, httpx.ConnectTimeout, httpx.ConnectError)
+
+RETRY = object()
+
+
+def _check_circuit(path):
+    try:
+        breaker.before_call()
+    except CircuitOpen:
+        metrics.count("short_circuits", path)
+        raise
+
+
+def _transport_failed(path, exc, elapsed, idempotent, last_attempt):
+    """Account for a failed send; raises unless the call should be retried."""
+    metrics.observe(path, elapsed, type(exc).__name__)
+    breaker.failed()
+    # a request that was never sent cannot have created anything
+    if last_attempt or not (idempotent or isinstance(exc, NOT_SENT_ERRORS)):
+        raise GatewayUnavailable(str(exc)) from exc
+
+
+def _handle_response(path, response, elapsed, idempotent, last_attempt):
+    """The decoded body of ``response``, or :data:`RETRY`; raises for unusable answers."""
+    if response.status_code in RETRY_STATUSES:
+        metrics.observe(path, elapsed, f"http_{response.status_code}")
+        breaker.failed()
+        if not idempotent or last_attempt:
+            raise GatewayUnavailable(f"Khalti answered {response.status_code}")
+        return RETRY
+
+    # the gateway is up even when it rejects this particular call
+    breaker.succeeded()
+    try:
+        data = response.json()
+    except ValueError:
+        metrics.observe(path, elapsed, "invalid_json")
+        raise InvalidResponse("Khalti sent a body that is not JSON", response.status_code)
+    if response.status_code >= 400:
+        metrics.observe(path, elapsed, f"http_{response.status_code}")
+        raise InvalidResponse(f"Khalti rejected the call ({response.status_code})", response.status_code, data)
+    metrics.observe(path, elapsed)
+    return data
+
+
+def _request_options(payload):
+    return {
+        "json": payload,
+        "headers": {"Authorization": f"Key {settings.KHALTI_SECRET_KEY}"},
+    }
+
+
+def call(path, payload, idempotent):
+    """POST ``payload`` to the Khalti endpoint ``path`` and return the decoded JSON body."""
+    max_retries = settings.KHALTI_MAX_RETRIES
+    for attempt in range(max_retries + 1):
+        _check_circuit(path)
+        start = time.perf_counter()
+        try:
+            response = get_session().post(
+                settings.KHALTI_BASE_URL + path,
+                timeout=(settings.KHALTI_CONNECT_TIMEOUT, settings.KHALTI_READ_TIMEOUT),
+                **_request_options(payload),
+            )
+        except TRANSPORT_ERRORS as exc:
+            _transport_failed(path, exc, time.perf_counter() - start, idempotent, attempt == max_retries)
+        except Exception:
+            # never leave a half-open trial call unaccounted for
+            breaker.cancelled()
+            raise
+        else:
+            data = _handle_response(path, response, time.perf_counter() - start, idempotent, attempt == max_retries)
+            if data is not RETRY:
+                return data
+
+        metrics.count("retries", path)
+        time.sleep(backoff(attempt))
+
+
+# async client, for the ASGI payment views: one pooled httpx.AsyncClient per
+# event loop (uvicorn runs one per process), sharing the breaker and metrics above
+
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client():
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(settings.KHALTI_READ_TIMEOUT, connect=settings.KHALTI_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=settings.KHALTI_POOL_SIZE),
+        )
+        _async_clients[loop] = client
+    return client
+
+
+async def acall(path, payload, idempotent):
+    """:func:`call` without blocking the event loop."""
+    max_retries = settings.KHALTI_MAX_RETRIES
+    for attempt in range(max_retries + 1):
+        _check_circuit(path)
+        start = time.perf_counter()
+        try:
+            response = await get_async_client().post(settings.KHALTI_BASE_URL + path, **_request_options(payload))
+        except TRANSPORT_ERRORS as exc:
+            _transport_failed(path, exc, time.perf_counter() - start, idempotent, attempt == max_retries)
+        except BaseException:
+            # includes the request being cancelled while it waits on the gateway
+            breaker.cancelled()
+            raise
+        else:
+            data = _handle_response(path, response, time.perf_counter() - start, idempotent, attempt == max_retries)
+            if data is not RETRY:
+                return data
+
+        metrics.count("retries", path)
+        await asyncio.sleep(backoff(attempt))
+
+
+def _initiated(data):
+    if not data.get("pidx") or not data.get("payment_url"):
+        raise InvalidResponse("Khalti did not return a pidx and payment_url", data=data)
+    return data
+
+
+def initiate(payload):
+    """Start a payment; returns Khalti's answer with ``pidx`` and ``payment_url``."""
+    return _initiated(call(INITIATE_PATH, payload, idempotent=False))
+
+
+def lookup(pidx):
+    """Khalti's current view of the payment ``pidx`` (``status``, ``transaction_id``, ...)."""
+    return call(LOOKUP_PATH, {"pidx": pidx}, idempotent=True)
+
+
+async def ainitiate(payload):
+    return _initiated(await acall(INITIATE_PATH, payload, idempotent=False))
+
+
+async def alookup(pidx):
+    return await acall(LOOKUP_PATH, {"pidx": pidx}, idempotent=True)
@@ -0,0 +1,20 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from store import archive
+
+
+class Command(BaseCommand):
+    help = "Move delivered and cancelled orders past ORDER_ARCHIVE_AFTER_DAYS into the archive tables (run from cron)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--days", type=int, default=settings.ORDER_ARCHIVE_AFTER_DAYS)
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(days=options["days"])
+        count = archive.archive_orders(before=before, batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Archived {count} orders."))
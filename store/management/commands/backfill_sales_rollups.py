@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from store import rollups
+from store.models import Order, ArchivedOrder, DailyOrderStats, DailyProductSales
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the daily sales rollups from the live and archived orders, reading them in "
+        "batches. Run at deploy time or at a quiet hour: status changes during the run can be "
+        "counted twice."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            DailyOrderStats.objects.all().delete()
+            DailyProductSales.objects.all().delete()
+        count = 0
+        for orders in (Order.objects.all(), ArchivedOrder.objects.all()):
+            count += rollups.backfill(orders, batch_size=options["batch_size"])
+            self.stdout.write(f"{orders.model.__name__}: {count} orders so far")
+        self.stdout.write(self.style.SUCCESS(f"Rolled up {count} orders."))
@@ -0,0 +1,93 @@
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection, connections
+from django.db.models import Sum
+
+from accounts.models import CustomUser
+from store import carts
+from store.bench import scratch_database
+from store.models import Product, Cart, CartProduct
+
+MAX_RETRIES = 50
+
+
+def read_modify_write(cart, product_id, quantity):
+    """The previous add_to_cart: get_or_create, then quantity += in Python and save()."""
+    line, created = CartProduct.objects.get_or_create(
+        cart=cart, product_id=product_id, defaults={"quantity": quantity}
+    )
+    if not created:
+        line.quantity += quantity
+        line.save()
+
+
+class Command(BaseCommand):
+    help = "Hammer a few carts with concurrent adds and compare lost updates and throughput."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--carts", type=int, default=4)
+        parser.add_argument("--products", type=int, default=4)
+        parser.add_argument("--adds", type=int, default=2000, help="adds in total")
+        parser.add_argument("--workers", type=int, default=16)
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as directory, scratch_database(
+            os.path.join(directory, "cart-writes.sqlite3")
+        ):
+            users = CustomUser.objects.bulk_create(
+                CustomUser(email=f"tab{i}@example.com") for i in range(options["carts"])
+            )
+            cart_list = Cart.objects.bulk_create(Cart(user=user) for user in users)
+            products = Product.objects.bulk_create(
+                Product(name=f"Product {i}", price=10) for i in range(options["products"])
+            )
+            work = [
+                (cart_list[i % len(cart_list)], products[i // len(cart_list) % len(products)].pk)
+                for i in range(options["adds"])
+            ]
+            connection.close()
+
+            for label, add in (
+                ("read-modify-write", read_modify_write),
+                ("upsert", carts.add_product),
+            ):
+                CartProduct.objects.all().delete()
+                connection.close()
+                elapsed, retries = self.run(add, work, options["workers"])
+                quantity = CartProduct.objects.aggregate(total=Sum("quantity"))["total"] or 0
+                lines = CartProduct.objects.count()
+                self.stdout.write(
+                    f"{label:18} {len(work) / elapsed:8.0f} adds/s  {retries:5} lock retries  "
+                    f"lines {lines}  quantity {quantity}/{len(work)}  lost updates {len(work) - quantity}"
+                )
+
+    def run(self, add, work, workers):
+        retries = 0
+
+        def one(item):
+            nonlocal retries
+            cart, product_id = item
+            for attempt in range(MAX_RETRIES):
+                try:
+                    add(cart, product_id, 1)
+                    return
+                except OperationalError:
+                    retries += 1
+                    time.sleep(0.001 * (attempt + 1))
+
+        def chunk(items):
+            try:
+                for item in items:
+                    one(item)
+            finally:
+                connections.close_all()
+
+        chunks = [work[i::workers] for i in range(workers)]
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(chunk, chunks))
+        return time.perf_counter() - start, retries
@@ -0,0 +1,92 @@
+import time
+from contextlib import contextmanager
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from accounts.models import CustomUser
+from store import checkout
+from store.bench import scratch_database, percentile
+from store.models import Product, Cart, CartProduct, Order, OrderItem
+from store.utils import generate_order_id
+
+WRITE_STATEMENTS = ("INSERT", "UPDATE", "DELETE")
+
+
+def row_by_row_checkout(user, cart):
+    """The previous place_order: one query per cart line for the product, the item and the delete."""
+    lines = CartProduct.objects.filter(cart=cart)
+    subtotal = sum(line.product.price * line.quantity for line in lines)
+    with transaction.atomic():
+        order = Order.objects.create(
+            user=user, order_id=generate_order_id(), subtotal=subtotal, total=subtotal
+        )
+        for line in lines:
+            OrderItem.objects.create(
+                order=order, product=line.product, product_name=line.product.name,
+                price=line.product.price, quantity=line.quantity,
+            )
+        for line in lines:
+            line.delete()
+    return order
+
+
+class Command(BaseCommand):
+    help = "Measure checkout latency, query count and write-lock hold time against cart size."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", nargs="+", type=int, default=[1, 10, 40, 100])
+        parser.add_argument("--repeat", type=int, default=20)
+
+    def handle(self, *args, **options):
+        with scratch_database():
+            user = CustomUser.objects.create_user("bench@example.com", "bench-pass")
+            cart = Cart.objects.create(user=user)
+            products = Product.objects.bulk_create(
+                Product(name=f"Bench product {i}", description="", price=10 + i)
+                for i in range(max(options["sizes"]))
+            )
+            self.stdout.write(
+                f"{'lines':>5} {'pipeline':12} {'queries':>7} {'p50 ms':>8} {'p95 ms':>8} {'lock p50 ms':>12}"
+            )
+            for size in options["sizes"]:
+                for label, place_order in (("row-by-row", row_by_row_checkout), ("batched", checkout.place_order)):
+                    queries, latencies, locks = [], [], []
+                    for _ in range(options["repeat"]):
+                        CartProduct.objects.bulk_create(
+                            CartProduct(cart=cart, product=product, quantity=2) for product in products[:size]
+                        )
+                        with self.measure() as result:
+                            place_order(user, cart)
+                        queries.append(result["queries"])
+                        latencies.append(result["elapsed"])
+                        locks.append(result["lock"])
+                    self.stdout.write(
+                        f"{size:5} {label:12} {max(queries):7} {percentile(latencies, 50):8.2f} "
+                        f"{percentile(latencies, 95):8.2f} {percentile(locks, 50):12.2f}"
+                    )
+
+    @contextmanager
+    def measure(self):
+        """Time the block, and from its first write statement to its end (the commit).
+
+        SQLite takes the database write lock at the first write of a transaction
+        and keeps it until the commit.
+        """
+        result = {"queries": 0, "lock": 0.0}
+        first_write = None
+
+        def wrapper(execute, sql, params, many, context):
+            nonlocal first_write
+            result["queries"] += 1
+            if first_write is None and sql.lstrip().upper().startswith(WRITE_STATEMENTS):
+                first_write = time.perf_counter()
+            return execute(sql, params, many, context)
+
+        start = time.perf_counter()
+        with connection.execute_wrapper(wrapper):
+            yield result
+        end = time.perf_counter()
+        result["elapsed"] = (end - start) * 1000
+        if first_write is not None:
+            result["lock"] = (end - first_write) * 1000
@@ -0,0 +1,109 @@
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from django.urls import reverse
+
+from accounts.models import CustomUser
+from store.bench import login_cookies, scratch_database, serve_site, stand_in_gateway, percentile
+from store.models import Product, Order
+
+
+class Command(BaseCommand):
+    help = (
+        "Load the catalog while payment requests wait on a slow Khalti stand-in, under WSGI "
+        "(a fixed pool of sync workers) and under ASGI (uvicorn, async payment views), and "
+        "report catalog latency."
+    )
+    # the url modules are imported per mode, not by the checks up front
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--delay", type=float, default=2.0, help="seconds the gateway takes to answer")
+        parser.add_argument("--workers", type=int, default=4, help="sync workers in WSGI mode")
+        parser.add_argument("--payment-clients", type=int, default=8)
+        parser.add_argument("--catalog-clients", type=int, default=2)
+        parser.add_argument("--duration", type=float, default=6.0, help="seconds per phase")
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as directory, scratch_database(
+            os.path.join(directory, "gateway.sqlite3")
+        ), stand_in_gateway(options["delay"]) as gateway, override_settings(KHALTI_BASE_URL=gateway.url):
+            cookies = self.setup_data(options["payment_clients"])
+            for mode in ("wsgi", "asgi"):
+                with serve_site(mode, options["workers"], KHALTI_SECRET_KEY="bench-key") as base_url:
+                    self.stdout.write(f"{mode}: serving on {base_url}")
+                    baseline = self.run_phase(base_url, [], options)
+                    loaded = self.run_phase(base_url, cookies, options)
+                self.report(mode, baseline, loaded)
+
+    def setup_data(self, buyers):
+        Product.objects.bulk_create(Product(name=f"Product {i}", price=100 + i) for i in range(48))
+        cookies = []
+        for i in range(buyers):
+            user = CustomUser.objects.create_user(f"payer{i}@example.com", "secret-pass")
+            order = Order.objects.create(user=user, order_id=f"ORD-BENCH-{i}", subtotal=500, total=500)
+            cookies.append((order.order_id, login_cookies(user)))
+        return cookies
+
+    def run_phase(self, base_url, payers, options):
+        stop = threading.Event()
+        catalog_latencies = []
+        payments = []
+        errors = []
+
+        catalog_url = base_url + reverse("store:products_page")
+
+        def catalog_client(_):
+            session = requests.Session()
+            while not stop.is_set():
+                start = time.perf_counter()
+                try:
+                    session.get(catalog_url, timeout=30).raise_for_status()
+                except requests.RequestException as exc:
+                    errors.append(exc)
+                    continue
+                catalog_latencies.append(time.perf_counter() - start)
+
+        def payment_client(payer):
+            order_id, cookies = payer
+            payment_url = base_url + reverse("store:khalti_payment", args=[order_id])
+            session = requests.Session()
+            session.cookies.update(cookies)
+            while not stop.is_set():
+                start = time.perf_counter()
+                try:
+                    response = session.get(payment_url, allow_redirects=False, timeout=30)
+                except requests.RequestException as exc:
+                    errors.append(exc)
+                    continue
+                if response.status_code == 302 and "/pay/" in response.headers.get("Location", ""):
+                    payments.append(time.perf_counter() - start)
+                else:
+                    errors.append(response.status_code)
+
+        with ThreadPoolExecutor(max_workers=len(payers) + options["catalog_clients"]) as pool:
+            futures = [pool.submit(payment_client, payer) for payer in payers]
+            # let the payment requests occupy the server before measuring the catalog
+            time.sleep(0.5 if payers else 0)
+            futures += [pool.submit(catalog_client, i) for i in range(options["catalog_clients"])]
+            time.sleep(options["duration"])
+            stop.set()
+            for future in futures:
+                future.result()
+        return {"catalog": catalog_latencies, "payments": payments, "errors": errors, "duration": options["duration"]}
+
+    def report(self, mode, baseline, loaded):
+        for label, phase in (("catalog only", baseline), ("payments waiting on gateway", loaded)):
+            samples = phase["catalog"]
+            self.stdout.write(
+                f"{mode} {label:28} catalog {len(samples) / phase['duration']:6.1f} req/s  "
+                f"p50 {percentile(samples, 50) * 1000:7.1f} ms  p95 {percentile(samples, 95) * 1000:7.1f} ms  "
+                f"p99 {percentile(samples, 99) * 1000:7.1f} ms  payments {len(phase['payments'])}  "
+                f"errors {len(phase['errors'])}"
+            )
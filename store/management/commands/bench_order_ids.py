@@ -0,0 +1,43 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+
+from store.utils import generate_order_id
+
+
+def generate_batch(count):
+    start = time.perf_counter()
+    ids = [generate_order_id() for _ in range(count)]
+    return ids, ids == sorted(ids), time.perf_counter() - start
+
+
+class Command(BaseCommand):
+    help = "Generate order ids in parallel worker processes and check they never collide."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=8)
+        parser.add_argument("--count", type=int, default=200_000, help="ids per process")
+
+    def handle(self, *args, **options):
+        processes, count = options["processes"], options["count"]
+        # fork like gunicorn --preload does, so the node id reseeding is exercised
+        context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(max_workers=processes, mp_context=context) as pool:
+            start = time.perf_counter()
+            results = list(pool.map(generate_batch, [count] * processes))
+            elapsed = time.perf_counter() - start
+
+        total = processes * count
+        unique = len({order_id for ids, _, _ in results for order_id in ids})
+        monotonic = all(increasing for _, increasing, _ in results)
+        slowest = max(seconds for _, _, seconds in results)
+        self.stdout.write(
+            f"{total} ids from {processes} processes in {elapsed:.2f}s including result transfer "
+            f"({total / elapsed:,.0f} ids/s overall, {count / slowest:,.0f} ids/s in the slowest process)"
+        )
+        self.stdout.write(f"unique: {unique}/{total}, increasing within each process: {monotonic}")
+        if unique != total or not monotonic:
+            raise CommandError("Order ids collided or went backwards.")
+        self.stdout.write(self.style.SUCCESS("No collisions."))
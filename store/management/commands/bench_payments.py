@@ -0,0 +1,163 @@
+import os
+import re
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.urls import reverse
+
+from accounts.models import CustomUser
+from store import khalti
+from store.bench import login_cookies, percentile, scratch_database, serve_site, stand_in_gateway
+from store.models import Order, Product
+
+STEPS = ("place_order", "order_page", "khalti_payment", "gateway_page", "callback")
+PAY_LINK = re.compile(r'href="([^"]+/payment/khalti)"')
+
+
+class Command(BaseCommand):
+    help = (
+        "End-to-end payment load test: concurrent customers place an order, start its Khalti "
+        "payment, pay on a Khalti stand-in and come back through the callback. Reports "
+        "p50/p95/p99 latency and the failure rate of every step."
+    )
+    # the url modules are imported per mode, not by the checks up front
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--mode", choices=["wsgi", "asgi"], default="asgi")
+        parser.add_argument("--workers", type=int, default=4, help="sync workers in WSGI mode")
+        parser.add_argument("--concurrency", type=int, default=8, help="customers paying at once")
+        parser.add_argument("--orders", type=int, default=20, help="orders each customer places and pays")
+        parser.add_argument("--clicks", type=int, default=1, help="times each customer clicks Pay per order")
+        parser.add_argument(
+            "--gateway", help="base URL of a running khalti_stand_in; by default one is started in-process",
+        )
+        parser.add_argument("--delay", type=float, default=0.2, help="seconds the in-process stand-in takes to answer")
+        parser.add_argument("--error-rate", type=float, default=0.0, help="share of stand-in calls answered 503")
+        parser.add_argument("--timeout-rate", type=float, default=0.0, help="share of stand-in calls left hanging")
+        parser.add_argument("--read-timeout", type=float, default=settings.KHALTI_READ_TIMEOUT)
+
+    def handle(self, *args, **options):
+        if options["gateway"]:
+            gateway = nullcontext(None)
+        else:
+            gateway = stand_in_gateway(
+                options["delay"], error_rate=options["error_rate"], timeout_rate=options["timeout_rate"],
+                hang=options["read_timeout"] + 5,
+            )
+        with tempfile.TemporaryDirectory() as directory, scratch_database(
+            os.path.join(directory, "payments.sqlite3")
+        ), gateway as stand_in:
+            gateway_url = options["gateway"] or stand_in.url
+            customers = self.setup_data(options["concurrency"])
+            khalti.metrics.reset()
+            with serve_site(
+                options["mode"], options["workers"],
+                KHALTI_BASE_URL=gateway_url, KHALTI_SECRET_KEY="bench-key", KHALTI_READ_TIMEOUT=options["read_timeout"],
+            ) as base_url:
+                self.stdout.write(f"{options['mode']}: serving on {base_url}, gateway {gateway_url}")
+                start = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=len(customers)) as pool:
+                    results = list(pool.map(lambda customer: self.customer(base_url, customer, options), customers))
+                elapsed = time.perf_counter() - start
+            self.report(results, elapsed, options)
+
+    def setup_data(self, customers):
+        product = Product.objects.create(name="Bench Honey", price=250, stock=10 ** 6)
+        return [
+            (product.pk, login_cookies(CustomUser.objects.create_user(f"customer{i}@example.com", "secret-pass")))
+            for i in range(customers)
+        ]
+
+    def customer(self, base_url, customer, options):
+        """Place and pay ``--orders`` orders one after the other; returns latencies and failures per step."""
+        product_id, cookies = customer
+        latencies = defaultdict(list)
+        attempts = defaultdict(int)
+        failures = defaultdict(int)
+        completed = 0
+        session = requests.Session()
+        session.cookies.update(cookies)
+
+        def get(step, url, expected):
+            """GET ``url`` without following redirects; the response if ``expected(response)``, else None."""
+            attempts[step] += 1
+            start = time.perf_counter()
+            try:
+                response = session.get(url, allow_redirects=False, timeout=options["read_timeout"] + 30)
+            except requests.RequestException:
+                failures[step] += 1
+                return None
+            latencies[step].append(time.perf_counter() - start)
+            if not expected(response):
+                failures[step] += 1
+                return None
+            return response
+
+        def redirects_to(prefix):
+            return lambda response: response.status_code == 302 and response.headers["Location"].startswith(prefix)
+
+        order_page = reverse("store:order_page")
+        callback = base_url + reverse("store:khalti_payment_response")
+        for _ in range(options["orders"]):
+            # filling the cart is not part of the payment flow
+            session.get(base_url + reverse("store:add_to_cart", args=[product_id]), allow_redirects=False, timeout=30)
+
+            if not get("place_order", base_url + reverse("store:place_order"), redirects_to(order_page)):
+                continue
+            response = get("order_page", base_url + order_page, lambda response: PAY_LINK.search(response.text))
+            if not response:
+                continue
+            # orders are listed newest first
+            pay_url = base_url + PAY_LINK.search(response.text).group(1)
+            for _ in range(options["clicks"]):
+                response = get("khalti_payment", pay_url, lambda response: "/pay/" in response.headers.get("Location", ""))
+            if not response:
+                continue
+            response = get("gateway_page", response.headers["Location"], redirects_to(callback))
+            if not response:
+                continue
+            if get("callback", response.headers["Location"], redirects_to(order_page)):
+                completed += 1
+        return latencies, attempts, failures, completed
+
+    def report(self, results, elapsed, options):
+        latencies = defaultdict(list)
+        attempts = defaultdict(int)
+        failures = defaultdict(int)
+        completed = 0
+        for customer_latencies, customer_attempts, customer_failures, customer_completed in results:
+            for step in STEPS:
+                latencies[step] += customer_latencies[step]
+                attempts[step] += customer_attempts[step]
+                failures[step] += customer_failures[step]
+            completed += customer_completed
+        wanted = options["concurrency"] * options["orders"]
+
+        self.stdout.write(f"{'step':16}{'requests':>9}{'failed':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for step in STEPS:
+            samples = latencies[step]
+            failed = failures[step] / attempts[step] * 100 if attempts[step] else 0.0
+            self.stdout.write(
+                f"{step:16}{attempts[step]:9}{failed:8.1f}%"
+                + "".join(f"{percentile(samples, pct) * 1000:10.1f}" for pct in (50, 95, 99))
+            )
+        paid = Order.objects.filter(status=Order.Status.PAID).count()
+        self.stdout.write(
+            f"{completed}/{wanted} payments completed in {elapsed:.1f}s ({completed / elapsed:.1f}/s), "
+            f"{paid} orders paid, {wanted - completed} flows failed ({(wanted - completed) / wanted * 100:.1f}%)"
+        )
+        gateway_calls = khalti.metrics.snapshot()["endpoints"]
+        self.stdout.write(
+            "gateway calls: "
+            + ", ".join(f"{path} {gateway_calls.get(path, {}).get('calls', 0)}" for path in (khalti.INITIATE_PATH, khalti.LOOKUP_PATH))
+        )
+        short_circuits = sum(khalti.metrics.snapshot()["short_circuits"].values())
+        if short_circuits:
+            self.stdout.write(f"{short_circuits} gateway calls failed fast on the open circuit")
@@ -0,0 +1,71 @@
+import random
+
+from django.core.management.base import BaseCommand
+
+from store import search
+from store.bench import scratch_database, timed
+from store.models import Product
+
+WORDS = [
+    "organic", "apple", "banana", "honey", "green", "tea", "rice", "basmati",
+    "almond", "butter", "coconut", "oil", "mustard", "lentil", "turmeric",
+    "ginger", "garlic", "spinach", "tomato", "mango", "pickle", "jam", "oats",
+    "millet", "buckwheat", "cashew", "walnut", "raisin", "cinnamon", "pepper",
+]
+
+QUERIES = ["honey", "org", "green tea", "basmati ri", "walnut butter"]
+
+SYLLABLES = ["ka", "ri", "mo", "ta", "lu", "ne", "so", "vi", "pa", "de", "go", "chu"]
+
+
+class Command(BaseCommand):
+    help = "Compare FTS5 product search against the old name__icontains scan."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", nargs="+", type=int, default=[100_000, 1_000_000])
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        for size in options["sizes"]:
+            with scratch_database():
+                self.populate(size)
+                self.stdout.write(f"\n{size} products")
+                for query in QUERIES:
+                    # what the listing does per request: a count plus the first page
+                    icontains, _ = timed(
+                        lambda: self.first_page(Product.objects.filter(name__icontains=query).order_by("pk")),
+                        options["repeat"],
+                    )
+                    fts, _ = timed(
+                        lambda: self.first_page(
+                            search.search_queryset(Product.objects.all(), query)
+                            .order_by("search_rank", "pk")
+                        ),
+                        options["repeat"],
+                    )
+                    self.stdout.write(
+                        f"  {query!r:18} icontains {icontains:9.2f} ms   fts5 {fts:9.2f} ms"
+                    )
+
+    def first_page(self, queryset):
+        queryset.count()
+        list(queryset[:16])
+
+    def populate(self, size, chunk_size=10_000):
+        rng = random.Random(size)
+        # a realistic catalog has a long tail of rare words
+        words = WORDS + [
+            "".join(rng.choices(SYLLABLES, k=rng.randint(2, 4))) for _ in range(5000)
+        ]
+        for start in range(0, size, chunk_size):
+            Product.objects.bulk_create(
+                Product(
+                    name=" ".join(rng.sample(words, 3)),
+                    description=" ".join(rng.sample(words, 12)),
+                    price=rng.randint(10, 5000),
+                    image="products/placeholder.jpg",
+                )
+                for _ in range(start, min(size, start + chunk_size))
+            )
+        # bulk_create skips the signal handlers, index everything in one pass
+        search.rebuild_index()
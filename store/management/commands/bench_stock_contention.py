@@ -0,0 +1,92 @@
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections
+from django.db.models import Sum
+
+from accounts.models import CustomUser
+from store import checkout, inventory
+from store.bench import scratch_database
+from store.models import Product, Cart, CartProduct, Order, StockReservation
+
+MAX_RETRIES = 50
+
+
+def attempt_checkout(user_id):
+    """One buyer checking out, retried while SQLite reports the database as locked."""
+    user = CustomUser.objects.get(pk=user_id)
+    for retry in range(MAX_RETRIES):
+        try:
+            checkout.place_order(user, user.cart)
+            return "sold", retry
+        except inventory.OutOfStock:
+            return "sold out", retry
+        except OperationalError:
+            time.sleep(0.001 * (retry + 1))
+    return "gave up", MAX_RETRIES
+
+
+def close_connections():
+    # forked workers must not share the parent's sqlite handle
+    connections.close_all()
+
+
+class Command(BaseCommand):
+    help = "Hammer one flash-sale product with concurrent checkouts and check nothing is oversold."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--stock", type=int, default=100)
+        parser.add_argument("--buyers", type=int, default=500)
+        parser.add_argument("--workers", type=int, default=16)
+        parser.add_argument("--processes", action="store_true", help="use worker processes instead of threads")
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as directory, scratch_database(
+            os.path.join(directory, "contention.sqlite3")
+        ):
+            product = Product.objects.create(name="Flash Sale Honey", price=450, stock=options["stock"])
+            users = CustomUser.objects.bulk_create(
+                CustomUser(email=f"buyer{i}@example.com") for i in range(options["buyers"])
+            )
+            carts = Cart.objects.bulk_create(Cart(user=user) for user in users)
+            CartProduct.objects.bulk_create(CartProduct(cart=cart, product=product, quantity=1) for cart in carts)
+            connection.close()
+
+            if options["processes"]:
+                pool = ProcessPoolExecutor(
+                    max_workers=options["workers"],
+                    mp_context=multiprocessing.get_context("fork"),
+                    initializer=close_connections,
+                )
+            else:
+                pool = ThreadPoolExecutor(max_workers=options["workers"])
+
+            start = time.perf_counter()
+            with pool:
+                results = list(pool.map(attempt_checkout, [user.pk for user in users]))
+            elapsed = time.perf_counter() - start
+
+            self.report(product, options["stock"], results, elapsed)
+
+    def report(self, product, stock, results, elapsed):
+        outcomes = {outcome: sum(1 for result, _ in results if result == outcome) for outcome in ("sold", "sold out", "gave up")}
+        retries = sum(retry for _, retry in results)
+        product.refresh_from_db()
+        reserved = StockReservation.objects.aggregate(total=Sum("quantity"))["total"] or 0
+        orders = Order.objects.count()
+
+        self.stdout.write(
+            f"{len(results)} checkouts in {elapsed:.2f}s ({len(results) / elapsed:.0f}/s, "
+            f"{outcomes['sold'] / elapsed:.0f} successful/s), {retries} lock retries"
+        )
+        self.stdout.write(
+            f"sold {outcomes['sold']}, sold out {outcomes['sold out']}, gave up {outcomes['gave up']}; "
+            f"stock left {product.stock}, reserved {reserved}, orders {orders}"
+        )
+        if reserved + product.stock != stock or orders != outcomes["sold"] or reserved > stock:
+            raise CommandError("Stock accounting is inconsistent: oversold or lost units.")
+        self.stdout.write(self.style.SUCCESS("No overselling."))
@@ -0,0 +1,90 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from store import caching
+from store.bench import scratch_database, percentile
+from store.models import Product
+
+# the benchmark must not touch (or clear) the site's real cache
+BENCH_CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "bench-view-cache",
+    }
+}
+
+
+class Command(BaseCommand):
+    help = "Simulate a traffic spike on a hot product page and count database queries."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=32)
+        parser.add_argument("--requests", type=int, default=20, help="requests per client")
+        parser.add_argument(
+            "--invalidate-every", type=int, default=50,
+            help="bump the products cache version after this many requests (a product edit)",
+        )
+
+    def handle(self, *args, **options):
+        with scratch_database(), override_settings(CACHES=BENCH_CACHES, ALLOWED_HOSTS=["testserver"]):
+            product = Product.objects.create(name="Viral Honey", description="raw forest honey", price=450)
+            url = reverse("store:product_detail_page", args=[product.pk])
+            for single_flight in (False, True):
+                with override_settings(VIEW_CACHE_SINGLE_FLIGHT=single_flight):
+                    cache.clear()
+                    self.report("single-flight" if single_flight else "cache-aside", self.spike(url, options))
+
+    def spike(self, url, options):
+        queries = 0
+        served = 0
+        latencies = []
+        lock = threading.Lock()
+        start_gate = threading.Barrier(options["clients"])
+
+        def count_queries(execute, sql, params, many, context):
+            nonlocal queries
+            with lock:
+                queries += 1
+            return execute(sql, params, many, context)
+
+        def client_loop(_):
+            nonlocal served
+            client = Client()
+            start_gate.wait()
+            with connection.execute_wrapper(count_queries):
+                for _ in range(options["requests"]):
+                    began = time.perf_counter()
+                    client.get(url)
+                    with lock:
+                        latencies.append((time.perf_counter() - began) * 1000)
+                        served += 1
+                        invalidate = served % options["invalidate_every"] == 0
+                    if invalidate:
+                        caching.bump_version("products")
+            connection.close()
+
+        began = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options["clients"]) as pool:
+            list(pool.map(client_loop, range(options["clients"])))
+        elapsed = time.perf_counter() - began
+        return {
+            "requests": served,
+            "queries": queries,
+            "elapsed": elapsed,
+            "p50": percentile(latencies, 50),
+            "p99": percentile(latencies, 99),
+        }
+
+    def report(self, label, result):
+        self.stdout.write(
+            f"{label:14} {result['requests']} requests  {result['queries']:6} queries  "
+            f"{result['queries'] / result['elapsed']:8.1f} queries/s  "
+            f"p50 {result['p50']:7.2f} ms  p99 {result['p99']:7.2f} ms"
+        )
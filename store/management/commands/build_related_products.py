@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from store import recommendations
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the related products shown on product detail pages from order "
+        "history. Meant to run periodically (e.g. nightly from cron)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--top", type=int, default=recommendations.TOP_N)
+
+    def handle(self, *args, **options):
+        count = recommendations.build_related_products(top_n=options["top"])
+        self.stdout.write(self.style.SUCCESS(f"Wrote {count} related product rows."))
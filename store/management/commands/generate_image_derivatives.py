@@ -0,0 +1,53 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand
+
+from store import images
+from store.models import Product
+
+
+class Command(BaseCommand):
+    help = "Generate thumbnails and WebP copies for existing product images."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+        parser.add_argument(
+            "--force", action="store_true", help="Regenerate derivatives that already exist."
+        )
+
+    def handle(self, *args, **options):
+        names = (
+            Product.objects.exclude(image="")
+            .order_by()
+            .values_list("image", flat=True)
+            .distinct()
+        )
+        generated = skipped = failed = 0
+
+        # Pillow releases the GIL while decoding, resizing and encoding
+        with ThreadPoolExecutor(max_workers=options["workers"]) as pool:
+            futures = {
+                pool.submit(images.generate_derivatives, name, options["force"]): name
+                for name in names.iterator()
+            }
+            for future in as_completed(futures):
+                try:
+                    written = future.result()
+                except Exception as exc:
+                    failed += 1
+                    self.stderr.write(f"{futures[future]}: {exc}")
+                    continue
+                # also records images generated before derivatives_of existed
+                images.record_derivatives(futures[future])
+                if written:
+                    generated += 1
+                else:
+                    skipped += 1
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Generated derivatives for {generated} images, "
+                f"{skipped} already done, {failed} failed."
+            )
+        )
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+
+from store.bench import StandInGateway
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a local Khalti stand-in (initiate, lookup and the payment page) for load tests. "
+        "Point the site at it with KHALTI_BASE_URL."
+    )
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8001)
+        parser.add_argument("--delay", type=float, default=0.0, help="seconds every answer takes")
+        parser.add_argument("--error-rate", type=float, default=0.0, help="share of calls answered 503")
+        parser.add_argument("--timeout-rate", type=float, default=0.0, help="share of calls left hanging")
+        parser.add_argument("--hang", type=float, default=60.0, help="seconds a hanging call waits before answering")
+
+    def handle(self, *args, **options):
+        server = StandInGateway(
+            options["delay"],
+            error_rate=options["error_rate"],
+            timeout_rate=options["timeout_rate"],
+            hang=options["hang"],
+            host=options["host"],
+            port=options["port"],
+        )
+        self.stdout.write(f"Khalti stand-in on {server.url}, run the site with KHALTI_BASE_URL={server.url}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
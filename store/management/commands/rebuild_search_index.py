@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from store import search
+
+
+class Command(BaseCommand):
+    help = "Rebuild the full-text product search index."
+
+    def handle(self, *args, **options):
+        if not search.fts_available():
+            self.stderr.write("The FTS5 search index is not available on this database.")
+            return
+        count = search.rebuild_index()
+        self.stdout.write(self.style.SUCCESS(f"Indexed {count} products."))
@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from store import reconciliation
+
+
+class Command(BaseCommand):
+    help = "Settle open Khalti payments the callback never confirmed, from the lookup API (run from cron)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument("--concurrency", type=int, default=settings.PAYMENT_RECONCILE_CONCURRENCY)
+        parser.add_argument(
+            "--min-age", type=int, default=settings.PAYMENT_RECONCILE_MIN_AGE,
+            help="seconds a payment is left to its callback before it is looked up",
+        )
+
+    def handle(self, *args, **options):
+        run = reconciliation.reconcile(
+            min_age=options["min_age"], batch_size=options["batch_size"], concurrency=options["concurrency"],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Looked up {run.looked_up} payments in {run.seconds:.2f}s ({run.rate:.1f}/s)."
+        ))
+        for label, counts in (("outcomes", run.outcomes), ("lookup errors", run.errors)):
+            counts = +counts
+            if counts:
+                self.stdout.write(f"{label}: " + ", ".join(f"{name} {n}" for name, n in sorted(counts.items())))
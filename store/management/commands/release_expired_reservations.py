@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from store import inventory
+
+
+class Command(BaseCommand):
+    help = "Put the stock of unpaid orders with expired reservations back on sale (run from cron)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        count = inventory.release_expired(batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Cancelled {count} unpaid orders."))
@@ -0,0 +1,39 @@
+from django.db import migrations
+
+
+class SQLiteRunSQL(migrations.RunSQL):
+    """RunSQL that only runs on SQLite, other databases search without the FTS5 index."""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == "sqlite":
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == "sqlite":
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0019_alter_order_status_delete_shippingaddress'),
+    ]
+
+    operations = [
+        SQLiteRunSQL(
+            [
+                "CREATE VIRTUAL TABLE IF NOT EXISTS store_product_fts USING fts5("
+                "name, description, categories, "
+                "tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+                # default ranking function, weights are name, description, categories
+                "INSERT INTO store_product_fts (store_product_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0, 4.0)')",
+                "INSERT INTO store_product_fts (rowid, name, description, categories) "
+                "SELECT p.id, p.name, COALESCE(p.description, ''), COALESCE(("
+                "SELECT group_concat(c.name, ' ') FROM store_category c "
+                "JOIN store_product_categories pc ON pc.category_id = c.id "
+                "WHERE pc.product_id = p.id), '') "
+                "FROM store_product p",
+            ],
+            "DROP TABLE IF EXISTS store_product_fts",
+        ),
+    ]
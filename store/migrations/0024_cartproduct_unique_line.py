@@ -0,0 +1,38 @@
+# Generated by Django 6.0 on 2026-10-18 15:20
+
+from django.db import migrations, models
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicate_lines(apps, schema_editor):
+    # concurrent adds could create several lines for one product, fold them into the oldest
+    CartProduct = apps.get_model("store", "CartProduct")
+    duplicates = (
+        CartProduct.objects.values("cart_id", "product_id")
+        .annotate(lines=Count("id"), quantity=Sum("quantity"), keep=Min("id"))
+        .filter(lines__gt=1)
+    )
+    for row in duplicates:
+        CartProduct.objects.filter(pk=row["keep"]).update(quantity=row["quantity"])
+        CartProduct.objects.filter(cart_id=row["cart_id"], product_id=row["product_id"]).exclude(
+            pk=row["keep"]
+        ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0023_product_stock_reservation'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_lines, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='cartproduct',
+            name='cartproduct_cart_product_idx',
+        ),
+        migrations.AddConstraint(
+            model_name='cartproduct',
+            constraint=models.UniqueConstraint(fields=('cart', 'product'), name='cartproduct_cart_product_uniq'),
+        ),
+    ]
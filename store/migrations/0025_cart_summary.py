@@ -0,0 +1,32 @@
+# Generated by Django 6.0 on 2026-10-18 16:05
+
+from django.db import migrations, models
+
+from store import carts
+
+
+def fill_cart_summaries(apps, schema_editor):
+    Cart = apps.get_model("store", "Cart")
+    CartProduct = apps.get_model("store", "CartProduct")
+    Cart.objects.update(**carts.summary_expressions(CartProduct))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0024_cartproduct_unique_line'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='cart',
+            name='total',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=12),
+        ),
+        migrations.RunPython(fill_cart_summaries, migrations.RunPython.noop),
+    ]
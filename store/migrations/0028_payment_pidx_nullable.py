@@ -0,0 +1,30 @@
+# Generated by Django 6.0 on 2026-10-18 17:10
+
+from django.db import migrations, models
+
+
+def blank_pidx_to_null(apps, schema_editor):
+    # a payment whose initiate call never succeeded kept pidx "", blocking every later one
+    for name in ("Payment", "ArchivedPayment"):
+        apps.get_model("store", name).objects.filter(pidx="").update(pidx=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0027_sales_rollups'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='archivedpayment',
+            name='pidx',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='pidx',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+        migrations.RunPython(blank_pidx_to_null, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-18 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0030_payment_url'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='derivatives_of',
+            field=models.CharField(blank=True, editable=False, max_length=100),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-18 11:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0031_product_derivatives_of'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='locked_until',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -14,14 +14,32 @@ class Product(models.Model):
     name = models.CharField(max_length=100)
     price = models.DecimalField(max_digits=10, decimal_places=2, default=0.0)
     image = models.ImageField(upload_to="products/")
+    # the image whose resized copies have been written, see store.images
+    derivatives_of = models.CharField(max_length=100, blank=True, editable=False)
     featured = models.BooleanField(default=False)
     description = models.TextField(null=True , blank=True)
+    # units left to sell, empty when the product's stock is not tracked
+    stock = models.PositiveIntegerField(null=True, blank=True)
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     categories = models.ManyToManyField(Category)
 
+    class Meta:
+        indexes = [
+            # home page: featured products, newest first. A partial index because
+            # the boolean filter is rendered as a bare column on SQLite
+            models.Index(
+                fields=["-created_at"],
+                condition=models.Q(featured=True),
+                name="product_featured_created_idx",
+            ),
+            # listing sorts and keyset seeks, the pk tie-breaker is implied
+            models.Index(fields=["price"], name="product_price_idx"),
+            models.Index(fields=["created_at"], name="product_created_idx"),
+        ]
+
     def __str__(self):
         return self.name
 
@@ -29,6 +47,10 @@ class Product(models.Model):
 class Cart(models.Model):
     user = models.OneToOneField("accounts.CustomUser", on_delete=models.CASCADE)
 
+    # denormalized from the lines, kept up to date by store.carts.refresh_summary
+    item_count = models.PositiveIntegerField(default=0)
+    total = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
     def __str__(self):
         return f"{self.user.email}'s cart"
 
@@ -40,6 +62,12 @@ class CartProduct(models.Model):
 
     added_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            # one line per product, add_to_cart upserts into it
+            models.UniqueConstraint(fields=["cart", "product"], name="cartproduct_cart_product_uniq"),
+        ]
+
     @property
     def get_total_price(self):
         return self.quantity*self.product.price
@@ -79,6 +107,16 @@ class Order(models.Model):
     #delivery-person
     delivery_person = models.ForeignKey("accounts.Deliveryperson", on_delete=models.PROTECT, null=True)
 
+    class Meta:
+        indexes = [
+            # order history page: a user's orders, newest first
+            models.Index(fields=["user", "-created_at"], name="order_user_created_idx"),
+            # archive_orders: finished orders not touched for a while
+            models.Index(fields=["status", "updated_at"], name="order_status_updated_idx"),
+        ]
+
+    is_archived = False
+
     def __str__(self):
         return f"Order {self.order_id} ({self.user.email})"
 
@@ -136,12 +174,185 @@ class Payment(models.Model):
 
     #from khalti
     transaction_id = models.CharField(max_length=100, unique=True , null=True, blank=True)
-    pidx = models.CharField(max_length=100, unique= True)
+    pidx = models.CharField(max_length=100, unique= True, null=True, blank=True)
+    # Khalti's payment page for pidx, reused until it expires
+    payment_url = models.URLField(max_length=500, blank=True)
+    payment_expires_at = models.DateTimeField(null=True, blank=True)
+    # set while a request is talking to Khalti about this payment, see store.payments
+    locked_until = models.DateTimeField(null=True, blank=True, editable=False)
 
     amount = models.DecimalField(max_digits=10, decimal_places=2)
 
     paid_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # the open payments reconcile_payments scans
+            models.Index(fields=["status", "created_at"], name="payment_status_created_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.order.order_id} - {self.status}"
+
+class RelatedProduct(models.Model):
+    """Precomputed top-N neighbours of a product, written by ``build_related_products``."""
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="related")
+    related = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="+")
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["product", "rank"], name="relatedproduct_product_rank_uniq"),
+        ]
+
+    def __str__(self):
+        return f"{self.product} -> {self.related} ({self.score:.2f})"
+
+
+class StockReservation(models.Model):
+    """Units held for an unpaid order, already taken off ``Product.stock``.
+
+    Deleted once the order is paid; released back to stock by the
+    ``release_expired_reservations`` sweeper when it expires first.
+    """
+
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name="reservations")
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="reservations")
+    quantity = models.PositiveIntegerField()
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["expires_at"], name="reservation_expires_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.order.order_id}: {self.product.name} x {self.quantity}"
+
+
+# archive tier: finished orders moved out of the tables above by ``archive_orders``,
+# keeping their original primary keys
+
+
+class ArchivedOrder(models.Model):
+    """A delivered or cancelled ``Order`` moved out of the order table; read-only."""
+
+    id = models.IntegerField(primary_key=True)
+    user = models.ForeignKey(
+        "accounts.CustomUser",
+        on_delete=models.PROTECT,
+        related_name="archived_orders",
+    )
+
+    order_id = models.CharField(max_length=30, unique=True)
+    status = models.CharField(max_length=20, choices=Order.Status.choices)
+
+    subtotal = models.DecimalField(max_digits=10, decimal_places=2)
+    tax = models.DecimalField(max_digits=10, decimal_places=2, default=0.0)
+    shipping_cost = models.DecimalField(max_digits=10, decimal_places=2, default=0.0)
+    total = models.DecimalField(max_digits=10, decimal_places=2, default=0.0)
+
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    delivery_person = models.ForeignKey("accounts.Deliveryperson", on_delete=models.PROTECT, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "-created_at"], name="archivedorder_user_created_idx"),
+        ]
+
+    is_archived = True
+
+    def __str__(self):
+        return f"Order {self.order_id} ({self.user.email}, archived)"
+
+
+class ArchivedOrderItem(models.Model):
+    id = models.IntegerField(primary_key=True)
+    order = models.ForeignKey(
+        ArchivedOrder,
+        on_delete=models.CASCADE,
+        related_name="items",
+    )
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.PROTECT,
+        related_name="+",
+    )
+
+    product_name = models.CharField(max_length=100)
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    quantity = models.PositiveIntegerField()
+
+    def get_total_price(self):
+        return self.price * self.quantity
+
+    def __str__(self):
+        return f"{self.product_name} x {self.quantity}"
+
+
+class ArchivedPayment(models.Model):
+    id = models.IntegerField(primary_key=True)
+    order = models.OneToOneField(
+        ArchivedOrder,
+        on_delete=models.CASCADE,
+        related_name="payment",
+    )
+
+    method = models.CharField(max_length=20, choices=Payment.Method.choices)
+    status = models.CharField(max_length=20, choices=Payment.Status.choices)
+    purchase_order_id = models.CharField(max_length=100, unique=True)
+    transaction_id = models.CharField(max_length=100, unique=True, null=True, blank=True)
+    pidx = models.CharField(max_length=100, unique=True, null=True, blank=True)
+
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+
+    paid_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.order.order_id} - {self.status}"
+
+
+# sales rollups, maintained incrementally by store.rollups
+
+
+class DailyOrderStats(models.Model):
+    """Orders created on ``day`` that are now in ``status``, and their total."""
+
+    day = models.DateField()
+    status = models.CharField(max_length=20, choices=Order.Status.choices)
+    orders = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        verbose_name_plural = "daily order stats"
+        constraints = [
+            models.UniqueConstraint(fields=["day", "status"], name="dailyorderstats_day_status_uniq"),
+        ]
+
+    def __str__(self):
+        return f"{self.day} {self.status}: {self.orders}"
+
+
+class DailyProductSales(models.Model):
+    """Units of a product sold in the orders created on ``day``."""
+
+    day = models.DateField()
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name="+")
+    units = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        verbose_name_plural = "daily product sales"
+        constraints = [
+            models.UniqueConstraint(fields=["day", "product"], name="dailyproductsales_day_product_uniq"),
+        ]
+
     def __str__(self):
-        return f"{self.order.order_id} - {self.status}"
\ No newline at end of file
+        return f"{self.day} {self.product_id}: {self.units}"
@@ -0,0 +1,229 @@
+"""Keyset (cursor) pagination for the product listing.
+
+Pages are fetched with ``WHERE (sort_column, id) > (last_value, last_id)`` seeks
+instead of ``OFFSET``, so page N costs the same as page 1 and no ``COUNT(*)`` is
+needed to render the navigation.
+"""
+import hashlib
+
+from django.core import signing
+from django.core.cache import cache
+from django.db.models import Q
+
+CURSOR_SALT = "store.pagination.cursor"
+TOTAL_CACHE_TIMEOUT = 60
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+class KeysetPage:
+    def __init__(self, object_list, next_cursor, previous_cursor, paginator):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.paginator = paginator
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __bool__(self):
+        return bool(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    @property
+    def estimated_total(self):
+        """The paginator's total, or None unless it counts totals (see ``count_total``)."""
+        if not self.paginator.count_total:
+            return None
+        return self.paginator.estimated_total()
+
+
+class KeysetPaginator:
+    """Paginate ``queryset`` on ``(field, pk)``.
+
+    ``field`` is a model field name, prefixed with ``-`` for descending order.
+    The pk is always used as the tie-breaker so the order is total and a cursor
+    never skips or repeats rows.
+
+    Pages only report an ``estimated_total`` when ``count_total`` is set, since
+    it costs a ``COUNT(*)`` whenever the cached count has expired.
+    """
+
+    count_total = False
+
+    def __init__(self, queryset, field, per_page, count_total=False):
+        self.queryset = queryset
+        self.descending = field.startswith("-")
+        self.field = field.lstrip("-")
+        self.per_page = per_page
+        self.count_total = count_total
+
+    def ordering(self, reverse=False):
+        descending = self.descending != reverse
+        prefix = "-" if descending else ""
+        if self.field == "pk":
+            return (f"{prefix}pk",)
+        return (f"{prefix}{self.field}", f"{prefix}pk")
+
+    def encode_cursor(self, obj, direction):
+        data = {"d": direction, "pk": obj.pk}
+        if self.field != "pk":
+            data["v"] = self.queryset.model._meta.get_field(self.field).value_to_string(obj)
+        return signing.dumps(data, salt=CURSOR_SALT, compress=True)
+
+    def decode_cursor(self, cursor):
+        try:
+            data = signing.loads(cursor, salt=CURSOR_SALT)
+            direction = data["d"]
+            if self.field == "pk":
+                value = data["pk"]
+            else:
+                value = self.queryset.model._meta.get_field(self.field).to_python(data["v"])
+            return direction, value, data["pk"]
+        except (signing.BadSignature, KeyError, TypeError, ValueError) as exc:
+            raise InvalidCursor(str(exc))
+
+    def seek(self, value, pk, forward):
+        # moving forward in a descending order means looking for smaller values
+        lookup = "lt" if self.descending == forward else "gt"
+        if self.field == "pk":
+            return Q(**{f"pk__{lookup}": pk})
+        return Q(**{f"{self.field}__{lookup}": value}) | Q(
+            **{self.field: value, f"pk__{lookup}": pk}
+        )
+
+    def read_cursor(self, cursor):
+        """``(direction, value, pk)`` of ``cursor``; a bad or missing cursor means the first page."""
+        if cursor:
+            try:
+                return self.decode_cursor(cursor)
+            except InvalidCursor:
+                pass
+        return "n", None, None
+
+    def fetch(self, queryset, value, pk, forward):
+        """Up to ``per_page + 1`` rows of ``queryset`` past the cursor position."""
+        if pk is not None:
+            queryset = queryset.filter(self.seek(value, pk, forward))
+        return list(queryset.order_by(*self.ordering(reverse=not forward))[: self.per_page + 1])
+
+    def get_page(self, cursor=None):
+        """Return the page addressed by ``cursor``; a bad or missing cursor gives the first page."""
+        direction, value, pk = self.read_cursor(cursor)
+        forward = direction == "n"
+        rows = self.fetch(self.queryset, value, pk, forward)
+        has_more = len(rows) > self.per_page
+        rows = rows[: self.per_page]
+        if not forward:
+            rows.reverse()
+
+        return self.make_page(rows, forward, has_more, pk is not None)
+
+    def make_page(self, rows, forward, has_more, from_cursor):
+        if not rows:
+            return KeysetPage(rows, None, None, self)
+
+        if forward:
+            has_next, has_previous = has_more, from_cursor
+        else:
+            has_next, has_previous = True, has_more
+
+        return KeysetPage(
+            rows,
+            self.encode_cursor(rows[-1], "n") if has_next else None,
+            self.encode_cursor(rows[0], "p") if has_previous else None,
+            self,
+        )
+
+    def estimated_total(self):
+        """Total row count, cached briefly so it is not recounted on every page."""
+        sql, params = self.queryset.order_by().values("pk").query.sql_with_params()
+        key = "keyset-total:" + hashlib.md5(f"{sql}{params}".encode()).hexdigest()
+        total = cache.get(key)
+        if total is None:
+            total = self.queryset.count()
+            cache.set(key, total, TOTAL_CACHE_TIMEOUT)
+        return total
+
+
+class MergedKeysetPaginator(KeysetPaginator):
+    """Keyset paginator over several querysets read as one, e.g. a table and its archive.
+
+    Each queryset is seeked on its own and the rows are merged on ``(field,
+    pk)``, so the pks must be unique across the querysets. A page costs one
+    query per queryset (plus its prefetches), whatever the position.
+    """
+
+    def __init__(self, querysets, field, per_page):
+        super().__init__(querysets[0], field, per_page)
+        self.querysets = querysets
+
+    def get_page(self, cursor=None):
+        direction, value, pk = self.read_cursor(cursor)
+        forward = direction == "n"
+        rows = []
+        for queryset in self.querysets:
+            rows += self.fetch(queryset, value, pk, forward)
+        rows.sort(
+            key=lambda row: (getattr(row, self.field), row.pk),
+            reverse=self.descending == forward,
+        )
+
+        has_more = len(rows) > self.per_page
+        rows = rows[: self.per_page]
+        if not forward:
+            rows.reverse()
+
+        return self.make_page(rows, forward, has_more, pk is not None)
+
+    def estimated_total(self):
+        return sum(KeysetPaginator(queryset, self.field, self.per_page).estimated_total() for queryset in self.querysets)
+
+
+class CatalogIndexPaginator(KeysetPaginator):
+    """Keyset paginator answered from the in-memory catalog index.
+
+    Filtering, ordering and the cursor seek all happen on the index ``mask``;
+    the database is only asked for the rows of the page itself. Cursors are
+    interchangeable with the ones from :class:`KeysetPaginator`. The total is
+    a popcount of the mask, so it is always reported.
+    """
+
+    def __init__(self, index, mask, queryset, field, per_page):
+        super().__init__(queryset, field, per_page, count_total=True)
+        self.index = index
+        self.mask = mask
+
+    def get_page(self, cursor=None):
+        direction, _, pk = self.read_cursor(cursor)
+        forward = direction == "n"
+        try:
+            ids = self.index.page(
+                self.mask, self.field, self.descending, self.per_page + 1,
+                after_pk=pk, backwards=not forward,
+            )
+        except KeyError:
+            # the boundary product is gone, let the database seek past it
+            return super().get_page(cursor)
+
+        has_more = len(ids) > self.per_page
+        ids = ids[: self.per_page]
+        if not forward:
+            ids.reverse()
+
+        products = self.queryset.model.objects.in_bulk(ids)
+        rows = [products[pk] for pk in ids if pk in products]
+        return self.make_page(rows, forward, has_more, pk is not None)
+
+    def estimated_total(self):
+        return self.mask.bit_count()
@@ -0,0 +1,197 @@
+"""Idempotent Khalti payment initiation and callbacks, for the sync and async views.
+
+A double click on "Pay", a retried request or a reloaded callback must not
+reach Khalti again, nor apply the same transition twice:
+
+* :func:`start` hands out the payment page stored on the ``Payment`` while it
+  has more than ``PAYMENT_URL_MARGIN`` seconds left (and the order's stock is
+  still reserved), and only initiates a new one once it has expired.
+* :func:`verify` uses the ``pidx`` as the callback's idempotency key: a
+  payment already settled is answered from the database.
+
+Either call to Khalti is made by one request at a time per payment, in any
+process: the request claims the ``Payment`` row with a conditional UPDATE of
+``locked_until``, and the requests that do not get it wait for the claim to
+go (for at most ``WAIT_TIMEOUT`` seconds) and read what the holder stored.
+"""
+import asyncio
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Min, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import khalti, reconciliation
+from .models import Payment, StockReservation
+
+# a page this close to expiring could run out while the customer pays
+PAYMENT_URL_MARGIN = 60
+# Khalti's payment pages last 30 minutes, when an answer does not say
+DEFAULT_EXPIRES_IN = 1800
+
+POLL_INTERVAL = 0.05
+# longest a request waits for another one's gateway call before telling the
+# customer to try again, rather than holding its worker for the whole call
+WAIT_TIMEOUT = 2
+
+
+def lock_timeout():
+    """Longest a request may hold a payment lock: one gateway call with its retries, then some."""
+    return (settings.KHALTI_CONNECT_TIMEOUT + settings.KHALTI_READ_TIMEOUT) * (settings.KHALTI_MAX_RETRIES + 1) + 5
+
+
+def lock(payment):
+    """Claim ``payment`` for one gateway call; returns the claim, or None while another request holds it.
+
+    The claim of a request that died lapses after :func:`lock_timeout`.
+    """
+    now = timezone.now()
+    until = now + timedelta(seconds=lock_timeout())
+    claimed = (
+        Payment.objects.filter(pk=payment.pk)
+        .filter(Q(locked_until__isnull=True) | Q(locked_until__lt=now))
+        .update(locked_until=until)
+    )
+    return until if claimed else None
+
+
+def unlock(payment, claim):
+    # a claim that lapsed may have been taken over since, leave that one alone
+    Payment.objects.filter(pk=payment.pk, locked_until=claim).update(locked_until=None)
+
+
+def _held(payment):
+    return Payment.objects.filter(pk=payment.pk, locked_until__gte=timezone.now())
+
+
+def wait(payment):
+    """Wait until nobody holds ``payment``, at most ``WAIT_TIMEOUT`` seconds."""
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    while _held(payment).exists() and time.monotonic() < deadline:
+        time.sleep(POLL_INTERVAL)
+
+
+async def await_release(payment):
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    while await _held(payment).aexists() and time.monotonic() < deadline:
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+def reopen(payment):
+    """Start ``payment`` over if Khalti reported it expired or cancelled, so the order can still be paid."""
+    reopened = Payment.objects.filter(pk=payment.pk, status=Payment.Status.FAILED).update(
+        status=Payment.Status.INITIATED, pidx=None, payment_url="", payment_expires_at=None,
+    )
+    if reopened:
+        payment.refresh_from_db()
+
+
+def reusable_url(payment):
+    """The stored payment page of ``payment`` if it is still good to send a customer to."""
+    if payment.payment_url and payment.payment_expires_at:
+        if payment.payment_expires_at > timezone.now() + timedelta(seconds=PAYMENT_URL_MARGIN):
+            return payment.payment_url
+    return None
+
+
+def record_initiated(payment, data, reserved_until=None):
+    """Store Khalti's initiate answer on ``payment``; returns the fields to save.
+
+    The page is only reused while the order's stock is still reserved, so a
+    customer is never sent to pay for an order the sweeper is about to cancel.
+    """
+    payment.pidx = data["pidx"]
+    payment.payment_url = data["payment_url"]
+    expires_at = parse_datetime(data.get("expires_at") or "") or (
+        timezone.now() + timedelta(seconds=data.get("expires_in") or DEFAULT_EXPIRES_IN)
+    )
+    payment.payment_expires_at = min(expires_at, reserved_until) if reserved_until else expires_at
+    return ["pidx", "payment_url", "payment_expires_at"]
+
+
+def _reservations(payment):
+    return StockReservation.objects.filter(order_id=payment.order_id)
+
+
+def start(payment, initiate):
+    """The payment page for ``payment``: the stored one while valid, else a new one from ``initiate()``.
+
+    Returns None when another request is initiating it and did not store a
+    page in time. Raises the :class:`~store.khalti.KhaltiError` of a failed initiate.
+    """
+    url = reusable_url(payment)
+    if url:
+        return url
+    claim = lock(payment)
+    if claim is None:
+        wait(payment)
+        payment.refresh_from_db()
+        return reusable_url(payment)
+    try:
+        # the previous holder may have finished between the check above and the lock
+        payment.refresh_from_db()
+        url = reusable_url(payment)
+        if url:
+            return url
+        reserved_until = _reservations(payment).aggregate(until=Min("expires_at"))["until"]
+        payment.save(update_fields=record_initiated(payment, initiate(), reserved_until))
+        return payment.payment_url
+    finally:
+        unlock(payment, claim)
+
+
+async def astart(payment, ainitiate):
+    """:func:`start` for the async views; ``ainitiate()`` is awaited."""
+    url = reusable_url(payment)
+    if url:
+        return url
+    claim = await sync_to_async(lock)(payment)
+    if claim is None:
+        await await_release(payment)
+        await payment.arefresh_from_db()
+        return reusable_url(payment)
+    try:
+        await payment.arefresh_from_db()
+        url = reusable_url(payment)
+        if url:
+            return url
+        reserved_until = (await _reservations(payment).aaggregate(until=Min("expires_at")))["until"]
+        await payment.asave(update_fields=record_initiated(payment, await ainitiate(), reserved_until))
+        return payment.payment_url
+    finally:
+        await sync_to_async(unlock)(payment, claim)
+
+
+def verify(payment):
+    """Settle ``payment`` from a Khalti lookup, once per ``pidx``; returns its status afterwards.
+
+    Raises the :class:`~store.khalti.KhaltiError` of a failed lookup.
+    """
+    if payment.status not in reconciliation.OPEN_STATUSES:
+        return payment.status
+    claim = lock(payment)
+    if claim is None:
+        wait(payment)
+        payment.refresh_from_db()
+        return payment.status
+    try:
+        return reconciliation.settle(payment, khalti.lookup(payment.pidx))
+    finally:
+        unlock(payment, claim)
+
+
+async def averify(payment):
+    if payment.status not in reconciliation.OPEN_STATUSES:
+        return payment.status
+    claim = await sync_to_async(lock)(payment)
+    if claim is None:
+        await await_release(payment)
+        await payment.arefresh_from_db()
+        return payment.status
+    try:
+        return await sync_to_async(reconciliation.settle)(payment, await khalti.alookup(payment.pidx))
+    finally:
+        await sync_to_async(unlock)(payment, claim)
@@ -0,0 +1,126 @@
+"""Offline "bought together" recommendations.
+
+:func:`build_related_products` scans order history once, live and archived
+orders alike, counts how often two products appear in the same order and
+stores the top neighbours of each product in ``RelatedProduct``. Products with too little purchase history are topped up
+with products that share their categories. The detail page then only reads the
+precomputed rows.
+"""
+from collections import Counter, defaultdict
+from itertools import combinations
+
+from django.db import transaction
+
+from . import caching
+from .models import Product, Order, OrderItem, ArchivedOrderItem, RelatedProduct
+
+TOP_N = 4
+
+# very large orders add little signal and a quadratic number of pairs
+MAX_ITEMS_PER_ORDER = 50
+
+# newest products per category considered as category-based fallbacks
+CATEGORY_CANDIDATES = 50
+
+
+def co_purchase_counts():
+    """Return ``{product_id: Counter({other_id: orders_with_both})}``."""
+    counts = defaultdict(Counter)
+    # live and archived orders keep distinct pks, so baskets do not mix across the two tiers
+    rows = (
+        OrderItem.objects.exclude(order__status=Order.Status.CANCELLED)
+        .values_list("order_id", "product_id")
+        .union(
+            ArchivedOrderItem.objects.exclude(order__status=Order.Status.CANCELLED).values_list("order_id", "product_id"),
+            all=True,
+        )
+        .order_by("order_id")
+    )
+
+    def flush(product_ids):
+        product_ids = sorted(product_ids)[:MAX_ITEMS_PER_ORDER]
+        for a, b in combinations(product_ids, 2):
+            counts[a][b] += 1
+            counts[b][a] += 1
+
+    current_order, basket = None, set()
+    for order_id, product_id in rows.iterator(chunk_size=5000):
+        if order_id != current_order:
+            flush(basket)
+            current_order, basket = order_id, set()
+        basket.add(product_id)
+    flush(basket)
+    return counts
+
+
+def category_neighbours():
+    """Return ``(product -> categories, category -> candidate products)``."""
+    product_categories = defaultdict(set)
+    for product_id, category_id in Product.categories.through.objects.values_list(
+        "product_id", "category_id"
+    ).iterator(chunk_size=5000):
+        product_categories[product_id].add(category_id)
+
+    candidates = defaultdict(list)
+    for product_id, category_id in (
+        Product.categories.through.objects.order_by("category_id", "-product__created_at")
+        .values_list("product_id", "category_id")
+        .iterator(chunk_size=5000)
+    ):
+        if len(candidates[category_id]) < CATEGORY_CANDIDATES:
+            candidates[category_id].append(product_id)
+    return product_categories, candidates
+
+
+def top_neighbours(product_id, counts, product_categories, candidates, top_n=TOP_N):
+    """Best ``top_n`` (related_id, score) pairs for one product.
+
+    Co-purchase scores are order counts (>= 1); category fallbacks score below 1
+    so they always rank after real purchase history.
+    """
+    ranked = counts.get(product_id, Counter()).most_common(top_n)
+    if len(ranked) >= top_n:
+        return ranked
+
+    seen = {product_id} | {other for other, _ in ranked}
+    own = product_categories.get(product_id, set())
+    shared = Counter()
+    for category_id in own:
+        for other in candidates.get(category_id, ()):
+            if other not in seen:
+                shared[other] += 1
+    for other, overlap in shared.most_common(top_n - len(ranked)):
+        ranked.append((other, overlap / (len(own) + 1)))
+    return ranked
+
+
+def build_related_products(top_n=TOP_N, batch_size=1000):
+    """Recompute the whole ``RelatedProduct`` table, returns the number of rows written."""
+    counts = co_purchase_counts()
+    product_categories, candidates = category_neighbours()
+
+    rows = []
+    for product_id in Product.objects.values_list("pk", flat=True).iterator(chunk_size=5000):
+        for rank, (related_id, score) in enumerate(
+            top_neighbours(product_id, counts, product_categories, candidates, top_n)
+        ):
+            rows.append(
+                RelatedProduct(product_id=product_id, related_id=related_id, rank=rank, score=score)
+            )
+
+    with transaction.atomic():
+        RelatedProduct.objects.all().delete()
+        RelatedProduct.objects.bulk_create(rows, batch_size=batch_size)
+    # detail pages render the related products, drop their ETags (once the rows are visible)
+    transaction.on_commit(lambda: caching.bump_version("products"))
+    return len(rows)
+
+
+def related_products(product, limit=TOP_N):
+    """Precomputed neighbours of ``product``, one indexed query."""
+    return [
+        row.related
+        for row in RelatedProduct.objects.filter(product=product)
+        .select_related("related")
+        .order_by("rank")[:limit]
+    ]
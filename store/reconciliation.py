@@ -0,0 +1,165 @@
+"""Khalti payment reconciliation.
+
+A customer who closes the tab on Khalti's page, or whose redirect back fails,
+never reaches the payment callback, and their payment would stay
+``initiated`` or ``pending`` for good. :func:`reconcile` (the
+``reconcile_payments`` command, run from cron) asks Khalti's lookup API about
+every open payment older than ``PAYMENT_RECONCILE_MIN_AGE`` and settles it.
+
+Lookups are network-bound, so each batch is looked up by
+``PAYMENT_RECONCILE_CONCURRENCY`` threads at once (over the pooled session of
+:mod:`store.khalti`), then applied in one short transaction: one
+``bulk_update`` for the payments and one ``update`` for the orders they pay.
+
+The callback goes through :func:`settle` as well, so both paths trust only
+what the lookup API says, never the query string of the redirect.
+"""
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import inventory, khalti, rollups
+from .models import Order, Payment
+
+OPEN_STATUSES = [Payment.Status.INITIATED, Payment.Status.PENDING]
+
+# lookup statuses we act on; others ("Partially Refunded", ...) are left to staff
+LOOKUP_STATUSES = {
+    "Initiated": Payment.Status.INITIATED,
+    "Pending": Payment.Status.PENDING,
+    "Completed": Payment.Status.SUCCESS,
+    "Expired": Payment.Status.FAILED,
+    "User canceled": Payment.Status.FAILED,
+    "Refunded": Payment.Status.REFUNDED,
+}
+
+
+def amount_paisa(payment):
+    return int((payment.amount * Decimal("100")).quantize(Decimal("1")))
+
+
+def apply(results):
+    """Settle payments from their lookups, ``[(payment, lookup data), ...]``, in one transaction.
+
+    Only payments still open when the transaction starts are changed, so a
+    payment settled meanwhile by the callback or another run is left alone.
+    Returns a ``Counter`` of the outcomes.
+    """
+    outcomes = Counter()
+    wanted = {}
+    for payment, data in results:
+        status = LOOKUP_STATUSES.get(data.get("status"))
+        if status is None:
+            outcomes["unknown"] += 1
+        elif status == Payment.Status.SUCCESS and data.get("total_amount") != amount_paisa(payment):
+            outcomes["amount_mismatch"] += 1
+        elif status == payment.status:
+            outcomes["unchanged"] += 1
+        else:
+            wanted[payment.pk] = (status, data)
+    if not wanted:
+        return outcomes
+
+    now = timezone.now()
+    with transaction.atomic():
+        payments = list(
+            Payment.objects.select_for_update()
+            .select_related("order")
+            .filter(pk__in=wanted, status__in=OPEN_STATUSES)
+            .order_by("pk")
+        )
+        outcomes["already_settled"] += len(wanted) - len(payments)
+        paid_orders = []
+        for payment in payments:
+            status, data = wanted[payment.pk]
+            payment.status = status
+            if status == Payment.Status.SUCCESS:
+                payment.transaction_id = data.get("transaction_id") or None
+                payment.paid_at = now
+                paid_orders.append(payment.order)
+            outcomes[status] += 1
+        if not payments:
+            return outcomes
+        Payment.objects.bulk_update(payments, ["status", "transaction_id", "paid_at"])
+
+        # an order the sweeper cancelled before the money arrived stays cancelled for staff to refund
+        payable = [order for order in paid_orders if order.status == Order.Status.PENDING]
+        outcomes["paid_order_not_pending"] += len(paid_orders) - len(payable)
+        if payable:
+            order_ids = [order.pk for order in payable]
+            Order.objects.filter(pk__in=order_ids).update(status=Order.Status.PAID, updated_at=now)
+            rollups.record([(order, Order.Status.PENDING, Order.Status.PAID) for order in payable])
+            inventory.confirm_many(order_ids)
+    return outcomes
+
+
+def settle(payment, data):
+    """Apply one lookup to ``payment``; returns the payment's status afterwards."""
+    apply([(payment, data)])
+    return Payment.objects.values_list("status", flat=True).get(pk=payment.pk)
+
+
+def _lookup(payment):
+    try:
+        return khalti.lookup(payment.pidx)
+    except khalti.KhaltiError as exc:
+        return exc
+
+
+class Run:
+    """What one :func:`reconcile` run did."""
+
+    def __init__(self):
+        self.outcomes = Counter()
+        self.looked_up = 0
+        self.errors = Counter()
+        self.seconds = 0.0
+
+    @property
+    def rate(self):
+        """Payments looked up per second."""
+        return self.looked_up / self.seconds if self.seconds else 0.0
+
+
+def reconcile(min_age=None, batch_size=100, concurrency=None):
+    """Look up the open payments older than ``min_age`` seconds at Khalti and settle them.
+
+    Works through them in pk batches of ``batch_size``, with up to
+    ``concurrency`` lookups in flight. Stops early when the circuit breaker
+    opens; what is left is picked up by the next run. Returns a :class:`Run`.
+    """
+    min_age = settings.PAYMENT_RECONCILE_MIN_AGE if min_age is None else min_age
+    concurrency = concurrency or settings.PAYMENT_RECONCILE_CONCURRENCY
+    cutoff = timezone.now() - timedelta(seconds=min_age)
+    run = Run()
+    start = time.perf_counter()
+    last_pk = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while True:
+            batch = list(
+                Payment.objects.filter(
+                    status__in=OPEN_STATUSES, pidx__isnull=False, created_at__lte=cutoff, pk__gt=last_pk,
+                ).order_by("pk")[:batch_size]
+            )
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+
+            results = []
+            for payment, answer in zip(batch, pool.map(_lookup, batch)):
+                if isinstance(answer, Exception):
+                    run.errors[type(answer).__name__] += 1
+                else:
+                    results.append((payment, answer))
+            run.looked_up += len(batch)
+            run.outcomes.update(apply(results))
+            if run.errors["CircuitOpen"]:
+                break
+    run.seconds = time.perf_counter() - start
+    return run
@@ -0,0 +1,134 @@
+"""Daily sales rollups.
+
+``DailyOrderStats`` counts the orders created on a day by their current status
+and ``DailyProductSales`` the units and revenue per product of the orders
+created on a day that are sold (paid, on the way or delivered). Both are kept
+up to date incrementally: every status change is applied as a delta with one
+multi-row ``INSERT ... ON CONFLICT DO UPDATE SET n = n + excluded.n`` per
+table, so reports never aggregate ``Order`` / ``OrderItem``.
+
+Saves go through the ``Order`` signals in :mod:`store.signals`; code changing
+statuses with ``update()`` or deleting orders calls :func:`record` itself.
+Archiving moves orders without changing them and leaves the rollups alone.
+``backfill_sales_rollups`` rebuilds both tables from the order history.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import connection, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models import Order, OrderItem, DailyOrderStats, DailyProductSales
+
+SOLD_STATUSES = {Order.Status.PAID, Order.Status.ON_THE_WAY, Order.Status.DELIVERED}
+
+
+def order_day(order):
+    return timezone.localdate(order.created_at)
+
+
+def _add(model, keys, values, rows):
+    """Add ``rows`` (``{key tuple: value tuple}``) onto the counters of ``model``, creating missing rows."""
+    rows = {key: amounts for key, amounts in rows.items() if any(amounts)}
+    if not rows:
+        return
+    quote = connection.ops.quote_name
+    table = quote(model._meta.db_table)
+    fields = [model._meta.get_field(name) for name in keys + values]
+    columns = [quote(field.column) for field in fields]
+    value_columns = columns[len(keys):]
+    params = []
+    for key, amounts in rows.items():
+        params += [field.get_db_prep_value(value, connection) for field, value in zip(fields, key + amounts)]
+    placeholders = "(" + ", ".join(["%s"] * len(fields)) + ")"
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES {', '.join([placeholders] * len(rows))} "
+            f"ON CONFLICT ({', '.join(columns[:len(keys)])}) DO UPDATE SET "
+            + ", ".join(f"{column} = {table}.{column} + excluded.{column}" for column in value_columns),
+            params,
+        )
+
+
+def _totals():
+    return defaultdict(lambda: [0, Decimal(0)])
+
+
+def _add_item_sales(sales, items_model, order_days, sign=1):
+    """Add the units and revenue of the items of ``order_days`` (``{order pk: day}``) to ``sales``."""
+    items = (
+        items_model.objects.filter(order_id__in=order_days)
+        .values("order_id", "product_id")
+        .annotate(units=Sum("quantity"), revenue=Sum(F("price") * F("quantity")))
+    )
+    for item in items:
+        line = sales[(order_days[item["order_id"]], item["product_id"])]
+        line[0] += sign * item["units"]
+        line[1] += sign * item["revenue"]
+
+
+def _save(stats, sales):
+    # no savepoint when already inside the caller's transaction (checkout)
+    with transaction.atomic(savepoint=False):
+        _add(DailyOrderStats, ["day", "status"], ["orders", "revenue"], {key: tuple(value) for key, value in stats.items()})
+        _add(DailyProductSales, ["day", "product"], ["units", "revenue"], {key: tuple(value) for key, value in sales.items()})
+
+
+def record(changes):
+    """Apply status changes ``(order, old_status, new_status)`` to the rollups.
+
+    A status of ``None`` means the order does not exist (created or deleted).
+    The order items are read once, for the orders becoming sold or unsold.
+    """
+    stats, sales = _totals(), _totals()
+    became_sold, became_unsold = {}, {}
+    for order, old_status, new_status in changes:
+        if old_status == new_status:
+            continue
+        day = order_day(order)
+        # an unsaved-and-not-reloaded total can still be the int or float it was given as
+        total = Decimal(str(order.total))
+        for status, sign in ((old_status, -1), (new_status, 1)):
+            if status is not None:
+                stats[(day, status)][0] += sign
+                stats[(day, status)][1] += sign * total
+        if (old_status in SOLD_STATUSES) != (new_status in SOLD_STATUSES):
+            (became_sold if new_status in SOLD_STATUSES else became_unsold)[order.pk] = day
+
+    if not stats:
+        return
+    for order_days, sign in ((became_sold, 1), (became_unsold, -1)):
+        if order_days:
+            _add_item_sales(sales, OrderItem, order_days, sign)
+    _save(stats, sales)
+
+
+def backfill(orders, batch_size=1000):
+    """Add every order of the ``orders`` queryset (live or archived) to the rollups, in pk batches.
+
+    Run on empty rollups, while statuses are not changing. Returns the number of orders read.
+    """
+    done = 0
+    last_pk = 0
+    items_model = orders.model.items.field.model
+    while True:
+        batch = list(
+            orders.filter(pk__gt=last_pk).order_by("pk").only("pk", "created_at", "status", "total")[:batch_size]
+        )
+        if not batch:
+            return done
+        last_pk = batch[-1].pk
+
+        stats, sales = _totals(), _totals()
+        sold = {}
+        for order in batch:
+            day = order_day(order)
+            stats[(day, order.status)][0] += 1
+            stats[(day, order.status)][1] += order.total
+            if order.status in SOLD_STATUSES:
+                sold[order.pk] = day
+        if sold:
+            _add_item_sales(sales, items_model, sold)
+        _save(stats, sales)
+        done += len(batch)
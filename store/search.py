@@ -0,0 +1,124 @@
+"""Full-text product search backed by an SQLite FTS5 index.
+
+The index lives in the ``store_product_fts`` virtual table (rowid == product id)
+and holds the product name, description and the names of its categories. It is
+created by migration 0020, ranks with ``bm25(10.0, 1.0, 4.0)`` (name,
+description, categories) and is kept in sync by the signal handlers in
+``store.signals``.
+"""
+import re
+
+from django.db import connection
+from django.db.models import Value
+from django.db.models.expressions import RawSQL
+
+FTS_TABLE = "store_product_fts"
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+_available = None
+
+
+def fts_available():
+    """Return True when the database supports the FTS5 product index."""
+    global _available
+    if _available is None:
+        if connection.vendor != "sqlite":
+            _available = False
+        else:
+            _available = FTS_TABLE in connection.introspection.table_names()
+    return _available
+
+
+def build_match_query(text):
+    """Turn free text into an FTS5 query.
+
+    Every word must match and the last one is treated as a prefix so results
+    show up while the user is still typing.
+    """
+    tokens = _TOKEN_RE.findall(text or "")
+    if not tokens:
+        return ""
+    terms = [f'"{token}"' for token in tokens[:-1]]
+    terms.append(f'"{tokens[-1]}"*')
+    return " AND ".join(terms)
+
+
+def _document(product):
+    categories = " ".join(category.name for category in product.categories.all())
+    return (product.pk, product.name, product.description or "", categories)
+
+
+def index_products(products):
+    """Insert or replace the index rows of the given products."""
+    if not fts_available():
+        return
+    rows = [_document(product) for product in products]
+    if not rows:
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [(row[0],) for row in rows]
+        )
+        cursor.executemany(
+            f"INSERT INTO {FTS_TABLE} (rowid, name, description, categories) "
+            "VALUES (%s, %s, %s, %s)",
+            rows,
+        )
+
+
+def remove_products(product_ids):
+    if not fts_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"DELETE FROM {FTS_TABLE} WHERE rowid = %s",
+            [(pk,) for pk in product_ids],
+        )
+
+
+def rebuild_index(chunk_size=2000):
+    """Drop every index row and re-index the whole catalog."""
+    from .models import Product
+
+    if not fts_available():
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE}")
+
+    count = 0
+    products = Product.objects.prefetch_related("categories").order_by("pk")
+    last_pk = 0
+    while True:
+        chunk = list(products.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            break
+        index_products(chunk)
+        count += len(chunk)
+        last_pk = chunk[-1].pk
+    return count
+
+
+def search_queryset(queryset, text):
+    """Filter ``queryset`` to products matching ``text``.
+
+    Matching rows are annotated with ``search_rank`` (lower is better). When the
+    FTS index is not available this falls back to a plain ``icontains`` filter.
+    """
+    match = build_match_query(text)
+    if not match:
+        return queryset.none()
+
+    if not fts_available():
+        return queryset.filter(name__icontains=text).annotate(search_rank=Value(0))
+
+    # MATCH runs once for the filter and once for the ranks: the CTE is
+    # materialized (SQLite 3.35+) instead of re-run for every matching row
+    table = queryset.model._meta.db_table
+    matching = RawSQL(f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", [match])
+    rank = RawSQL(
+        f"WITH matches AS MATERIALIZED (SELECT rowid, rank FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s) "
+        f"SELECT rank FROM matches WHERE rowid = {table}.id",
+        [match],
+    )
+    return queryset.filter(pk__in=matching).annotate(search_rank=rank)
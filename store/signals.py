@@ -0,0 +1,107 @@
+from django.db import transaction
+from django.db.models.signals import post_init, post_save, pre_delete, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from . import search, catalog_index, caching, carts, images, rollups
+from .models import Product, Category, Cart, Order
+
+
+def bump_products_version():
+    # after the commit: a request bumping in between would cache the old rows under the new version
+    transaction.on_commit(lambda: caching.bump_version("products"))
+
+
+def products_changed(products):
+    products = list(products)
+    search.index_products(products)
+    catalog_index.products_changed(products)
+    bump_products_version()
+
+
+def affected_products(product_ids):
+    return Product.objects.filter(pk__in=product_ids).prefetch_related("categories")
+
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    products_changed([instance])
+    if not created:
+        # the price may have changed, carts holding the product need new totals
+        carts.refresh_summaries(Cart.objects.filter(products__product=instance))
+
+    name = instance.image.name
+    if name and instance.derivatives_of != name:
+        transaction.on_commit(lambda: images.schedule(name))
+
+
+@receiver(pre_delete, sender=Product)
+def remember_product_carts(sender, instance, **kwargs):
+    instance._cart_ids = list(Cart.objects.filter(products__product=instance).values_list("pk", flat=True))
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance, **kwargs):
+    search.remove_products([instance.pk])
+    catalog_index.product_deleted(instance.pk)
+    bump_products_version()
+    carts.refresh_summaries(Cart.objects.filter(pk__in=getattr(instance, "_cart_ids", [])))
+
+
+@receiver(m2m_changed, sender=Product.categories.through)
+def product_categories_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear", "pre_clear"):
+        return
+
+    if not reverse:
+        if action != "pre_clear":
+            products_changed([instance])
+        return
+
+    # category side of the relation: refresh every affected product
+    if action == "pre_clear":
+        instance._cleared_product_ids = list(instance.product_set.values_list("pk", flat=True))
+        return
+    if action == "post_clear":
+        pk_set = getattr(instance, "_cleared_product_ids", [])
+    products_changed(affected_products(pk_set))
+
+
+@receiver(post_save, sender=Category)
+def category_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    # category names are shown on the listing
+    bump_products_version()
+    if not created:
+        search.index_products(instance.product_set.prefetch_related("categories"))
+
+
+@receiver(pre_delete, sender=Category)
+def remember_category_products(sender, instance, **kwargs):
+    instance._deleted_product_ids = list(instance.product_set.values_list("pk", flat=True))
+
+
+@receiver(post_delete, sender=Category)
+def category_deleted(sender, instance, **kwargs):
+    products_changed(affected_products(getattr(instance, "_deleted_product_ids", [])))
+
+
+@receiver(post_init, sender=Order)
+def remember_order_status(sender, instance, **kwargs):
+    # status is read from __dict__ so a deferred field is not loaded
+    instance._saved_status = instance.__dict__.get("status") if instance.pk else None
+
+
+@receiver(post_save, sender=Order)
+def order_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    old_status = None if created else instance._saved_status
+    if old_status is None and not created:
+        # loaded with status deferred, the previous status is unknown
+        return
+    if old_status != instance.status:
+        rollups.record([(instance, old_status, instance.status)])
+        instance._saved_status = instance.status
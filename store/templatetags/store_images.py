@@ -0,0 +1,45 @@
+from django import template
+from django.core.files.storage import default_storage
+from django.utils.html import format_html
+
+from store import images
+
+register = template.Library()
+
+
+def _srcset(name, extension):
+    return ", ".join(
+        f"{default_storage.url(images.derivative_name(name, width, extension))} {width}w"
+        for width in images.WIDTHS
+    )
+
+
+@register.simple_tag
+def product_picture(image, alt="", css_class="", sizes="220px"):
+    """Render a product image as a <picture> with WebP and resized fallbacks.
+
+    Until the derivatives exist (they are generated in the background after
+    an upload) the original image is used.
+    """
+    if not image:
+        return ""
+    name = image.name
+    if not images.derivatives_recorded(image):
+        return format_html(
+            '<img src="{}" alt="{}" class="{}" loading="lazy">', image.url, alt, css_class
+        )
+
+    fallback = images.fallback_extension(name)
+    return format_html(
+        '<picture>'
+        '<source type="image/webp" srcset="{}" sizes="{}">'
+        '<img src="{}" srcset="{}" sizes="{}" alt="{}" class="{}" loading="lazy">'
+        '</picture>',
+        _srcset(name, "webp"),
+        sizes,
+        default_storage.url(images.derivative_name(name, images.WIDTHS[0], fallback)),
+        _srcset(name, fallback),
+        sizes,
+        alt,
+        css_class,
+    )
@@ -1,3 +1,1541 @@
-from django.test import TestCase
+import asyncio
+import json
+import re
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+import httpx
+import requests
+from django.conf import settings
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, connection, connections, transaction
+from django.template import Context, Template
+from django.test import AsyncRequestFactory, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from . import search, catalog_index, caching, carts, checkout, inventory, recommendations, images, views, archive, khalti, payments, reconciliation
+from .bench import stand_in_gateway
+from accounts.models import CustomUser
+from .models import (
+    Product, Category, Cart, CartProduct, Order, OrderItem, Payment, StockReservation,
+    ArchivedOrder, ArchivedOrderItem, DailyOrderStats, DailyProductSales,
+)
+from .pagination import KeysetPaginator, CatalogIndexPaginator
+from .utils import OrderIdGenerator, MAX_SEQUENCE
+
+
+# the configured file-based cache lives in the project directory, keep tests off it
+TEST_CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "store-tests"}}
+
+
+@override_settings(CACHES=TEST_CACHES)
+class StoreTestCase(TestCase):
+    def setUp(self):
+        # process-local state outlives the per-test transaction rollback
+        catalog_index.reset()
+        cache.clear()
+
+
+def make_product(name, **kwargs):
+    kwargs.setdefault("price", 100)
+    if "image" not in kwargs:
+        # there is no file behind the stand-in image, nothing to resize
+        kwargs.update(image="products/test.jpg", derivatives_of="products/test.jpg")
+    return Product.objects.create(name=name, **kwargs)
+
+
+class ProductSearchTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.fruit = Category.objects.create(name="Fruit")
+        self.apple = make_product("Organic Apple", description="crisp and sweet")
+        self.apple.categories.add(self.fruit)
+        self.honey = make_product("Wild Honey", description="raw honey from apple orchards")
+        self.rice = make_product("Basmati Rice")
+
+    def result_names(self, text):
+        products = search.search_queryset(Product.objects.all(), text).order_by("search_rank", "pk")
+        return [product.name for product in products]
+
+    def test_build_match_query(self):
+        self.assertEqual(search.build_match_query("green te"), '"green" AND "te"*')
+        self.assertEqual(search.build_match_query('"; DROP'), '"DROP"*')
+        self.assertEqual(search.build_match_query("  "), "")
+
+    def test_prefix_match(self):
+        self.assertEqual(self.result_names("basm"), ["Basmati Rice"])
+
+    def test_name_ranks_above_description(self):
+        self.assertEqual(self.result_names("apple"), ["Organic Apple", "Wild Honey"])
+
+    def test_category_names_are_searchable(self):
+        self.assertEqual(self.result_names("fruit"), ["Organic Apple"])
+
+    def test_index_follows_updates_and_deletes(self):
+        self.rice.name = "Jasmine Rice"
+        self.rice.save()
+        self.assertEqual(self.result_names("basmati"), [])
+        self.assertEqual(self.result_names("jasmine"), ["Jasmine Rice"])
+
+        self.fruit.name = "Produce"
+        self.fruit.save()
+        self.assertEqual(self.result_names("produce"), ["Organic Apple"])
+
+        self.apple.categories.clear()
+        self.assertEqual(self.result_names("produce"), [])
+
+        self.honey.delete()
+        self.assertEqual(self.result_names("honey"), [])
+
+    def test_products_view_uses_search(self):
+        response = self.client.get(reverse("store:products_page"), {"name": "hon"})
+        self.assertEqual([p.name for p in response.context["products"]], ["Wild Honey"])
+
+
+class KeysetPaginationTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        # repeated prices so the pk tie-breaker matters
+        for i in range(23):
+            make_product(f"Product {i}", price=100 + (i % 5))
+
+    def walk(self, paginator):
+        pages = []
+        page = paginator.get_page()
+        pages.append([p.pk for p in page])
+        while page.has_next():
+            page = paginator.get_page(page.next_cursor)
+            pages.append([p.pk for p in page])
+        return page, pages
+
+    def test_every_sort_is_stable_in_both_directions(self):
+        for field in ["pk", "price", "-price", "created_at", "-created_at"]:
+            paginator = KeysetPaginator(Product.objects.all(), field, 5)
+            expected = list(
+                Product.objects.order_by(*paginator.ordering()).values_list("pk", flat=True)
+            )
+
+            last_page, pages = self.walk(paginator)
+            self.assertEqual([pk for page in pages for pk in page], expected, field)
+
+            backwards = [[p.pk for p in last_page]]
+            page = last_page
+            while page.has_previous():
+                page = paginator.get_page(page.previous_cursor)
+                backwards.insert(0, [p.pk for p in page])
+            self.assertEqual(backwards, pages, field)
+
+    def test_catalog_index_pages_match_the_database(self):
+        cheap = Category.objects.create(name="Cheap")
+        for product in Product.objects.filter(price__lte=102):
+            product.categories.add(cheap)
+        index = catalog_index.get_index()
+        queryset = Product.objects.filter(price__gte=101, categories=cheap)
+
+        for sparse_factor in [0, 10_000]:
+            with mock.patch.object(catalog_index, "SPARSE_FACTOR", sparse_factor):
+                for field in ["pk", "price", "-price", "created_at", "-created_at"]:
+                    mask = index.filter_mask(min_price=101, category_ids=[cheap.pk])
+                    paginator = CatalogIndexPaginator(index, mask, queryset, field, 3)
+                    expected = list(
+                        queryset.order_by(*paginator.ordering()).values_list("pk", flat=True)
+                    )
+                    last_page, pages = self.walk(paginator)
+                    self.assertEqual([pk for page in pages for pk in page], expected, field)
+                    self.assertEqual(paginator.estimated_total(), len(expected))
+
+                    page = paginator.get_page(last_page.previous_cursor)
+                    self.assertEqual([p.pk for p in page], pages[-2], field)
+
+    @override_settings(CATALOG_INDEX_MAX_MEMORY=1000)
+    def test_catalog_over_memory_cap_is_served_from_the_database(self):
+        self.assertIsNone(catalog_index.get_index())
+        response = self.client.get(reverse("store:products_page"), {"sorting_key": "price_asc"})
+        self.assertEqual(len(response.context["products"]), 16)
+        self.assertNotIn("price_facets", response.context)
+
+    def test_tampered_cursor_falls_back_to_first_page(self):
+        paginator = KeysetPaginator(Product.objects.all(), "price", 5)
+        first = [p.pk for p in paginator.get_page()]
+        self.assertEqual([p.pk for p in paginator.get_page("not-a-cursor")], first)
+
+    def test_products_view_cursor_links(self):
+        url = reverse("store:products_page")
+        response = self.client.get(url, {"sorting_key": "price_desc"})
+        page = response.context["products"]
+        self.assertEqual(len(page), 16)
+        self.assertEqual(page.estimated_total, 23)
+
+        response = self.client.get(url, {"sorting_key": "price_desc", "cursor": page.next_cursor})
+        self.assertEqual(len(response.context["products"]), 7)
+        self.assertFalse(response.context["products"].has_next())
+
+    @override_settings(CATALOG_INDEX_MAX_MEMORY=1000)
+    def test_database_listing_counts_only_when_asked(self):
+        url = reverse("store:products_page")
+        with self.assertNumQueries(1):
+            page = KeysetPaginator(Product.objects.all(), "price", 16).get_page()
+            self.assertIsNone(page.estimated_total)
+        response = self.client.get(url, {"sorting_key": "price_asc"})
+        self.assertNotContains(response, "products</span>")
+
+        with override_settings(CATALOG_COUNT_TOTAL=True):
+            response = self.client.get(url, {"sorting_key": "price_asc"})
+        self.assertContains(response, "about 23 products")
+
+
+class CatalogFacetTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.fruit = Category.objects.create(name="Fruit")
+        self.dairy = Category.objects.create(name="Dairy")
+        self.apple = make_product("Apple", price=80)
+        self.apple.categories.add(self.fruit)
+        self.mango = make_product("Mango", price=300)
+        self.mango.categories.add(self.fruit)
+        self.milk = make_product("Milk", price=120)
+        self.milk.categories.add(self.dairy)
+
+    def price_counts(self, facets):
+        return {low: count for low, high, count in facets["prices"] if count}
+
+    def test_counts_ignore_own_filter(self):
+        facets = catalog_index.get_index().facets(category_ids=[self.fruit.pk], max_price=200)
+        self.assertEqual(facets["total"], 1)
+        self.assertEqual(facets["categories"], {self.fruit.pk: 1, self.dairy.pk: 1})
+        self.assertEqual(self.price_counts(facets), {0: 1, 250: 1})
+
+    def test_index_is_updated_incrementally(self):
+        index = catalog_index.get_index()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.mango.price = 90
+            self.mango.save()
+            self.milk.categories.add(self.fruit)
+            make_product("Cheese", price=700).categories.add(self.dairy)
+            self.apple.delete()
+
+        self.assertIs(catalog_index.get_index(), index)
+        facets = index.facets()
+        self.assertEqual(facets["total"], 3)
+        self.assertEqual(facets["categories"], {self.fruit.pk: 2, self.dairy.pk: 2})
+        self.assertEqual(self.price_counts(facets), {0: 1, 100: 1, 500: 1})
+
+    def test_rolled_back_change_never_reaches_the_index(self):
+        index = catalog_index.get_index()
+        version = caching.get_version("products")
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                self.mango.price = 5000
+                self.mango.save()
+                raise IntegrityError("rolled back")
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.price_counts(index.facets()), {0: 1, 100: 1, 250: 1})
+        self.assertEqual(caching.get_version("products"), version)
+
+    def test_outdated_index_keeps_serving_while_it_is_rebuilt(self):
+        index = catalog_index.get_index()
+        # another process changes a price and bumps the version
+        Product.objects.filter(pk=self.mango.pk).update(price=90)
+        cache.set(catalog_index.VERSION_KEY, 1, None)
+
+        started = []
+
+        def thread(target, **kwargs):
+            return mock.Mock(start=lambda: started.append(target))
+
+        with mock.patch.object(catalog_index.threading, "Thread", thread):
+            self.assertIs(catalog_index.get_index(), index)
+            # one rebuild at a time
+            self.assertIs(catalog_index.get_index(), index)
+        self.assertEqual(len(started), 1)
+
+        started[0]()
+        rebuilt = catalog_index.get_index()
+        self.assertIsNot(rebuilt, index)
+        self.assertEqual(rebuilt.version, 1)
+        self.assertEqual(self.price_counts(rebuilt.facets()), {0: 2, 100: 1})
+
+    def test_products_view_shows_counts(self):
+        response = self.client.get(reverse("store:products_page"), {"min_price": 100})
+        self.assertContains(response, "Fruit (1)")
+        self.assertContains(response, "Dairy (1)")
+        buckets = {b["low"]: b["count"] for b in response.context["price_facets"]}
+        self.assertEqual(buckets[0], 1)
+
+
+class FeaturedProductsCacheTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = make_product("Featured Honey", featured=True)
+
+    def test_warm_home_page_runs_no_queries(self):
+        url = reverse("store:home_page")
+        self.assertContains(self.client.get(url), "Featured Honey")
+        with self.assertNumQueries(0):
+            self.assertContains(self.client.get(url), "Featured Honey")
+
+    def test_product_changes_invalidate_the_block(self):
+        url = reverse("store:home_page")
+        self.client.get(url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.name = "Featured Ghee"
+            self.product.save()
+        self.assertContains(self.client.get(url), "Featured Ghee")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.delete()
+        self.assertNotContains(self.client.get(url), "Featured Ghee")
+
+
+class RelatedProductsTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = CustomUser.objects.create_user("buyer@example.com", "secret-pass")
+        self.tea = make_product("Green Tea")
+        self.honey = make_product("Honey")
+        self.lemon = make_product("Lemon")
+        self.rice = make_product("Rice")
+        grocery = Category.objects.create(name="Grocery")
+        self.rice.categories.add(grocery)
+        self.tea.categories.add(grocery)
+
+    def order(self, *products, status=Order.Status.PENDING):
+        order = Order.objects.create(
+            user=self.user, order_id=f"ORD-{Order.objects.count()}", subtotal=0, status=status
+        )
+        for product in products:
+            OrderItem.objects.create(order=order, product=product, product_name=product.name, price=1, quantity=1)
+
+    def test_co_purchases_rank_before_category_fallback(self):
+        self.order(self.tea, self.honey, self.lemon)
+        self.order(self.tea, self.honey)
+        self.order(self.tea, self.lemon, status=Order.Status.CANCELLED)
+        recommendations.build_related_products(top_n=3)
+
+        self.assertEqual(
+            recommendations.related_products(self.tea), [self.honey, self.lemon, self.rice]
+        )
+        self.assertEqual(recommendations.related_products(self.rice), [self.tea])
+
+    def test_archived_orders_still_count(self):
+        self.order(self.tea, self.lemon, status=Order.Status.DELIVERED)
+        self.order(self.tea, self.honey, status=Order.Status.CANCELLED)
+        self.assertEqual(archive.archive_orders(before=timezone.now() + timedelta(days=1)), 2)
+        self.order(self.tea, self.lemon)
+
+        counts = recommendations.co_purchase_counts()
+        self.assertEqual(counts[self.tea.pk], {self.lemon.pk: 2})
+
+    def test_detail_page_reads_precomputed_rows(self):
+        self.order(self.tea, self.honey)
+        recommendations.build_related_products()
+        url = reverse("store:product_detail_page", args=[self.tea.pk])
+        with self.assertNumQueries(2):
+            response = self.client.get(url)
+        self.assertEqual(response.context["related_products"], [self.honey, self.rice])
+        self.assertContains(response, reverse("store:product_detail_page", args=[self.honey.pk]))
+
+
+class ImageDerivativeTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media.name))
+
+        buffer = BytesIO()
+        Image.new("RGB", (1000, 800), "green").save(buffer, "JPEG")
+        self.name = default_storage.save("products/honey.jpg", ContentFile(buffer.getvalue()))
+
+    def test_generate_derivatives(self):
+        written = images.generate_derivatives(self.name)
+        self.assertEqual(sorted(written), sorted(images.derivative_names(self.name)))
+        with default_storage.open("products/honey.220w.webp") as f:
+            self.assertEqual(Image.open(f).size, (220, 176))
+        self.assertEqual(images.generate_derivatives(self.name), [])
+
+    def test_picture_tag_falls_back_until_derivatives_exist(self):
+        product = make_product("Honey", image=self.name)
+        tpl = Template("{% load store_images %}{% product_picture product.image alt=product.name %}")
+
+        html = tpl.render(Context({"product": product}))
+        self.assertNotIn("srcset", html)
+
+        call_command("generate_image_derivatives", workers=2, stdout=StringIO())
+        product.refresh_from_db()
+        self.assertEqual(product.derivatives_of, self.name)
+        with mock.patch.object(default_storage, "exists", side_effect=AssertionError("storage probed")):
+            html = tpl.render(Context({"product": product}))
+        self.assertIn('type="image/webp" srcset="/media/products/honey.220w.webp 220w, '
+                      '/media/products/honey.440w.webp 440w"', html)
+        self.assertIn('src="/media/products/honey.220w.jpg"', html)
+
+
+class ConditionalGetTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = make_product("Honey")
+        self.user = CustomUser.objects.create_user("buyer@example.com", "secret-pass")
+
+    def revalidate(self, url, response, **params):
+        return self.client.get(url, params, HTTP_IF_NONE_MATCH=response["ETag"])
+
+    def test_unchanged_listing_is_not_modified(self):
+        url = reverse("store:products_page")
+        response = self.client.get(url, {"sorting_key": "price_asc"})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Last-Modified", response)
+        self.assertIn("Cookie", response["Vary"])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.revalidate(url, response, sorting_key="price_asc").status_code, 304)
+        # another sort order is another representation
+        self.assertEqual(self.revalidate(url, response, sorting_key="price_desc").status_code, 200)
+
+    def test_product_change_invalidates_validators(self):
+        url = reverse("store:product_detail_page", args=[self.product.pk])
+        response = self.client.get(url)
+        self.assertEqual(
+            self.client.get(url, HTTP_IF_MODIFIED_SINCE=response["Last-Modified"]).status_code, 304
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.price = 99
+            self.product.save()
+        self.assertEqual(self.revalidate(url, response).status_code, 200)
+
+    def test_anonymous_and_authenticated_pages_differ(self):
+        url = reverse("store:product_detail_page", args=[self.product.pk])
+        anonymous = self.client.get(url)
+
+        self.client.force_login(self.user)
+        response = self.revalidate(url, anonymous)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], anonymous["ETag"])
+        self.assertIn("private", response["Cache-Control"])
+
+
+class ViewCacheCoalescingTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = make_product("Honey")
+
+    def test_warm_detail_page_runs_no_catalog_queries(self):
+        url = reverse("store:product_detail_page", args=[self.product.pk])
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            self.assertContains(self.client.get(url), "Honey")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.product.name = "Ghee"
+            self.product.save()
+        self.assertContains(self.client.get(url), "Ghee")
+        self.assertEqual(self.client.get(reverse("store:product_detail_page", args=[0])).status_code, 404)
+
+    def test_concurrent_misses_compute_once(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return "value"
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(lambda _: caching.get_or_set("coalesce", compute, 60), range(8)))
+        self.assertEqual(results, ["value"] * 8)
+        self.assertEqual(len(calls), 1)
+
+    def test_expired_entry_is_served_while_another_worker_refreshes(self):
+        caching.get_or_set("stale", lambda: "old", timeout=0, stale_timeout=60)
+        # another worker holds the refresh lock
+        cache.add("stale:lock", 1)
+        self.assertEqual(caching.get_or_set("stale", lambda: "new", 0, 60), "old")
+
+        cache.delete("stale:lock")
+        self.assertEqual(caching.get_or_set("stale", lambda: "new", 60, 60), "new")
+        self.assertEqual(caching.get_or_set("stale", lambda: "newer", 60, 60), "new")
+
+
+class CheckoutTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = CustomUser.objects.create_user("buyer@example.com", "secret-pass")
+        self.client.force_login(self.user)
+        self.cart = Cart.objects.create(user=self.user)
+
+    def fill_cart(self, size):
+        for i in range(size):
+            CartProduct.objects.create(cart=self.cart, product=make_product(f"Item {i}", price=10 + i), quantity=2)
+
+    def test_query_count_does_not_grow_with_cart_size(self):
+        for size in (1, 40):
+            self.fill_cart(size)
+            # savepoint + cart read + order insert + sales rollup + item bulk insert
+            # + cart delete + cart summary update + release
+            with self.assertNumQueries(8):
+                order = checkout.place_order(self.user, self.cart)
+            self.assertEqual(order.items.count(), size)
+            self.assertFalse(self.cart.products.exists())
+
+    def test_order_snapshots_cart(self):
+        self.fill_cart(3)
+        response = self.client.post(reverse("store:place_order"))
+        self.assertRedirects(response, reverse("store:order_page"), fetch_redirect_response=False)
+
+        order = Order.objects.get(user=self.user)
+        self.assertEqual(order.subtotal, (10 + 11 + 12) * 2)
+        self.assertEqual(order.total, order.subtotal)
+        self.assertEqual(
+            sorted(order.items.values_list("product_name", "price", "quantity")),
+            [("Item 0", 10, 2), ("Item 1", 11, 2), ("Item 2", 12, 2)],
+        )
+
+    def test_empty_cart_creates_no_order(self):
+        with self.assertRaises(checkout.EmptyCart):
+            checkout.place_order(self.user, self.cart)
+        self.assertFalse(Order.objects.exists())
+
+
+class OrderHistoryMixin:
+    """A logged in customer with ``add_orders`` to give them numbered orders."""
+
+    def setUp(self):
+        super().setUp()
+        self.user = CustomUser.objects.create_user("regular@example.com", "secret-pass")
+        self.client.force_login(self.user)
+        self.order_count = 0
+
+    def add_orders(self, count, items=3, status=Order.Status.PENDING):
+        for _ in range(count):
+            self.order_count += 1
+            order = Order.objects.create(
+                user=self.user, order_id=f"ORD-HIST-{self.order_count}", subtotal=0, total=10 * items,
+                status=status,
+            )
+            OrderItem.objects.bulk_create(
+                OrderItem(
+                    order=order,
+                    product=make_product(f"Item {self.order_count}-{i}"),
+                    product_name=f"Item {self.order_count}-{i}",
+                    price=10,
+                    quantity=1,
+                )
+                for i in range(items)
+            )
+
+
+class OrderHistoryTests(OrderHistoryMixin, StoreTestCase):
+    def test_query_count_does_not_grow_with_history(self):
+        # caches the navbar cart summary
+        self.client.get(reverse("store:order_page"))
+        for orders in (1, 30):
+            self.add_orders(orders, status=Order.Status.DELIVERED)
+            archive.archive_orders(before=timezone.now() + timedelta(days=1))
+            self.add_orders(orders)
+            # session + user + (orders page + items joined to their products) per tier
+            with self.assertNumQueries(6):
+                response = self.client.get(reverse("store:order_page"))
+            self.assertEqual(response.status_code, 200)
+
+    def test_orders_are_paginated_newest_first(self):
+        self.add_orders(views.ORDERS_PER_PAGE + 2, items=1)
+        response = self.client.get(reverse("store:order_page"))
+        page = response.context["orders"]
+        self.assertEqual(
+            [order.order_id for order in page],
+            [f"ORD-HIST-{n}" for n in range(self.order_count, 2, -1)],
+        )
+
+        response = self.client.get(reverse("store:order_page"), {"cursor": page.next_cursor})
+        self.assertEqual([order.order_id for order in response.context["orders"]], ["ORD-HIST-2", "ORD-HIST-1"])
+
+    def test_items_show_the_price_paid(self):
+        self.add_orders(1, items=1)
+        Product.objects.update(name="Renamed", price=999)
+        response = self.client.get(reverse("store:order_page"))
+        self.assertContains(response, "Item 1-0")
+        self.assertContains(response, "Rs. 10")
+        self.assertNotContains(response, "999")
+
+
+class OrderArchiveTests(OrderHistoryMixin, StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.long_ago = timezone.now() - timedelta(days=settings.ORDER_ARCHIVE_AFTER_DAYS + 1)
+
+    def order(self, number):
+        return Order.objects.get(order_id=f"ORD-HIST-{number}")
+
+    def age(self, *numbers, days=settings.ORDER_ARCHIVE_AFTER_DAYS + 1):
+        moment = timezone.now() - timedelta(days=days)
+        Order.objects.filter(order_id__in=[f"ORD-HIST-{n}" for n in numbers]).update(
+            created_at=moment, updated_at=moment
+        )
+
+    def test_moves_old_finished_orders_with_items_and_payment(self):
+        self.add_orders(2, items=2, status=Order.Status.DELIVERED)
+        self.add_orders(1, status=Order.Status.CANCELLED)
+        self.add_orders(1, status=Order.Status.PENDING)
+        self.add_orders(1, status=Order.Status.DELIVERED)
+        delivered = self.order(1)
+        Payment.objects.create(
+            order=delivered, purchase_order_id="TR-1", pidx="pidx-1", amount=20, status=Payment.Status.SUCCESS
+        )
+        item_ids = sorted(delivered.items.values_list("pk", flat=True))
+        self.age(1, 2, 3, 4)
+        delivered.refresh_from_db()
+
+        self.assertEqual(archive.archive_orders(batch_size=1), 3)
+
+        # pending, and delivered too recently
+        self.assertEqual(sorted(Order.objects.values_list("order_id", flat=True)), ["ORD-HIST-4", "ORD-HIST-5"])
+        archived = ArchivedOrder.objects.get(order_id="ORD-HIST-1")
+        self.assertEqual(archived.pk, delivered.pk)
+        self.assertEqual((archived.status, archived.total, archived.created_at), (delivered.status, delivered.total, delivered.created_at))
+        self.assertEqual(sorted(archived.items.values_list("pk", flat=True)), item_ids)
+        self.assertEqual(archived.payment.pidx, "pidx-1")
+        self.assertFalse(Payment.objects.exists())
+        self.assertEqual(OrderItem.objects.count(), 3 + 3)
+        self.assertEqual(ArchivedOrderItem.objects.count(), 2 + 2 + 3)
+        self.assertEqual(archive.archive_orders(), 0)
+
+    def test_orders_holding_stock_stay(self):
+        self.add_orders(1, items=1, status=Order.Status.CANCELLED)
+        order = self.order(1)
+        StockReservation.objects.create(
+            order=order, product=order.items.get().product, quantity=1, expires_at=timezone.now()
+        )
+        self.age(1)
+        self.assertEqual(archive.archive_orders(), 0)
+
+    def test_order_page_reads_both_tiers_in_order(self):
+        self.add_orders(views.ORDERS_PER_PAGE, items=1, status=Order.Status.DELIVERED)
+        self.add_orders(views.ORDERS_PER_PAGE, items=1)
+        # archived and live orders interleave: odd ones archived, all spread over time
+        for number in range(1, self.order_count + 1):
+            moment = self.long_ago - timedelta(days=self.order_count - number)
+            Order.objects.filter(order_id=f"ORD-HIST-{number}").update(created_at=moment, updated_at=moment)
+        Order.objects.filter(order_id__in=[f"ORD-HIST-{n}" for n in range(2, self.order_count + 1, 2)]).update(
+            status=Order.Status.PENDING
+        )
+        Order.objects.filter(order_id__in=[f"ORD-HIST-{n}" for n in range(1, self.order_count + 1, 2)]).update(
+            status=Order.Status.DELIVERED
+        )
+        archive.archive_orders()
+        self.assertEqual(ArchivedOrder.objects.count(), views.ORDERS_PER_PAGE)
+
+        seen = []
+        cursor = None
+        while True:
+            response = self.client.get(reverse("store:order_page"), {"cursor": cursor} if cursor else {})
+            page = response.context["orders"]
+            seen += [order.order_id for order in page]
+            if not page.has_next():
+                break
+            cursor = page.next_cursor
+        self.assertEqual(seen, [f"ORD-HIST-{n}" for n in range(self.order_count, 0, -1)])
+
+        response = self.client.get(reverse("store:order_page"), {"cursor": page.previous_cursor})
+        self.assertEqual(
+            [order.order_id for order in response.context["orders"]],
+            [f"ORD-HIST-{n}" for n in range(self.order_count, self.order_count - views.ORDERS_PER_PAGE, -1)],
+        )
+        self.assertContains(response, "Item 20-0")
+
+
+class SalesRollupTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = CustomUser.objects.create_user("buyer@example.com", "secret-pass")
+        self.cart = Cart.objects.create(user=self.user)
+        self.honey = make_product("Honey", price=300, image="")
+        self.tea = make_product("Tea", price=50, image="")
+
+    def buy(self, honey=1, tea=2):
+        CartProduct.objects.create(cart=self.cart, product=self.honey, quantity=honey)
+        CartProduct.objects.create(cart=self.cart, product=self.tea, quantity=tea)
+        with self.captureOnCommitCallbacks(execute=True):
+            return checkout.place_order(self.user, self.cart)
+
+    def stats(self):
+        return {
+            (row.status, row.orders, row.revenue)
+            for row in DailyOrderStats.objects.exclude(orders=0)
+        }
+
+    def sales(self):
+        return {
+            (row.product_id, row.units, row.revenue)
+            for row in DailyProductSales.objects.exclude(units=0)
+        }
+
+    def test_status_changes_move_orders_between_rollups(self):
+        first, second = self.buy(), self.buy(honey=2, tea=0)
+        self.assertEqual(self.stats(), {("pending", 2, 1000)})
+        self.assertEqual(self.sales(), set())
+
+        for order in (first, second):
+            order.status = Order.Status.PAID
+            order.save()
+        second.status = Order.Status.DELIVERED
+        second.save()
+        self.assertEqual(self.stats(), {("paid", 1, 400), ("delivered", 1, 600)})
+        self.assertEqual(self.sales(), {(self.honey.pk, 3, 900), (self.tea.pk, 2, 100)})
+
+        first.status = Order.Status.CANCELLED
+        first.save()
+        self.assertEqual(self.stats(), {("cancelled", 1, 400), ("delivered", 1, 600)})
+        self.assertEqual(self.sales(), {(self.honey.pk, 2, 600)})
+        self.assertEqual(DailyOrderStats.objects.get(status="delivered").day, timezone.localdate())
+
+    def test_cancellations_are_recorded(self):
+        expired = self.buy()
+        self.client.force_login(self.user)
+        self.client.post(reverse("store:cancel_order", args=[self.buy().pk]))
+        StockReservation.objects.create(
+            order=expired, product=self.honey, quantity=1, expires_at=timezone.now() - timedelta(minutes=1)
+        )
+        inventory.release_expired()
+        self.assertEqual(self.stats(), {("cancelled", 2, 800)})
+
+    def test_backfill_matches_incremental_rollups_and_archiving_keeps_them(self):
+        orders = [self.buy(), self.buy(honey=3), self.buy(tea=5)]
+        for order, status in zip(orders, (Order.Status.DELIVERED, Order.Status.PAID, Order.Status.CANCELLED)):
+            order.status = status
+            order.save()
+        archive.archive_orders(before=timezone.now() + timedelta(days=1))
+        self.assertEqual(ArchivedOrder.objects.count(), 2)
+        incremental = (self.stats(), self.sales())
+
+        out = StringIO()
+        call_command("backfill_sales_rollups", "--batch-size", "1", stdout=out)
+        self.assertIn("Rolled up 3 orders", out.getvalue())
+        self.assertEqual((self.stats(), self.sales()), incremental)
+
+    def test_dashboard_reads_only_rollups(self):
+        order = self.buy()
+        order.status = Order.Status.PAID
+        order.save()
+        admin_user = CustomUser.objects.create_superuser("admin@example.com", "secret-pass")
+        self.client.force_login(admin_user)
+
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(reverse("admin:store_dailyorderstats_changelist"), {"days": 7})
+        self.assertContains(response, "Sold: 1 orders, Rs. 400")
+        self.assertContains(response, "Honey")
+        for query in captured.captured_queries:
+            self.assertNotRegex(query["sql"], r'"store_order(item)?"')
+
+
+def gateway_response(code=200, **data):
+    response = mock.Mock(status_code=code)
+    response.json.return_value = data
+    return response
+
+
+class KhaltiClientTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        khalti.metrics.reset()
+        self.now = 0.0
+        self.breaker = khalti.CircuitBreaker(3, 30, clock=lambda: self.now)
+        for patcher in (
+            mock.patch.object(khalti, "breaker", self.breaker),
+            mock.patch.object(khalti.time, "sleep"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def gateway(self, *responses):
+        session = mock.Mock()
+        session.post.side_effect = responses
+        patcher = mock.patch.object(khalti, "get_session", return_value=session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return session
+
+    def test_session_is_shared_and_pooled(self):
+        session = khalti.get_session()
+        self.assertIs(khalti.get_session(), session)
+        self.assertEqual(session.get_adapter(settings.KHALTI_BASE_URL)._pool_maxsize, settings.KHALTI_POOL_SIZE)
+
+    def test_lookup_retries_server_errors(self):
+        session = self.gateway(gateway_response(503), requests.ConnectionError("reset"), gateway_response(status="Completed"))
+        self.assertEqual(khalti.lookup("pidx-1"), {"status": "Completed"})
+        self.assertEqual(session.post.call_count, 3)
+
+        stats = khalti.metrics.snapshot()["endpoints"][khalti.LOOKUP_PATH]
+        self.assertEqual(stats["calls"], 3)
+        self.assertEqual(stats["retries"], 2)
+        self.assertEqual(stats["errors"], {"http_503": 1, "ConnectionError": 1})
+
+    def test_retries_are_bounded(self):
+        session = self.gateway(*[gateway_response(502)] * 5)
+        with self.assertRaises(khalti.GatewayUnavailable):
+            khalti.lookup("pidx-1")
+        self.assertEqual(session.post.call_count, settings.KHALTI_MAX_RETRIES + 1)
+
+    def test_initiate_is_only_retried_when_nothing_was_sent(self):
+        session = self.gateway(requests.ReadTimeout("slow"))
+        with self.assertRaises(khalti.GatewayUnavailable):
+            khalti.initiate({"amount": 1000})
+        self.assertEqual(session.post.call_count, 1)
+
+        session = self.gateway(requests.ConnectTimeout("down"), gateway_response(pidx="p", payment_url="https://pay"))
+        self.assertEqual(khalti.initiate({"amount": 1000})["pidx"], "p")
+        self.assertEqual(session.post.call_count, 2)
+
+    def test_rejections_do_not_count_against_the_gateway(self):
+        self.gateway(*[gateway_response(400, detail="bad amount")] * 5)
+        for _ in range(5):
+            with self.assertRaises(khalti.InvalidResponse):
+                khalti.initiate({"amount": 1})
+        self.assertEqual(self.breaker.state, "closed")
+
+    def test_circuit_opens_fails_fast_and_recovers(self):
+        session = self.gateway(*[requests.ReadTimeout("slow")] * 3, gateway_response(pidx="p", payment_url="https://pay"))
+        for _ in range(3):
+            with self.assertRaises(khalti.GatewayUnavailable):
+                khalti.initiate({})
+        self.assertEqual(self.breaker.state, "open")
+
+        with self.assertRaises(khalti.CircuitOpen):
+            khalti.initiate({})
+        self.assertEqual(session.post.call_count, 3)
+        self.assertEqual(khalti.metrics.snapshot()["short_circuits"], {khalti.INITIATE_PATH: 1})
+
+        self.now = 31
+        self.assertEqual(self.breaker.state, "half-open")
+        khalti.initiate({})
+        self.assertEqual(self.breaker.state, "closed")
+
+    def test_failed_trial_call_reopens_the_circuit(self):
+        self.gateway(*[requests.ReadTimeout("slow")] * 4)
+        for _ in range(3):
+            with self.assertRaises(khalti.GatewayUnavailable):
+                khalti.initiate({})
+        self.now = 31
+        with self.assertRaises(khalti.GatewayUnavailable):
+            khalti.initiate({})
+        self.assertEqual(self.breaker.state, "open")
+
+    def test_payment_view_redirects_to_gateway(self):
+        user = CustomUser.objects.create_user("payer@example.com", "secret-pass")
+        self.client.force_login(user)
+        order = Order.objects.create(user=user, order_id="ORD-PAY-1", subtotal=250, total=250)
+        session = self.gateway(gateway_response(pidx="pidx-9", payment_url="https://pay.example/9"))
+
+        response = self.client.get(reverse("store:khalti_payment", args=[order.order_id]))
+        self.assertRedirects(response, "https://pay.example/9", fetch_redirect_response=False)
+        self.assertEqual(Payment.objects.get(order=order).pidx, "pidx-9")
+        self.assertEqual(session.post.call_args.kwargs["json"]["amount"], 25000)
+
+    def test_payment_view_reports_an_unavailable_gateway(self):
+        user = CustomUser.objects.create_user("payer@example.com", "secret-pass")
+        self.client.force_login(user)
+        order = Order.objects.create(user=user, order_id="ORD-PAY-2", subtotal=250, total=250)
+        self.gateway(requests.ReadTimeout("slow"))
+
+        response = self.client.get(reverse("store:khalti_payment", args=[order.order_id]), follow=True)
+        self.assertContains(response, "Payment service unavailable")
+
+    def test_metrics_are_staff_only(self):
+        url = reverse("store:khalti_metrics")
+        self.assertEqual(self.client.get(url).status_code, 302)
+        self.client.force_login(CustomUser.objects.create_superuser("admin@example.com", "secret-pass"))
+        self.assertEqual(self.client.get(url).json()["circuit"], "closed")
+
+
+class AsyncPaymentViewTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        khalti.metrics.reset()
+        patcher = mock.patch.object(khalti, "breaker", khalti.CircuitBreaker(3, 30))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = CustomUser.objects.create_user("payer@example.com", "secret-pass")
+        self.orders = [
+            Order.objects.create(user=self.user, order_id=f"ORD-ASYNC-{i}", subtotal=250, total=250)
+            for i in range(5)
+        ]
+
+    def gateway(self, handler):
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        patcher = mock.patch.object(khalti, "get_async_client", return_value=client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_request(self, url, data=None):
+        request = AsyncRequestFactory().get(url, data)
+        request.session = SessionStore()
+        request._messages = FallbackStorage(request)
+        request.user = self.user
+
+        async def auser():
+            return self.user
+
+        request.auser = auser
+        return request
+
+    def pay(self, order):
+        return views.khalti_payment_async(
+            self.make_request(reverse("store:khalti_payment", args=[order.order_id])), order_id=order.order_id
+        )
+
+    async def test_initiate_redirects_to_gateway(self):
+        def handler(request):
+            self.assertEqual(request.url.path, "/api/v2/epayment/initiate/")
+            return httpx.Response(200, json={"pidx": "pidx-7", "payment_url": "https://pay.example/7"})
+
+        self.gateway(handler)
+        response = await self.pay(self.orders[0])
+        self.assertEqual((response.status_code, response.url), (302, "https://pay.example/7"))
+        payment = await Payment.objects.aget(order=self.orders[0])
+        self.assertEqual(payment.pidx, "pidx-7")
+
+    async def test_slow_gateway_calls_overlap(self):
+        async def handler(request):
+            await asyncio.sleep(0.3)
+            order_id = json.loads(request.content)["purchase_order_name"]
+            return httpx.Response(200, json={"pidx": order_id, "payment_url": f"https://pay.example/{order_id}"})
+
+        self.gateway(handler)
+        start = time.perf_counter()
+        responses = await asyncio.gather(*[self.pay(order) for order in self.orders])
+        # five 0.3s gateway calls waited on together, not one after the other
+        self.assertLess(time.perf_counter() - start, 0.3 * len(self.orders) / 2)
+        self.assertEqual({response.url for response in responses}, {f"https://pay.example/{order.order_id}" for order in self.orders})
+
+    async def test_unavailable_gateway(self):
+        def handler(request):
+            raise httpx.ConnectError("refused")
+
+        self.gateway(handler)
+        with mock.patch.object(khalti.asyncio, "sleep") as sleep:
+            response = await self.pay(self.orders[0])
+        self.assertEqual(response.url, reverse("store:order_page"))
+        # refused connections sent nothing, so even initiate is retried
+        self.assertEqual(sleep.call_count, settings.KHALTI_MAX_RETRIES)
+        self.assertEqual(
+            khalti.metrics.snapshot()["endpoints"][khalti.INITIATE_PATH]["errors"],
+            {"ConnectError": settings.KHALTI_MAX_RETRIES + 1},
+        )
+
+    async def test_callback_marks_order_paid(self):
+        def handler(request):
+            self.assertEqual(request.url.path, "/api/v2/epayment/lookup/")
+            return httpx.Response(200, json={"pidx": "pidx-1", "status": "Completed", "total_amount": 25000, "transaction_id": "TXN-1"})
+
+        self.gateway(handler)
+        order = self.orders[0]
+        await Payment.objects.acreate(order=order, purchase_order_id="TR-1", pidx="pidx-1", amount=250)
+        request = self.make_request(
+            reverse("store:khalti_payment_response"),
+            {"pidx": "pidx-1", "purchase_order_id": "TR-1", "total_amount": "25000", "status": "Completed"},
+        )
+        response = await views.khalti_payment_response_async(request)
+        self.assertEqual(response.url, reverse("store:order_page"))
+        await order.arefresh_from_db()
+        self.assertEqual(order.status, Order.Status.PAID)
+
+        request = self.make_request(reverse("store:khalti_payment_response"), {"pidx": "pidx-1"})
+        response = await views.khalti_payment_response_async(request)
+        self.assertEqual(response.url, reverse("store:home_page"))
+
+    async def test_concurrent_initiations_share_one_gateway_call(self):
+        calls = []
+
+        async def handler(request):
+            calls.append(request)
+            await asyncio.sleep(0.2)
+            return httpx.Response(200, json={"pidx": "pidx-1", "payment_url": "https://pay.example/1", "expires_in": 1800})
+
+        self.gateway(handler)
+        # a customer hammering "Pay"
+        responses = await asyncio.gather(*[self.pay(self.orders[0]) for _ in range(5)])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual({response.url for response in responses}, {"https://pay.example/1"})
+
+
+class ReconciliationTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        khalti.metrics.reset()
+        self.gateway = self.enterContext(stand_in_gateway())
+        self.enterContext(override_settings(KHALTI_BASE_URL=self.gateway.url))
+        for patcher in (
+            mock.patch.object(khalti, "breaker", khalti.CircuitBreaker(3, 30)),
+            mock.patch.object(khalti.time, "sleep"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.user = CustomUser.objects.create_user("payer@example.com", "secret-pass")
+        self.product = make_product("Honey", stock=10)
+
+    def order(self, amount=250):
+        number = Order.objects.count()
+        order = Order.objects.create(user=self.user, order_id=f"ORD-REC-{number}", subtotal=amount, total=amount)
+        StockReservation.objects.create(
+            order=order, product=self.product, quantity=1, expires_at=timezone.now() + timedelta(hours=1),
+        )
+        return order
+
+    def payment(self, status, amount=250, paid_amount=None):
+        """An order with an open payment that Khalti reports as ``status``."""
+        order = self.order(amount)
+        pidx = self.gateway.add_payment((paid_amount or amount) * 100, status)
+        payment = Payment.objects.create(order=order, purchase_order_id=f"TR-{order.order_id}", pidx=pidx, amount=amount)
+        # old enough to be looked up
+        Payment.objects.filter(pk=payment.pk).update(
+            created_at=timezone.now() - timedelta(seconds=settings.PAYMENT_RECONCILE_MIN_AGE + 1)
+        )
+        return payment
+
+    def test_reconcile_settles_open_payments(self):
+        completed = [self.payment("Completed") for _ in range(3)]
+        pending = self.payment("Pending")
+        expired = self.payment("Expired")
+        canceled = self.payment("User canceled")
+        underpaid = self.payment("Completed", paid_amount=10)
+        recent = Payment.objects.get(pk=self.payment("Completed").pk)
+        Payment.objects.filter(pk=recent.pk).update(created_at=timezone.now())
+
+        run = reconciliation.reconcile(batch_size=3, concurrency=4)
+
+        self.assertEqual(run.looked_up, 7)
+        self.assertEqual(+run.outcomes, {"success": 3, "pending": 1, "failed": 2, "amount_mismatch": 1})
+        statuses = dict(Payment.objects.values_list("pk", "status"))
+        self.assertEqual(
+            [statuses[payment.pk] for payment in completed + [pending, expired, canceled, underpaid, recent]],
+            ["success"] * 3 + ["pending", "failed", "failed", "initiated", "initiated"],
+        )
+        paid = Order.objects.filter(status=Order.Status.PAID)
+        self.assertEqual(set(paid), {payment.order for payment in completed})
+        self.assertEqual(Payment.objects.get(pk=completed[0].pk).transaction_id, f"TXN-{completed[0].pidx}")
+        self.assertFalse(StockReservation.objects.filter(order__in=paid).exists())
+        self.assertEqual(DailyOrderStats.objects.get(status=Order.Status.PAID).orders, 3)
+
+        # a second run only looks up what is still open
+        self.assertEqual(reconciliation.reconcile().looked_up, 2)
+
+    def test_reconcile_stops_when_the_circuit_opens(self):
+        for _ in range(4):
+            self.payment("Completed")
+        with mock.patch.object(khalti, "breaker", khalti.CircuitBreaker(1, 30)), \
+                override_settings(KHALTI_BASE_URL="http://127.0.0.1:9/api/v2/"):
+            run = reconciliation.reconcile(batch_size=2, concurrency=1)
+        # the first lookup's retry already finds the circuit open; the second batch is left to the next run
+        self.assertEqual(run.looked_up, 2)
+        self.assertEqual(run.errors, {"CircuitOpen": 2})
+        self.assertFalse(Payment.objects.exclude(status=Payment.Status.INITIATED).exists())
+
+    def test_callback_trusts_the_lookup_not_the_query_string(self):
+        payment = self.payment("Initiated")
+        self.client.force_login(self.user)
+        url = reverse("store:khalti_payment_response")
+        query = {"pidx": payment.pidx, "purchase_order_id": payment.purchase_order_id, "status": "Completed", "transaction_id": "forged"}
+
+        self.client.get(url, query)
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, Payment.Status.INITIATED)
+
+        self.gateway.set_status(payment.pidx, "Completed")
+        response = self.client.get(url, query)
+        self.assertRedirects(response, reverse("store:order_page"), fetch_redirect_response=False)
+        payment.refresh_from_db()
+        self.assertEqual((payment.status, payment.transaction_id), (Payment.Status.SUCCESS, f"TXN-{payment.pidx}"))
+        self.assertEqual(payment.order.status, Order.Status.PAID)
+
+    def test_payment_page_is_reused_until_it_expires(self):
+        order = self.order()
+        self.client.force_login(self.user)
+        url = reverse("store:khalti_payment", args=[order.order_id])
+
+        first = self.client.get(url)["Location"]
+        self.assertEqual(self.client.get(url)["Location"], first)
+        self.assertEqual(len(self.gateway.payments), 1)
+
+        Payment.objects.filter(order=order).update(payment_expires_at=timezone.now() + timedelta(seconds=30))
+        self.assertNotEqual(self.client.get(url)["Location"], first)
+        self.assertEqual(len(self.gateway.payments), 2)
+
+    def test_payment_page_expires_with_the_reservation(self):
+        order = self.order()
+        reservation = order.reservations.get()
+        reservation.expires_at = timezone.now() + timedelta(minutes=10)
+        reservation.save()
+        self.client.force_login(self.user)
+        self.client.get(reverse("store:khalti_payment", args=[order.order_id]))
+        self.assertEqual(Payment.objects.get(order=order).payment_expires_at, reservation.expires_at)
+
+    def test_expired_payment_can_be_started_again(self):
+        payment = self.payment("Expired")
+        expired_pidx = payment.pidx
+        reconciliation.reconcile()
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, Payment.Status.FAILED)
+
+        self.client.force_login(self.user)
+        response = self.client.get(reverse("store:khalti_payment", args=[payment.order.order_id]))
+        self.assertIn("/pay/", response["Location"])
+        self.assertEqual(len(self.gateway.payments), 2)
+        payment.refresh_from_db()
+        self.assertEqual(payment.status, Payment.Status.INITIATED)
+        self.assertNotEqual(payment.pidx, expired_pidx)
+        self.assertIn(payment.pidx, self.gateway.payments)
+
+    def test_only_pending_orders_can_be_paid(self):
+        order = self.order()
+        self.client.force_login(self.user)
+        for status in (Order.Status.CANCELLED, Order.Status.PAID):
+            Order.objects.filter(pk=order.pk).update(status=status)
+            response = self.client.get(reverse("store:khalti_payment", args=[order.order_id]))
+            self.assertRedirects(response, reverse("store:order_page"), fetch_redirect_response=False)
+            self.assertNotContains(self.client.get(reverse("store:order_page")), "Pay</a>")
+        self.assertEqual(self.gateway.payments, {})
+        self.assertFalse(Payment.objects.exists())
+
+    def test_one_request_at_a_time_talks_to_khalti_about_a_payment(self):
+        payment = self.payment("Completed")
+        claim = payments.lock(payment)
+        self.assertIsNotNone(claim)
+        self.assertIsNone(payments.lock(payment))
+
+        # a claim left by a request that died lapses
+        Payment.objects.filter(pk=payment.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+        takeover = payments.lock(payment)
+        self.assertIsNotNone(takeover)
+        payments.unlock(payment, claim)
+        self.assertIsNone(payments.lock(payment))
+        payments.unlock(payment, takeover)
+        self.assertIsNotNone(payments.lock(payment))
+
+    def test_busy_payment_is_not_waited_on_for_long(self):
+        order = self.order()
+        payment = Payment.objects.create(order=order, purchase_order_id=f"TR-{order.order_id}", amount=250)
+        payments.lock(payment)
+        self.client.force_login(self.user)
+        start = time.monotonic()
+        with mock.patch.object(payments, "WAIT_TIMEOUT", 0.2):
+            response = self.client.get(reverse("store:khalti_payment", args=[order.order_id]))
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertRedirects(response, reverse("store:order_page"), fetch_redirect_response=False)
+        self.assertEqual(self.gateway.payments, {})
+
+    def test_repeated_callbacks_look_up_once(self):
+        payment = self.payment("Completed")
+        self.client.force_login(self.user)
+        query = {"pidx": payment.pidx, "purchase_order_id": payment.purchase_order_id}
+        for _ in range(3):
+            response = self.client.get(reverse("store:khalti_payment_response"), query)
+            self.assertRedirects(response, reverse("store:order_page"), fetch_redirect_response=False)
+        self.assertEqual(khalti.metrics.snapshot()["endpoints"][khalti.LOOKUP_PATH]["calls"], 1)
+        self.assertEqual(DailyOrderStats.objects.get(status=Order.Status.PAID).orders, 1)
+
+    def test_payment_through_the_stand_in(self):
+        order = self.order()
+        self.client.force_login(self.user)
+
+        response = self.client.get(reverse("store:khalti_payment", args=[order.order_id]))
+        payment_url = response["Location"]
+        self.assertTrue(payment_url.startswith(self.gateway.url.removesuffix("api/v2/") + "pay/"))
+        # the customer pays on Khalti and is sent back to the callback
+        callback = requests.get(payment_url, allow_redirects=False, timeout=5).headers["Location"]
+        self.assertTrue(callback.startswith(settings.SITE_URL + reverse("store:khalti_payment_response")))
+
+        self.client.get(callback.removeprefix(settings.SITE_URL))
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.Status.PAID)
+
+
+
+class InventoryTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = make_product("Flash Sale Honey", price=100, stock=3)
+
+    def buy(self, email, quantity=1):
+        user = CustomUser.objects.create_user(email, "secret-pass")
+        cart = Cart.objects.create(user=user)
+        CartProduct.objects.create(cart=cart, product=self.product, quantity=quantity)
+        return checkout.place_order(user, cart)
+
+    def test_checkout_never_oversells(self):
+        first = self.buy("a@example.com", quantity=2)
+        with self.assertRaises(inventory.OutOfStock):
+            self.buy("b@example.com", quantity=2)
+        self.buy("c@example.com")
+        with self.assertRaises(inventory.OutOfStock):
+            self.buy("d@example.com")
+
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 0)
+        self.assertEqual(Order.objects.count(), 2)
+        self.assertEqual(first.reservations.get().quantity, 2)
+        # the failed checkout left the cart alone
+        self.assertTrue(CartProduct.objects.filter(cart__user__email="b@example.com").exists())
+
+    def test_untracked_stock_is_not_reserved(self):
+        order = self.buy("a@example.com")
+        untracked = make_product("Rice")
+        user = order.user
+        CartProduct.objects.create(cart=user.cart, product=untracked, quantity=50)
+        second = checkout.place_order(user, user.cart)
+        self.assertFalse(second.reservations.exists())
+
+    def test_sweeper_releases_expired_reservations(self):
+        paid = self.buy("a@example.com")
+        unpaid = self.buy("b@example.com")
+        Order.objects.filter(pk=paid.pk).update(status=Order.Status.PAID)
+        inventory.confirm(paid)
+
+        self.assertEqual(inventory.release_expired(), 0)
+        later = timezone.now() + timedelta(seconds=settings.STOCK_RESERVATION_TTL + 1)
+        placed_at = unpaid.updated_at
+        self.assertEqual(inventory.release_expired(now=later), 1)
+
+        unpaid.refresh_from_db()
+        self.product.refresh_from_db()
+        self.assertEqual(unpaid.status, Order.Status.CANCELLED)
+        # archiving ages orders by when they last changed
+        self.assertGreater(unpaid.updated_at, placed_at)
+        self.assertFalse(unpaid.reservations.exists())
+        self.assertEqual(self.product.stock, 2)
+
+    def test_cancelling_an_order_returns_its_stock(self):
+        order = self.buy("a@example.com", quantity=3)
+        self.client.force_login(order.user)
+        self.client.post(reverse("store:cancel_order", args=[order.pk]))
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 3)
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.Status.CANCELLED)
+
+    def test_only_the_owner_can_cancel_a_pending_order(self):
+        order = self.buy("a@example.com")
+        self.client.force_login(CustomUser.objects.create_user("b@example.com", "secret-pass"))
+        self.assertEqual(self.client.post(reverse("store:cancel_order", args=[order.pk])).status_code, 404)
+
+        Order.objects.filter(pk=order.pk).update(status=Order.Status.PAID)
+        self.client.force_login(order.user)
+        self.assertEqual(self.client.post(reverse("store:cancel_order", args=[order.pk])).status_code, 404)
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.Status.PAID)
+
+
+class OrderIdTests(StoreTestCase):
+    def test_ids_are_unique_and_increasing(self):
+        generator = OrderIdGenerator()
+        ids = [generator() for _ in range(10_000)]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertLessEqual(len(ids[0]), Order._meta.get_field("order_id").max_length)
+
+    def test_clock_stepping_back_or_sequence_overflow_keeps_order(self):
+        generator = OrderIdGenerator()
+        with mock.patch("store.utils.time.time_ns", return_value=5_000_000_000):
+            first = generator.next_value()
+            generator.sequence = MAX_SEQUENCE
+            overflowed = generator.next_value()
+        with mock.patch("store.utils.time.time_ns", return_value=1_000_000_000):
+            stepped_back = generator.next_value()
+        self.assertLess(first, overflowed)
+        self.assertLess(overflowed, stepped_back)
+
+    def test_same_user_can_order_twice_in_a_minute(self):
+        user = CustomUser.objects.create_user("buyer@example.com", "secret-pass")
+        cart = Cart.objects.create(user=user)
+        for _ in range(2):
+            CartProduct.objects.create(cart=cart, product=make_product("Honey"))
+            checkout.place_order(user, cart)
+        self.assertEqual(Order.objects.filter(user=user).count(), 2)
+
+
+class CartLinesTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = CustomUser.objects.create_user("buyer@example.com", "secret-pass")
+        self.client.force_login(self.user)
+        self.cart = Cart.objects.create(user=self.user)
+        self.honey = make_product("Honey", price=100)
+        self.tea = make_product("Tea", price=40)
+        self.rice = make_product("Rice", price=90)
+        CartProduct.objects.create(cart=self.cart, product=self.honey, quantity=1)
+        CartProduct.objects.create(cart=self.cart, product=self.tea, quantity=1)
+
+    def post(self, lines):
+        return self.client.post(
+            reverse("store:update_cart_lines"), {"lines": lines}, content_type="application/json"
+        )
+
+    def test_applies_every_change_in_one_request(self):
+        lines = [
+            {"product_id": self.honey.pk, "quantity": 3},
+            {"product_id": self.tea.pk, "quantity": 0},
+            {"product_id": self.rice.pk, "quantity": 2},
+        ]
+        # session, user, cart, savepoint, product check, upsert, delete, cart summary update,
+        # release, lines
+        with self.assertNumQueries(10):
+            response = self.post(lines)
+
+        self.assertEqual(response.status_code, 200)
+        summary = response.json()
+        self.assertEqual(
+            [(line["name"], line["quantity"], line["subtotal"]) for line in summary["lines"]],
+            [("Honey", 3, "300.00"), ("Rice", 2, "180.00")],
+        )
+        self.assertEqual(summary["count"], 5)
+        self.assertEqual(summary["total"], "480.00")
+
+    def test_rejects_invalid_changes_without_applying_any(self):
+        for body in ([], [{"product_id": self.honey.pk}], [{"product_id": self.honey.pk, "quantity": -1}]):
+            self.assertEqual(self.post(body).status_code, 400)
+
+        response = self.post([{"product_id": self.honey.pk, "quantity": 5}, {"product_id": 0, "quantity": 1}])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Unknown products: 0", response.json()["error"])
+        self.assertEqual(CartProduct.objects.get(cart=self.cart, product=self.honey).quantity, 1)
+
+
+class CartUpsertTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = CustomUser.objects.create_user("buyer@example.com", "secret-pass")
+        self.cart = Cart.objects.create(user=self.user)
+        self.product = make_product("Honey")
+
+    def test_adds_increment_a_single_line(self):
+        self.assertEqual(carts.add_product(self.cart, self.product.pk, 2), (2, True))
+        # savepoint, upsert, cart summary update, release
+        with self.assertNumQueries(4):
+            self.assertEqual(carts.add_product(self.cart, self.product.pk, 3), (5, False))
+        self.assertEqual(CartProduct.objects.get(cart=self.cart).quantity, 5)
+
+    def test_duplicate_lines_are_rejected(self):
+        CartProduct.objects.create(cart=self.cart, product=self.product)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            CartProduct.objects.create(cart=self.cart, product=self.product)
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ConcurrentCartUpsertTests(TransactionTestCase):
+    def test_concurrent_adds_lose_no_update(self):
+        user = CustomUser.objects.create_user("buyer@example.com", "secret-pass")
+        cart = Cart.objects.create(user=user)
+        product = Product.objects.create(name="Honey")
+
+        def add(_):
+            try:
+                done = 0
+                while done < 10:
+                    try:
+                        carts.add_product(cart, product.pk, 1)
+                        done += 1
+                    except OperationalError:
+                        # the in-memory test database reports "table is locked" instead of
+                        # waiting; the failed statement changed nothing, try again
+                        time.sleep(0.001)
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            list(pool.map(add, range(4)))
+        self.assertEqual(list(CartProduct.objects.values_list("quantity", flat=True)), [40])
+
+
+class CartSummaryTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = CustomUser.objects.create_user("buyer@example.com", "secret-pass")
+        self.client.force_login(self.user)
+        self.cart = Cart.objects.create(user=self.user)
+        self.honey = make_product("Honey", price=100)
+        # saved under captureOnCommitCallbacks, no image to generate derivatives for
+        self.tea = make_product("Tea", price=40, image="")
+
+    def assertSummary(self, item_count, total):
+        self.cart.refresh_from_db()
+        self.assertEqual((self.cart.item_count, self.cart.total), (item_count, total))
+        self.assertEqual(carts.get_summary(self.user), {"item_count": item_count, "total": total})
+
+    def test_every_cart_change_updates_the_summary(self):
+        def change(func, *args):
+            # the cached summary is dropped once the change commits
+            with self.captureOnCommitCallbacks(execute=True):
+                func(*args)
+
+        change(self.client.post, reverse("store:add_to_cart", args=[self.honey.pk]), {"quantity": 2})
+        change(self.client.post, reverse("store:add_to_cart", args=[self.tea.pk]))
+        self.assertSummary(3, 240)
+
+        line = CartProduct.objects.get(cart=self.cart, product=self.honey)
+        change(self.client.post, reverse("store:update_cart", args=[line.pk]), {"quantity": 1})
+        self.assertSummary(2, 140)
+
+        self.tea.price = 50
+        change(self.tea.save)
+        self.assertSummary(2, 150)
+
+        change(self.client.post, reverse("store:remove_from_cart", args=[line.pk]))
+        self.assertSummary(1, 50)
+
+        change(checkout.place_order, self.user, self.cart)
+        self.assertSummary(0, 0)
+
+    def test_badge_and_cart_page_queries(self):
+        carts.add_product(self.cart, self.honey.pk, 2)
+        carts.add_product(self.cart, self.tea.pk, 1)
+        self.client.get(reverse("store:home_page"))
+
+        # session and user only: the badge comes from the cache
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse("store:home_page"))
+        self.assertContains(response, ">3</span>")
+
+        # session, user, cart, lines joined to their products
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse("store:cart_page"))
+        self.assertContains(response, "Rs.240.00")
+
+
+class AnonymousCartTests(StoreTestCase):
+    def setUp(self):
+        super().setUp()
+        self.honey = make_product("Honey", price=100)
+        self.tea = make_product("Tea", price=40)
+
+    def cookie_lines(self):
+        request = RequestFactory().get("/")
+        request.COOKIES = {name: morsel.value for name, morsel in self.client.cookies.items()}
+        return carts.read_cookie(request)
+
+    def test_anonymous_cart_writes_no_rows(self):
+        with self.assertNumQueries(1):
+            self.client.post(reverse("store:add_to_cart", args=[self.honey.pk]), {"quantity": 2})
+        self.client.post(reverse("store:add_to_cart", args=[self.tea.pk]))
+        self.client.post(reverse("store:update_cart", args=[self.tea.pk]), {"quantity": 3})
+        self.assertFalse(CartProduct.objects.exists())
+
+        response = self.client.get(reverse("store:cart_page"))
+        self.assertContains(response, "Rs.320.00")
+        self.assertContains(response, ">5</span>")
+
+        self.client.post(reverse("store:remove_from_cart", args=[self.honey.pk]))
+        self.assertEqual(self.cookie_lines(), {self.tea.pk: 3})
+
+    def test_tampered_cookie_is_ignored(self):
+        self.client.cookies[carts.COOKIE_NAME] = "not-signed"
+        self.assertEqual(self.cookie_lines(), {})
+        self.assertContains(self.client.get(reverse("store:cart_page")), "Your cart is empty")
+
+    def test_login_merges_the_cookie_cart(self):
+        user = CustomUser.objects.create_user("buyer@example.com", "secret-pass")
+        carts.add_product(Cart.objects.create(user=user), self.honey.pk, 1)
+        self.client.post(reverse("store:add_to_cart", args=[self.honey.pk]), {"quantity": 2})
+        self.client.post(reverse("store:add_to_cart", args=[self.tea.pk]))
+
+        response = self.client.post(
+            reverse("accounts:login_page") + "?next=" + reverse("store:cart_page"),
+            {"email": "buyer@example.com", "password": "secret-pass"},
+        )
+        self.assertRedirects(response, reverse("store:cart_page"), fetch_redirect_response=False)
+        self.assertEqual(response.cookies[carts.COOKIE_NAME].value, "")
+        self.assertEqual(
+            dict(CartProduct.objects.filter(cart__user=user).values_list("product__name", "quantity")),
+            {"Honey": 3, "Tea": 1},
+        )
+        self.assertEqual(Cart.objects.get(user=user).total, 340)
+
+
+class QueryPlanTests(StoreTestCase):
+    """Every query a view runs must be answered through an index."""
+
+    # tables that are legitimately read in full: the category list on the filter form
+    FULL_SCAN_ALLOWED = {"store_category"}
+
+    def setUp(self):
+        super().setUp()
+        self.user = CustomUser.objects.create_user("shopper@example.com", "secret-pass")
+        self.client.force_login(self.user)
+
+        fruit = Category.objects.create(name="Fruit")
+        for i in range(30):
+            product = make_product(f"Product {i}", price=50 + i * 10, featured=i % 3 == 0)
+            product.categories.add(fruit)
+        self.product = product
+        self.category = fruit
+
+        cart = Cart.objects.create(user=self.user)
+        CartProduct.objects.create(cart=cart, product=product, quantity=2)
+        order = Order.objects.create(user=self.user, order_id="ORD-PLAN-1", subtotal=10, total=10)
+        OrderItem.objects.create(order=order, product=product, product_name="x", price=10, quantity=1)
+
+        # the catalog index build reads the whole table once per process, by design
+        catalog_index.get_index()
+
+    def full_scans(self, sql, params):
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            details = [row[-1] for row in cursor.fetchall()]
+        return [
+            detail
+            for detail in details
+            if re.match(r"SCAN (\w+)$", detail)
+            and re.match(r"SCAN (\w+)$", detail).group(1) not in self.FULL_SCAN_ALLOWED
+        ]
+
+    def assertIndexedQueries(self, url, params=None):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(url, params or {})
+        self.assertLess(response.status_code, 400, url)
+
+        for query in captured.captured_queries:
+            sql = query["sql"]
+            if not sql.lstrip().upper().startswith("SELECT"):
+                continue
+            # the captured sql has its parameters inlined, EXPLAIN it as-is
+            scans = self.full_scans(sql, ())
+            self.assertEqual(scans, [], f"{url} {params}: {sql}")
+
+    def test_catalog_views(self):
+        products_url = reverse("store:products_page")
+        self.assertIndexedQueries(reverse("store:home_page"))
+        self.assertIndexedQueries(products_url)
+        for sorting_key in ["price_asc", "price_desc", "latest", "oldest"]:
+            self.assertIndexedQueries(products_url, {"sorting_key": sorting_key})
+        self.assertIndexedQueries(
+            products_url,
+            {"min_price": 100, "max_price": 200, "categories": self.category.pk, "sorting_key": "latest"},
+        )
+        self.assertIndexedQueries(products_url, {"name": "prod"})
+        self.assertIndexedQueries(reverse("store:product_detail_page", args=[self.product.pk]))
+
+    @override_settings(CATALOG_INDEX_MAX_MEMORY=0)
+    def test_sorted_listing_without_catalog_index(self):
+        catalog_index.reset()
+        products_url = reverse("store:products_page")
+        for sorting_key in ["price_asc", "price_desc", "latest", "oldest"]:
+            self.assertIndexedQueries(products_url, {"sorting_key": sorting_key})
+
+    def test_payment_callback_lookup(self):
+        queryset = Payment.objects.filter(pidx="abc", purchase_order_id="TR-1", amount=10)
+        sql, params = queryset.query.sql_with_params()
+        self.assertEqual(self.full_scans(sql, params), [])
+
+    def test_cart_and_order_views(self):
+        self.assertIndexedQueries(reverse("store:cart_page"))
+        self.assertIndexedQueries(reverse("store:order_page"))
+        self.assertIndexedQueries(reverse("store:place_order"))
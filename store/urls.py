@@ -1,8 +1,14 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
 app_name = "store"
 
+if settings.ASYNC_PAYMENT_VIEWS:
+    khalti_payment, khalti_payment_response = views.khalti_payment_async, views.khalti_payment_response_async
+else:
+    khalti_payment, khalti_payment_response = views.khalti_payment, views.khalti_payment_response
+
 urlpatterns = [
     path("", views.home, name="home_page"),
 
@@ -15,6 +21,7 @@ urlpatterns = [
     path("cart/<int:pk>/remove/", views.remove_from_cart, name="remove_from_cart"),
     path("cart/", views.cart, name="cart_page"),
     path("cart/update/<int:pk>/", views.update_cart, name="update_cart"),
+    path("cart/lines/", views.update_cart_lines, name="update_cart_lines"),
     
     #order
     path("place-order/", views.place_order, name="place_order"),
@@ -22,7 +29,8 @@ urlpatterns = [
     path("order/<int:pk>/cancel/", views.cancel_order, name="cancel_order"),
 
     #khalti-payment
-    path("order/<order_id>/payment/khalti", views.khalti_payment, name="khalti_payment"),
-    path("order/payment/khalti", views.khalti_payment_response, name="khalti_payment_response"),
+    path("order/<order_id>/payment/khalti", khalti_payment, name="khalti_payment"),
+    path("order/payment/khalti", khalti_payment_response, name="khalti_payment_response"),
+    path("payment/khalti/metrics/", views.khalti_metrics, name="khalti_metrics"),
     
 ]
@@ -1,6 +1,67 @@
-from datetime import datetime
+"""Order id generation.
 
+Ids are 96-bit numbers written as 20 Crockford base32 characters after an
+``ORD-`` prefix, laid out like a ULID / Snowflake id::
 
-def generate_order_id(user_id):
-    now = datetime.now()
-    return f"ORD-{now.year}{now.month}{now.day}-{user_id}-{now.hour}{now.minute}"
\ No newline at end of file
+    48 bits  milliseconds since the Unix epoch
+    32 bits  random node id, drawn per process (again after a fork)
+    16 bits  per-process sequence within the millisecond
+
+so they sort by creation time, are strictly increasing within a process and
+need no database round trip. Two gunicorn workers only collide if they draw
+the same node id and create an order in the same millisecond with the same
+sequence number.
+"""
+import os
+import secrets
+import threading
+import time
+
+CROCKFORD = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+ID_LENGTH = 20
+
+SEQUENCE_BITS = 16
+NODE_BITS = 32
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+class OrderIdGenerator:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reseed()
+
+    def reseed(self):
+        self.node = secrets.randbits(NODE_BITS)
+        self.last_ms = 0
+        self.sequence = 0
+
+    def next_value(self):
+        with self.lock:
+            now = time.time_ns() // 1_000_000
+            if now > self.last_ms:
+                self.last_ms, self.sequence = now, 0
+            else:
+                # same millisecond, or the clock stepped back: keep counting from
+                # the last timestamp handed out so ids never go backwards
+                self.sequence += 1
+                if self.sequence > MAX_SEQUENCE:
+                    self.last_ms, self.sequence = self.last_ms + 1, 0
+            return (self.last_ms << (NODE_BITS + SEQUENCE_BITS)) | (self.node << SEQUENCE_BITS) | self.sequence
+
+    def __call__(self):
+        return "ORD-" + encode(self.next_value())
+
+
+def encode(value, length=ID_LENGTH):
+    chars = []
+    for _ in range(length):
+        value, digit = divmod(value, 32)
+        chars.append(CROCKFORD[digit])
+    return "".join(reversed(chars))
+
+
+generate_order_id = OrderIdGenerator()
+
+# a forked worker (gunicorn --preload) must not share its parent's node id
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=generate_order_id.reseed)
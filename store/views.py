@@ -1,30 +1,62 @@
-from django.shortcuts import render, get_object_or_404, redirect
-from .models import Product, Cart, CartProduct , Order , OrderItem, Payment
+from django.shortcuts import render, get_object_or_404, aget_object_or_404, redirect
+from .models import Product, Cart, CartProduct, Order, Payment
 from django.core.paginator import Paginator
 from .forms import ProductFilterForm
+from .pagination import KeysetPaginator, CatalogIndexPaginator
+from .conditional import conditional_catalog_page
 from django.urls import reverse, reverse_lazy
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.db.models import F, Sum, ExpressionWrapper, DecimalField
-from .utils import generate_order_id
+from django.contrib.admin.views.decorators import staff_member_required
+from . import search, catalog_index, caching, recommendations, checkout, inventory, carts, archive, rollups, khalti, reconciliation, payments
 from django.db import transaction, IntegrityError
-import requests
 import json
+import logging
 from decimal import Decimal
 from django.conf import settings
+from django.http import Http404, JsonResponse
+from django.views.decorators.http import require_POST
+from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
+from asgiref.sync import sync_to_async
+
+logger = logging.getLogger(__name__)
 
 
 def home(request):
 
-    featured_products = Product.objects.filter(featured=True).order_by("-created_at")[
-        :8
-    ]
+    version = caching.get_version("products")
+
+    # lazy: only evaluated when the cached fragment in home.html has expired,
+    # and then loaded by a single worker however many requests miss together
+    featured_products = SimpleLazyObject(
+        lambda: caching.get_or_set(
+            caching.versioned_key("products", "featured"),
+            lambda: list(Product.objects.filter(featured=True).order_by("-created_at")[:8]),
+            settings.FEATURED_PRODUCTS_CACHE_TIMEOUT,
+        )
+    )
 
-    context = {"products": featured_products}
+    context = {
+        "products": featured_products,
+        "featured_version": version,
+        "featured_cache_timeout": settings.FEATURED_PRODUCTS_CACHE_TIMEOUT,
+    }
 
     return render(request, "store/home.html", context)
 
 
+PRODUCTS_PER_PAGE = 16
+
+SORT_FIELDS = {
+    "price_asc": "price",
+    "price_desc": "-price",
+    "latest": "-created_at",
+    "oldest": "created_at",
+}
+
+
+@conditional_catalog_page
 def products(request):
     products = Product.objects.all()
 
@@ -32,8 +64,8 @@ def products(request):
     
     if filter_form.is_valid():
         if filter_form.cleaned_data.get('name'):
-            products = products.filter(
-                name__icontains=filter_form.cleaned_data.get('name')
+            products = search.search_queryset(
+                products, filter_form.cleaned_data.get('name')
             )
 
         if filter_form.cleaned_data.get('min_price'):
@@ -47,65 +79,165 @@ def products(request):
             )
 
         if filter_form.cleaned_data.get('categories'):
+                # a product in several of the selected categories would be joined in twice
                 products = products.filter(
                 categories__in=filter_form.cleaned_data.get('categories')
-            )
+            ).distinct()
     
         sorting_key= filter_form.cleaned_data.get("sorting_key")
-        if sorting_key=="price_asc":
-             products = products.order_by("price")
-        elif sorting_key=="price_desc":
-             products = products.order_by("-price")
-        elif sorting_key=="oldest":
-             products = products.order_by("created_at")
-        elif sorting_key=="latest":
-             products = products.order_by("-created_at")
-
-    products_paginator = Paginator(products, 16)
-    page_number = request.GET.get("page")
-    page_obj = products_paginator.get_page(page_number)
+        search_text = filter_form.cleaned_data.get('name')
+    else:
+        sorting_key = search_text = None
 
-    
+    # navigation links keep the filters but not the position
+    query = request.GET.copy()
+    query.pop("page", None)
+    query.pop("cursor", None)
+
+    context = {"filter_form": filter_form, "base_query": query.urlencode()}
+
+    index = catalog_index.get_index()
+    if index is not None and filter_form.is_valid():
+        filters = index_filters(filter_form)
+        context["price_facets"] = product_facets(index, filter_form, filters, query)
+    else:
+        filters = None
+
+    if search_text and sorting_key not in SORT_FIELDS:
+        # relevance order has no column to seek on, search results use offset pages
+        products = products.order_by("search_rank", "pk")
+        products_paginator = Paginator(products, PRODUCTS_PER_PAGE)
+        context["products"] = products_paginator.get_page(request.GET.get("page"))
+    else:
+        sort_field = SORT_FIELDS.get(sorting_key, "pk")
+        if filters is not None:
+            # filter, sort and seek in memory, only the page rows come from the db
+            products_paginator = CatalogIndexPaginator(
+                index, index.filter_mask(**filters), products, sort_field, PRODUCTS_PER_PAGE
+            )
+        else:
+            products_paginator = KeysetPaginator(
+                products, sort_field, PRODUCTS_PER_PAGE, count_total=settings.CATALOG_COUNT_TOTAL
+            )
+        context["products"] = products_paginator.get_page(request.GET.get("cursor"))
+        context["cursor_pagination"] = True
 
-    context = {"products": page_obj,"filter_form": filter_form, }
     return render(request, "store/products.html", context)
 
+def index_filters(filter_form):
+    """Translate the cleaned filter form into catalog index filter arguments."""
+    data = filter_form.cleaned_data
+    product_ids = None
+    if data.get("name"):
+        product_ids = list(
+            search.search_queryset(Product.objects.all(), data["name"]).values_list("pk", flat=True)
+        )
+
+    return {
+        "product_ids": product_ids,
+        "min_price": data.get("min_price") or None,
+        "max_price": data.get("max_price") or None,
+        "category_ids": [category.pk for category in data.get("categories") or []],
+    }
+
+
+def product_facets(index, filter_form, filters, query):
+    """Compute facet counts for the current filters from the in-memory catalog index.
+
+    Category counts are attached to the form's checkbox labels, the price
+    histogram is returned as a list of buckets with a link to select each one.
+    """
+    facets = index.facets(**filters)
+    filter_form.set_category_counts(facets["categories"])
+
+    price_facets = []
+    for low, high, count in facets["prices"]:
+        bucket_query = query.copy()
+        bucket_query["min_price"] = low
+        if high is None:
+            bucket_query.pop("max_price", None)
+        else:
+            bucket_query["max_price"] = high
+        price_facets.append(
+            {"low": low, "high": high, "count": count, "query": bucket_query.urlencode()}
+        )
+    return price_facets
+
+
+@conditional_catalog_page
 def product_detail(request, pk):
-     
-    product = get_object_or_404(Product, pk=pk)
-    context = {"product":product}
+
+    def load():
+        product = Product.objects.filter(pk=pk).first()
+        if product is None:
+            return None
+        return product, recommendations.related_products(product)
+
+    # missing products are cached too, creating one bumps the version
+    detail = caching.get_or_set(
+        caching.versioned_key("products", "detail", pk),
+        load,
+        settings.PRODUCT_DETAIL_CACHE_TIMEOUT,
+        settings.PRODUCT_DETAIL_STALE_TIMEOUT,
+    )
+    if detail is None:
+        raise Http404("No Product matches the given query.")
+
+    product, related_products = detail
+    context = {
+        "product":product,
+        "related_products": related_products,
+    }
     return render(request,"store/product_detail.html", context) 
 
-@login_required(login_url=reverse_lazy("accounts:login_page"))
 def add_to_cart(request, pk):
     product = get_object_or_404(Product, pk=pk)
-    cart, _ = Cart.objects.get_or_create(user=request.user)
-
-    cart_product, created = CartProduct.objects.get_or_create(
-        product=product,
-        cart=cart,
-        defaults={"quantity": int(request.POST.get("quantity", 1))}
-    )
+    quantity = max(1, int(request.POST.get("quantity", 1)))
+
+    if not request.user.is_authenticated:
+        # anonymous carts live in a signed cookie until login
+        lines = carts.read_cookie(request)
+        created = product.pk not in lines
+        lines[product.pk] = lines.get(product.pk, 0) + quantity
+        if len(lines) > carts.MAX_COOKIE_LINES:
+            messages.error(request, "Your cart is full, please log in to add more products")
+            return redirect("store:product_detail_page", pk=pk)
+    else:
+        cart, _ = Cart.objects.get_or_create(user=request.user)
+        _, created = carts.add_product(cart, product.pk, quantity)
 
     if not created:
-        cart_product.quantity += int(request.POST.get("quantity", 1))
-        cart_product.save()
         messages.info(request, "Product quantity updated in cart")
     else:
         messages.success(request, "Product added to cart successfully")
 
-    return redirect("store:product_detail_page", pk=pk)
+    response = redirect("store:product_detail_page", pk=pk)
+    if not request.user.is_authenticated:
+        carts.write_cookie(response, lines)
+    return response
 
 
-@login_required(login_url=reverse_lazy("accounts:login_page"))
 def remove_from_cart(request, pk):
+    if not request.user.is_authenticated:
+        # cookie cart lines are addressed by product id
+        lines = carts.read_cookie(request)
+        response = redirect("store:cart_page")
+        if lines.pop(pk, None) is None:
+            messages.error(request, "Cart item not found")
+        else:
+            messages.success(request, "Cart item removed successfully")
+            carts.write_cookie(response, lines)
+        return response
+
     cart = Cart.objects.filter(user=request.user).first()
     if not cart:
         return redirect("store:cart_page")
 
     try:
-        cart_item = CartProduct.objects.get(pk=pk, cart=cart)
-        cart_item.delete()
+        with transaction.atomic():
+            cart_item = CartProduct.objects.get(pk=pk, cart=cart)
+            cart_item.delete()
+            carts.refresh_summary(cart)
         messages.success(request, "Cart item removed successfully")
     except CartProduct.DoesNotExist:
         messages.error(request, "Cart item not found")
@@ -113,31 +245,42 @@ def remove_from_cart(request, pk):
     return redirect("store:cart_page")
 
 
-@login_required(login_url=reverse_lazy("accounts:login_page"))
 def cart(request):
-    cart, _ = Cart.objects.get_or_create(user=request.user)
+    if not request.user.is_authenticated:
+        cart_products = carts.cookie_cart_lines(carts.read_cookie(request))
+        context = {
+            "products": cart_products,
+            "cart_total": sum((item.get_total_price for item in cart_products), Decimal(0)),
+        }
+        return render(request, "store/cart.html", context)
 
-    cart_products = CartProduct.objects.filter(cart=cart).annotate(
-        subtotal=ExpressionWrapper(
-            F("product__price") * F("quantity"),
-            output_field=DecimalField(max_digits=10, decimal_places=2),
-        )
-    )
+    cart, _ = Cart.objects.get_or_create(user=request.user)
 
-    cart_total = cart_products.aggregate(
-        total=Sum("subtotal")
-    )["total"] or 0
+    # one joined query for the lines, the total is kept on the cart
+    cart_products = CartProduct.objects.filter(cart=cart).select_related("product").order_by("added_at", "pk")
 
     context = {
         "products": cart_products,
-        "cart_total": cart_total
+        "cart_total": cart.total
     }
 
     return render(request, "store/cart.html", context)
 
 
-@login_required(login_url=reverse_lazy("accounts:login_page"))
 def update_cart(request, pk):
+    if request.method == "POST" and not request.user.is_authenticated:
+        lines = carts.read_cookie(request)
+        quantity = int(request.POST.get("quantity", 1))
+        response = redirect("store:cart_page")
+        if pk not in lines:
+            messages.error(request, "Item not found in cart")
+        elif quantity < 1:
+            messages.error(request, "Quantity must be at least 1")
+        else:
+            lines[pk] = quantity
+            carts.write_cookie(response, lines)
+        return response
+
     if request.method == "POST":
         cart = Cart.objects.filter(user=request.user).first()
         if not cart:
@@ -148,8 +291,10 @@ def update_cart(request, pk):
             quantity = int(request.POST.get("quantity", 1))
 
             if quantity >= 1:
-                cart_product.quantity = quantity
-                cart_product.save()
+                with transaction.atomic():
+                    cart_product.quantity = quantity
+                    cart_product.save(update_fields=["quantity"])
+                    carts.refresh_summary(cart)
             else:
                 messages.error(request, "Quantity must be at least 1")
 
@@ -159,47 +304,49 @@ def update_cart(request, pk):
     return redirect("store:cart_page")
 
 
-@login_required(login_url=reverse_lazy("accounts:login_page"))
-def place_order(request):
-    user_cart = request.user.cart
+@require_POST
+def update_cart_lines(request):
+    """Apply a JSON list of ``{product_id, quantity}`` changes and return the new cart."""
+    try:
+        changes = carts.parse_changes(json.loads(request.body))
+    except ValueError:
+        return JsonResponse({"error": "Invalid JSON body."}, status=400)
+    except carts.InvalidChange as e:
+        return JsonResponse({"error": str(e)}, status=400)
 
-    cart_products = CartProduct.objects.filter(cart=user_cart).annotate(
-        subtotal=ExpressionWrapper(
-            F("product__price") * F("quantity"),
-            output_field=DecimalField(max_digits=10, decimal_places=2),
-        )
-    )
-    cart_sub_total = cart_products.aggregate(total=Sum("subtotal"))["total"] or 0
+    if not request.user.is_authenticated:
+        try:
+            lines = carts.change_cookie_lines(carts.read_cookie(request), changes)
+        except carts.InvalidChange as e:
+            return JsonResponse({"error": str(e)}, status=400)
+        response = JsonResponse(carts.cookie_summary(lines))
+        carts.write_cookie(response, lines)
+        return response
 
+    cart, _ = Cart.objects.get_or_create(user=request.user)
     try:
-        order_id = generate_order_id(request.user.id)
-        with transaction.atomic():
-            # create new order
-            new_order = Order.objects.create(
-                user=request.user, order_id=order_id,
-                subtotal=cart_sub_total,
-                total = cart_sub_total,
-            )
+        carts.apply_changes(cart, changes)
+    except carts.InvalidChange as e:
+        return JsonResponse({"error": str(e)}, status=400)
 
-            # create order items for newly created order
-            for cart_item in cart_products:
-                OrderItem.objects.create(
-                    order=new_order,
-                    product=cart_item.product,
-                    product_name=cart_item.product.name,
-                    price=cart_item.product.price,
-                    quantity=cart_item.quantity,
-                )
+    return JsonResponse(carts.cart_summary(cart))
 
-            # remove ordered items from cart
-            for cart_item in cart_products:
-                cart_item.delete()
 
+@login_required(login_url=reverse_lazy("accounts:login_page"))
+def place_order(request):
+    try:
+        checkout.place_order(request.user, request.user.cart)
+    except checkout.EmptyCart:
+        messages.error(request, "Your cart is empty")
+        return redirect("store:cart_page")
+    except inventory.OutOfStock as e:
+        messages.error(request, f"Sorry, {e.product.name} is out of stock")
+        return redirect("store:cart_page")
     except IntegrityError:
         messages.error(request, "Failed to create an order")
         return redirect("store:cart_page")
-    except Exception as e:
-        print("Unexpected behaviour: ", str(e))
+    except Exception:
+        logger.exception("Could not place the order of user %s", request.user.pk)
         return redirect("store:cart_page")
     else:
         messages.success(request, "Order placed successful")
@@ -208,23 +355,34 @@ def place_order(request):
 
 @login_required(login_url=reverse_lazy("accounts:login_page"))
 def cancel_order(request, pk):
-    try:
-        order_to_delete = Order.objects.get(pk=pk)
-    except Order.DoesNotExist:
-        messages.error(request, "Failed to cancel the order")
-    else:
-        order_to_delete.delete()
-        messages.success(request, "Order cancel successful")
+    order = get_object_or_404(Order, pk=pk, user=request.user, status=Order.Status.PENDING)
+    with transaction.atomic():
+        # conditional, a payment may have settled the order since it was read
+        cancelled = Order.objects.filter(pk=order.pk, status=Order.Status.PENDING).update(
+            status=Order.Status.CANCELLED, updated_at=timezone.now()
+        )
+        if cancelled:
+            rollups.record([(order, Order.Status.PENDING, Order.Status.CANCELLED)])
+            inventory.release(order)
 
+    if cancelled:
+        messages.success(request, "Order cancel successful")
+    else:
+        messages.error(request, "Failed to cancel the order")
     return redirect("store:order_page")
 
 
+ORDERS_PER_PAGE = 10
+
+
 @login_required(login_url=reverse_lazy("accounts:login_page"))
 def order(request):
 
-    orders = Order.objects.filter(user=request.user)
+    # live and archived orders, items and their products prefetched per page;
+    # seeks on the (user, -created_at) indexes, so old pages cost the same as the first
+    orders_paginator = archive.order_history(request.user, ORDERS_PER_PAGE)
 
-    context = {"orders": orders}
+    context = {"orders": orders_paginator.get_page(request.GET.get("cursor"))}
 
     return render(request, "store/order.html", context)
 
@@ -237,129 +395,158 @@ def khalti_payment(request, order_id):
         user=request.user,
     )
 
-    if order.status == Order.Status.PAID:
-        messages.info(request, "This order is already paid.")
-        return redirect("store:order_page")
-    
-    purchase_order_id = f"TR-{order.order_id}"
+    if order.status != Order.Status.PENDING:
+        return unpayable_order(request, order)
 
-    # 2. Create or reuse payment safely
-    payment, created = Payment.objects.get_or_create(
-        purchase_order_id=purchase_order_id,
+    payment, _ = Payment.objects.get_or_create(
+        purchase_order_id=f"TR-{order.order_id}",
         defaults={
             "order": order,
             "amount": order.total,
             "status": Payment.Status.INITIATED,
         },
     )
-
-    if not created and payment.status != Payment.Status.INITIATED:
+    if payment.status == Payment.Status.FAILED:
+        payments.reopen(payment)
+    if payment.status != Payment.Status.INITIATED:
         messages.warning(request, "Payment already processed for this order.")
         return redirect("store:order_page")
 
-    amount_paisa = int((payment.amount * Decimal("100")).quantize(Decimal("1")))
+    try:
+        payment_url = payments.start(payment, lambda: khalti.initiate(khalti_payload(request.user, order, payment)))
+    except khalti.GatewayUnavailable:
+        messages.error(request, "Payment service unavailable. Try again later.")
+        return redirect("store:order_page")
+    except khalti.KhaltiError:
+        messages.error(request, "Invalid response from payment gateway.")
+        return redirect("store:order_page")
+    return payment_redirect(request, payment_url)
 
-    payload = {
-        "return_url": settings.SITE_URL + reverse("store:khalti_payment_response"),
-        "website_url": settings.SITE_URL + reverse("store:home_page"),
-        "amount": amount_paisa,
-        "purchase_order_id": payment.purchase_order_id,
-        "purchase_order_name": str(order.order_id),
-        "customer_info": {
-            "name": request.user.get_full_name() or request.user.email,
-            "email": request.user.email,
-            "phone": getattr(order, "phone", "no phone"),
-        },
-    }
-    if not created and payment.status != Payment.Status.INITIATED:
-        messages.warning(request, "Payment already processed for this order.")
+
+def unpayable_order(request, order):
+    if order.status == Order.Status.CANCELLED:
+        messages.warning(request, "This order was cancelled and can no longer be paid.")
+    else:
+        messages.info(request, "This order is already paid.")
+    return redirect("store:order_page")
+
+
+def payment_redirect(request, payment_url):
+    if payment_url is None:
+        messages.info(request, "This payment is already being started, please try again in a moment.")
         return redirect("store:order_page")
+    return redirect(payment_url)
+
+
+def paid_payment(request):
+    """The payment the Khalti redirect is about, or None; the query string is only used to find it."""
+    pidx = request.GET.get("pidx")
+    if not pidx:
+        return None
+    return Payment.objects.filter(pidx=pidx, purchase_order_id=request.GET.get("purchase_order_id")).first()
+
+
+def payment_result(request, status):
+    """Tell the customer where their payment stands after the callback looked it up."""
+    if status == Payment.Status.SUCCESS:
+        messages.success(request, "Payment done, please wait for product to reach your doorstep.")
+    elif status in reconciliation.OPEN_STATUSES or status is None:
+        messages.info(request, "Khalti has not confirmed the payment yet, your order will be updated once it does.")
+    else:
+        messages.error(request, "The payment was not completed.")
+    return redirect("store:order_page")
+
+
+@login_required(login_url=reverse_lazy("accounts:login_page"))
+def khalti_payment_response(request):
+    payment = paid_payment(request)
+    if payment is None:
+        messages.error(request, "Payment not verified yet, please contact the administrator.")
+        return redirect("store:home_page")
+
+    try:
+        status = payments.verify(payment)
+    except khalti.GatewayUnavailable:
+        # left open, reconcile_payments settles it once Khalti answers again
+        status = None
+    except khalti.KhaltiError:
+        messages.error(request, "Payment not verified yet, please contact the administrator.")
+        return redirect("store:home_page")
+    return payment_result(request, status)
 
-    amount_paisa = int((payment.amount * Decimal("100")).quantize(Decimal("1")))
 
-    payload = {
+def khalti_payload(user, order, payment):
+    """Body of the Khalti initiate call for ``payment``."""
+    return {
         "return_url": settings.SITE_URL + reverse("store:khalti_payment_response"),
         "website_url": settings.SITE_URL + reverse("store:home_page"),
-        "amount": amount_paisa,
+        "amount": reconciliation.amount_paisa(payment),
         "purchase_order_id": payment.purchase_order_id,
         "purchase_order_name": str(order.order_id),
         "customer_info": {
-            "name": request.user.get_full_name() or request.user.email,
-            "email": request.user.email,
+            "name": user.get_full_name() or user.email,
+            "email": user.email,
             "phone": getattr(order, "phone", "no phone"),
         },
     }
 
-    headers = {
-        "Authorization": f"Key {settings.KHALTI_SECRET_KEY}",
-        "Content-Type": "application/json",
-    }
 
-    try:
-        response = requests.post(
-            "https://dev.khalti.com/api/v2/epayment/initiate/",
-            json=payload,
-            headers=headers,
-            timeout=10,
-        )
+# async versions of the two payment views, routed instead of the sync ones when
+# ASYNC_PAYMENT_VIEWS is set (the ASGI entry point sets it): while the gateway is
+# slow they wait on the event loop instead of holding a worker thread
 
-        response.raise_for_status()
-        data = response.json()
-    except requests.RequestException as e:
-        messages.error(request, "Payment service unavailable. Try again later.")
-        return redirect("store:order_page")
-    pidx = data.get("pidx")
-    payment_url = data.get("payment_url")
 
-    if not pidx or not payment_url:
-        messages.error(request, "Invalid response from payment gateway.")
-        return redirect("store:order_page")
-    
-    payment.pidx = pidx
-    payment.save(update_fields=["pidx"])
+@login_required(login_url="accounts:login_page")
+async def khalti_payment_async(request, order_id):
+    user = await request.auser()
+    order = await aget_object_or_404(Order, order_id=order_id, user=user)
 
-    return redirect(payment_url)
+    if order.status != Order.Status.PENDING:
+        return unpayable_order(request, order)
 
+    payment, _ = await Payment.objects.aget_or_create(
+        purchase_order_id=f"TR-{order.order_id}",
+        defaults={
+            "order": order,
+            "amount": order.total,
+            "status": Payment.Status.INITIATED,
+        },
+    )
+    if payment.status == Payment.Status.FAILED:
+        await sync_to_async(payments.reopen)(payment)
+    if payment.status != Payment.Status.INITIATED:
+        messages.warning(request, "Payment already processed for this order.")
+        return redirect("store:order_page")
 
+    try:
+        payment_url = await payments.astart(payment, lambda: khalti.ainitiate(khalti_payload(user, order, payment)))
+    except khalti.GatewayUnavailable:
+        messages.error(request, "Payment service unavailable. Try again later.")
+        return redirect("store:order_page")
+    except khalti.KhaltiError:
+        messages.error(request, "Invalid response from payment gateway.")
+        return redirect("store:order_page")
+    return payment_redirect(request, payment_url)
 
 
 @login_required(login_url=reverse_lazy("accounts:login_page"))
-def khalti_payment_response(request):
-    payment_status = request.GET.get("status")
-    pidx = request.GET.get("pidx")
-    transaction_id = request.GET.get("transcation_id")
-    purchase_order_id = request.GET.get("purchase_order_id")
-    amount =Decimal (request.Get.get("total_amount")) /100
-
-
-    try:
-        payment = Payment.objects.get(
-            pidx=pidx,
-            purchase_order_id=purchase_order_id,
-            amount=amount
-        )
-    except Payment.DoesNotExist:
+async def khalti_payment_response_async(request):
+    payment = await sync_to_async(paid_payment)(request)
+    if payment is None:
         messages.error(request, "Payment not verified yet, please contact the administrator.")
         return redirect("store:home_page")
-    except Exception:
+
+    try:
+        status = await payments.averify(payment)
+    except khalti.GatewayUnavailable:
+        status = None
+    except khalti.KhaltiError:
         messages.error(request, "Payment not verified yet, please contact the administrator.")
         return redirect("store:home_page")
-    else:
-        try:
-            with transaction.atomic():
-                payment.status = Payment.Status.SUCCESS
-                payment.save()
-                
-                order = payment.order   # ✅ get related order object
-                order.status = Order.Status.PAID
-                order.save()
-
-        except IntegrityError:
-            messages.error(request, "Payment not verified yet, please contact the administrator.")
-            return redirect("store:home_page")
-        else:
-            messages.success(
-                request,
-                "Payment done, please wait for product to reach your doorstep."
-            )
-            return redirect("store:order_page")
+    return payment_result(request, status)
+
+
+@staff_member_required
+def khalti_metrics(request):
+    """Gateway call counters of the worker process answering this request."""
+    return JsonResponse(khalti.metrics.snapshot())